@@ -0,0 +1,155 @@
+# -------------
+# Shared logging setup
+#
+# Every module used to give its logger its own StreamHandler, so formatting a log line and writing it to the console
+# happened right there on whichever thread logged - including the serial reader and the sensor producer threads. A slow
+# terminal (or disk, once we log to a file) could hold up a sensor read.
+#
+# Now every module just does "logger = get_logger(__name__)". Those loggers don't have handlers of their own - their
+# records go up to the root logger, which has a single QueueHandler that drops them on a queue and returns right away.
+# A QueueListener on a background thread takes them off the queue and hands them to the real handlers:
+#   - the console
+#   - a rotating log file (if config/diagnostics.yaml asks for one)
+#   - anything added with add_handler(), like the GUI's log panel
+#
+# Logging starts up with just the console the first time get_logger() is called, so running any module on its own
+# still prints its logs. The GUI calls configure() to add the file and change levels once it's read the config.
+# Modules import this from the top of the repo, so run them on their own from there too, as modules - e.g
+# "python -m main_pipeline.interpreter" - which is also where the config/ paths they load are relative to.
+# -------------
+
+import os
+import queue
+import atexit
+import threading
+import logging
+import logging.handlers
+import yaml
+
+LOG_FORMAT = "%(levelname)s: %(asctime)s - %(name)s:  %(message)s"
+DATE_FORMAT = "%H:%M:%S"
+
+_queue = queue.SimpleQueue()
+_queue_handler = None
+_listener = None
+_console_handler = None
+_file_handler = None
+_extra_handlers = []
+_lock = threading.Lock()
+
+def default_formatter():
+    return logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
+
+def start():
+    """Hooks the root logger up to the queue and starts the listener thread, with just the console behind it. Does
+    nothing if it's already running"""
+    global _queue_handler, _listener, _console_handler
+    with _lock:
+        if _listener is not None:
+            return
+        _console_handler = logging.StreamHandler()
+        _console_handler.setLevel(logging.DEBUG)
+        _console_handler.setFormatter(default_formatter())
+
+        _queue_handler = logging.handlers.QueueHandler(_queue)
+        root = logging.getLogger()
+        root.addHandler(_queue_handler)
+        # The root logger has to let everything through - each handler behind the listener has its own level
+        root.setLevel(logging.DEBUG)
+
+        _listener = logging.handlers.QueueListener(_queue, _console_handler, respect_handler_level=True)
+        _listener.start()
+    # Make sure whatever's still on the queue gets written out when the program ends
+    atexit.register(stop)
+
+def stop():
+    """Writes out everything still on the queue, stops the listener thread, and closes the handlers"""
+    global _queue_handler, _listener, _file_handler
+    with _lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        logging.getLogger().removeHandler(_queue_handler)
+        for handler in _handlers():
+            handler.close()
+        _queue_handler = None
+        _listener = None
+        _file_handler = None
+
+def _handlers():
+    return tuple(handler for handler in [_console_handler, _file_handler, *_extra_handlers] if handler is not None)
+
+def _update_listener():
+    # The listener reads its handlers tuple fresh for every record, so swapping in a new tuple is safe while it's running
+    if _listener is not None:
+        _listener.handlers = _handlers()
+
+def get_logger(name:str, level:int=logging.DEBUG):
+    """Gets a logger whose records go through the shared queue. Starts the logging thread if it isn't running yet
+
+    Args:
+        name (str): Logger name, usually __name__
+        level (int, optional): Lowest level the logger passes on. Defaults to logging.DEBUG.
+
+    Returns:
+        logger (logging.Logger): The logger
+    """
+    start()
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    return logger
+
+def add_handler(handler:logging.Handler):
+    """Puts another handler behind the queue. It gets called from the listener thread, so it must be thread safe (the
+    GUI's log panel is - it just queues records up for the GUI thread). Give it a formatter first, and a logging.Filter
+    if it should only see some loggers' records"""
+    start()
+    with _lock:
+        if handler not in _extra_handlers:
+            _extra_handlers.append(handler)
+        _update_listener()
+
+def remove_handler(handler:logging.Handler):
+    with _lock:
+        if handler in _extra_handlers:
+            _extra_handlers.remove(handler)
+        _update_listener()
+
+def configure(config:dict):
+    """Sets the console level and the rotating log file from the "Logging" section of diagnostics.yaml
+
+    Args:
+        config (dict): {"console level": str, "file": str or None, "file level": str, "max file size (MB)": float,
+            "backup count": int}
+    """
+    global _file_handler
+    start()
+    with _lock:
+        _console_handler.setLevel(config.get("console level", "DEBUG"))
+        if _file_handler is not None:
+            _file_handler.close()
+            _file_handler = None
+        filepath = config.get("file")
+        if filepath:
+            directory = os.path.dirname(filepath)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            _file_handler = logging.handlers.RotatingFileHandler(filepath,
+                                                                 maxBytes=int(config.get("max file size (MB)", 10)*1e6),
+                                                                 backupCount=int(config.get("backup count", 5)))
+            _file_handler.setLevel(config.get("file level", "DEBUG"))
+            _file_handler.setFormatter(logging.Formatter("%(levelname)s: %(asctime)s - %(threadName)s - %(name)s:  %(message)s"))
+        _update_listener()
+
+def load_config(filepath:str="config/diagnostics.yaml"):
+    """Reads the "Logging" section of the diagnostics config
+
+    Returns:
+        config (dict): The section, or {} (console only) if the file or section isn't there
+    """
+    try:
+        with open(filepath, "r") as stream:
+            return (yaml.safe_load(stream) or {}).get("Logging", {}) or {}
+    except FileNotFoundError as e:
+        get_logger(__name__).warning(f"Couldn't load the diagnostics config, logging to the console only: {e}")
+        return {}
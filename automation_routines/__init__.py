@@ -1,28 +1,24 @@
-from os.path import dirname, basename, isfile, join
-import glob
-import importlib
+from os.path import dirname
 
-# List all python (.py) files in the current folder and assign them to __all__
-    # __all__ manages the "from package import *" feature - it's not strictly necessary in our
-    # case because we're not importing them this way, but I've done it for good measure
-modules = glob.glob(join(dirname(__file__), "*.py"))
-__all__ = [basename(f)[:-3] for f in modules if isfile(f) and not f.endswith('__init__.py')]
+from ._scheduler import RoutineScheduler, run_steps, legacy_steps
+from ._sequences import load_sequences
+from ._registry import RoutineRegistry, LazyRoutine
 
-from . import *
+# We don't import the routine modules here - the registry reads their names (and ROUTINE_INFO) straight out of the
+# files, and each one only gets imported when it's started. That keeps GUI start-up quick no matter how many routines
+# there are. See _registry.py
+registry = RoutineRegistry(dirname(__file__), package=__name__)
 
-# What I really want is to import each module automatically, which I can do with their names
-#   and the importlib library. This function can be called directly either way you prefer -
+# This function can be called directly either way you prefer -
 #   e.g "import automation_routines" -> "automation_routines.get_automation_routines()"
 #   or "automation_routines import get_automation_routines".
 def get_automation_routines():
-    """Imports all the python modules in this package and sticks them in a dictionary. 
+    """Finds all the automation routines in this package and sticks them in a dictionary, along with the valve sequences
+    from config/valve_sequences.yaml (compiled and ready to go). Cheap to call again - only files that have changed since
+    last time get re-read.
 
     Returns:
-        dict: Dictionary with key-value pairs "automation routine name": automation routine module.
+        dict: Dictionary with key-value pairs "automation routine name": routine (a LazyRoutine, which imports the
+            module when it's started, or a SequenceRoutine). Both have steps(**kwargs) and run(**kwargs).
     """
-    auto_routines_dict = {}
-    for module_name in __all__:
-        routine = importlib.import_module("."+module_name, package="automation_routines")
-        auto_routines_dict.update({module_name:routine})
-
-    return auto_routines_dict
\ No newline at end of file
+    return registry.discover()
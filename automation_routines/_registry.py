@@ -0,0 +1,198 @@
+# -------------
+# Routine registry
+#
+# We used to import every routine module as soon as the GUI started, just to put their names in the dropdown. Each one
+# pulls in yaml, the Arduino interface, and whatever else it needs, so start-up got slower with every routine we added.
+#
+# Now we only read the routine files, not run them: each file gets parsed (with ast, which doesn't execute anything) to
+# check it has a steps() or run() function, and to pick up its ROUTINE_INFO dictionary if it has one:
+#
+#   ROUTINE_INFO = {"name": "Leak check", "description": "Pressurizes the line and watches it for 10 minutes"}
+#
+# ROUTINE_INFO has to be a plain literal (strings, numbers, lists, dicts) so we can read it without importing the module.
+# A routine only gets imported when it's started. Everything is cached by the file's modification time, so looking the
+# routines up again is nearly free, and if a file changes it gets re-read (and re-imported next time it's started) -
+# you can edit a routine without restarting the GUI.
+# -------------
+
+import os
+import sys
+import ast
+import glob
+import importlib
+
+try:
+    from automation_routines._scheduler import legacy_steps, run_steps
+    from automation_routines._sequences import load_sequences
+except ImportError:
+    from _scheduler import legacy_steps, run_steps
+    from _sequences import load_sequences
+
+import logging
+from logdecorator import log_on_start , log_on_end , log_on_error
+from app_logging import get_logger
+logger = get_logger(__name__)
+
+# Top-level functions that make a module a routine
+ENTRY_POINTS = ("steps", "run")
+
+def read_routine_info(filepath:str):
+    """Reads what we need to know about a routine file without importing it
+
+    Args:
+        filepath (str): Path to the routine's .py file
+
+    Returns:
+        info (dict): The module's ROUTINE_INFO (empty if it doesn't have one), with "entry points" added - which of
+            steps()/run() it defines. None if the file isn't a routine (no steps() or run())
+    """
+    with open(filepath, "rb") as f:
+        tree = ast.parse(f.read(), filename=filepath)
+    info = {}
+    entry_points = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name in ENTRY_POINTS:
+            entry_points.append(node.name)
+        elif isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == "ROUTINE_INFO"
+                                                  for target in node.targets):
+            try:
+                info = dict(ast.literal_eval(node.value))
+            except (ValueError, TypeError):
+                logger.warning(f"ROUTINE_INFO in {filepath} isn't a plain dictionary, ignoring it")
+    if not entry_points:
+        return None
+    info.setdefault("description", ast.get_docstring(tree) or "")
+    info["entry points"] = entry_points
+    return info
+
+
+class LazyRoutine():
+    """Stand-in for a routine module that only imports it when it's started, and re-imports it if the file changed"""
+    def __init__(self, module_name:str, package:str, filepath:str, info:dict) -> None:
+        """
+        Args:
+            module_name (str): The module's name, e.g "test_routine"
+            package (str): The package it's in, e.g "automation_routines"
+            filepath (str): Path to the module's .py file
+            info (dict): What read_routine_info() found out about it
+        """
+        self.module_name = module_name
+        self.package = package
+        self.filepath = filepath
+        self.info = info
+        self.name = info.get("name", module_name)
+        self.description = info.get("description", "")
+        self._module = None
+        self._loaded_mtime = None
+
+    def __repr__(self):
+        return f"LazyRoutine({self.module_name!r}, loaded={self._module is not None})"
+
+    def load(self):
+        """Imports the module (or re-imports it, if the file has changed since we last did)
+
+        Returns:
+            module (module): The routine module
+        """
+        mtime = os.stat(self.filepath).st_mtime_ns
+        if self._module is not None and mtime != self._loaded_mtime:
+            logger.info(f"{self.filepath} has changed, reloading it")
+            # Import it from scratch rather than importlib.reload(), which leaves behind anything the edit removed
+            # (like a steps() that's been renamed)
+            sys.modules.pop(f"{self.package}.{self.module_name}", None)
+            self._module = None
+        if self._module is None:
+            self._module = importlib.import_module("." + self.module_name, package=self.package)
+        self._loaded_mtime = mtime
+        return self._module
+
+    def steps(self, **kwargs):
+        """Imports the routine and returns its steps. Old routines that only have run() get wrapped up as one step"""
+        module = self.load()
+        if hasattr(module, "steps"):
+            return module.steps(**kwargs)
+        logger.warning(f"{self.name} only has run(), so it can't be paused or stopped partway through")
+        return legacy_steps(module.run, **kwargs)
+
+    def run(self, **kwargs):
+        run_steps(self.steps(**kwargs), name=self.name, custom_logger=kwargs.get("logger"))
+
+
+class RoutineRegistry():
+    """Class that finds the automation routines in a folder (and the valve sequences in the config) and keeps track of
+    them, re-reading only what's changed"""
+    def __init__(self, folder:str, package:str, sequences_filepath:str="config/valve_sequences.yaml",
+                 comms_filepath:str="config/sensor_comms.yaml") -> None:
+        """
+        Args:
+            folder (str): Folder the routine modules are in
+            package (str): Package name of that folder, for importing
+            sequences_filepath (str, optional): Valve sequence config. Defaults to "config/valve_sequences.yaml".
+            comms_filepath (str, optional): Sensor comms config, for the valve pins. Defaults to "config/sensor_comms.yaml".
+        """
+        self.folder = folder
+        self.package = package
+        self.sequences_filepath = sequences_filepath
+        self.comms_filepath = comms_filepath
+        self._files = {}        # {file path: (mtime, LazyRoutine or None if it's not a routine)}
+        self._sequences = (None, {})    # (mtimes of the config files, {name: SequenceRoutine})
+
+    def discover(self):
+        """Finds every routine, re-reading only the files that are new or have changed since last time
+
+        Returns:
+            routines (dict): Dictionary with key-value pairs "routine name": routine (a LazyRoutine or SequenceRoutine)
+        """
+        routines = {}
+        seen = set()
+        # Modules starting with an underscore (like _scheduler) are helpers, not routines
+        for filepath in sorted(glob.glob(os.path.join(self.folder, "[!_]*.py"))):
+            seen.add(filepath)
+            try:
+                mtime = os.stat(filepath).st_mtime_ns
+            except OSError:
+                continue
+            cached = self._files.get(filepath)
+            if cached is not None and cached[0] == mtime:
+                routine = cached[1]
+            else:
+                routine = self._read(filepath, cached[1] if cached is not None else None)
+                self._files[filepath] = (mtime, routine)
+            if routine is not None:
+                routines[routine.name] = routine
+        # Forget about anything that's been deleted
+        for filepath in set(self._files) - seen:
+            del self._files[filepath]
+
+        routines.update(self._discover_sequences())
+        return routines
+
+    def _read(self, filepath:str, previous:LazyRoutine=None):
+        module_name = os.path.basename(filepath)[:-3]
+        try:
+            info = read_routine_info(filepath)
+        except (SyntaxError, ValueError, OSError) as e:
+            logger.warning(f"Couldn't read automation routine {module_name}: {e}")
+            return None
+        if info is None:
+            logger.debug(f"{module_name} has no steps() or run(), so it isn't a routine")
+            return None
+        if previous is not None:
+            # Keep the already-imported module around - it gets reloaded next time it's started
+            previous.info = info
+            previous.name = info.get("name", module_name)
+            previous.description = info.get("description", "")
+            return previous
+        return LazyRoutine(module_name, self.package, filepath, info)
+
+    def _discover_sequences(self):
+        mtimes = []
+        for filepath in (self.sequences_filepath, self.comms_filepath):
+            try:
+                mtimes.append(os.stat(filepath).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        mtimes = tuple(mtimes)
+        if mtimes != self._sequences[0]:
+            self._sequences = (mtimes, load_sequences(self.sequences_filepath, self.comms_filepath))
+        return self._sequences[1]
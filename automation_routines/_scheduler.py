@@ -0,0 +1,231 @@
+# -------------
+# Routine scheduler
+#
+# Automation routines used to run in their own process, and the GUI paused and stopped them by freezing and killing
+# that process (psutil suspend/kill). That could catch a routine halfway through talking to the Arduino and leave the
+# valves in whatever state they happened to be in. Now routines run in the GUI's process as a series of steps, and the
+# scheduler only ever pauses or stops them in between steps.
+#
+# A routine is a generator: it does one step's worth of work, then yields how long to wait (in seconds) before the next
+# step. Yielding None (or 0) just marks a step boundary without waiting. Waits are measured from when the previous wait
+# was *supposed* to end, not from whenever the step happened to finish, so the schedule doesn't drift the way a string
+# of time.sleep() calls does - a step that takes 20 ms just shortens the wait after it by 20 ms.
+#
+# Pausing during a wait holds onto however much of the wait was left, and picks up from there on resume. Stopping closes
+# the generator, which raises GeneratorExit at the yield it's sitting on, so a routine can put its valves somewhere safe
+# in a finally: block.
+# -------------
+
+import time
+import threading
+
+import logging
+from logdecorator import log_on_start , log_on_end , log_on_error
+from app_logging import get_logger
+logger = get_logger(__name__)
+
+# Scheduler states
+IDLE = "idle"
+RUNNING = "running"
+PAUSED = "paused"
+STOPPING = "stopping"
+
+# How the routine ended, passed to on_finished
+FINISHED = "finished"
+STOPPED = "stopped"
+ERROR = "error"
+
+def legacy_steps(run, **kwargs):
+    """Wraps an old-style routine (just a run(**kwargs) function) in a single step, so the scheduler can still start it.
+    It can't be paused or stopped partway through - the scheduler has to wait for run() to return"""
+    run(**kwargs)
+    yield
+
+class RoutineScheduler():
+    """Class that runs one automation routine at a time on its own thread, one step at a time"""
+    def __init__(self, on_finished=None, spin:float=0.002, custom_logger:logging.Logger=None) -> None:
+        """
+        Args:
+            on_finished (callable, optional): Called as on_finished(name, outcome) from the scheduler thread when a
+                routine ends, where outcome is "finished", "stopped", or "error". Defaults to None.
+            spin (float, optional): How close to a deadline (in seconds) we stop sleeping and just poll the clock, since
+                thread waits can overshoot by a millisecond or more (~15 ms on Windows). Defaults to 0.002.
+            custom_logger (logging.Logger, optional): Logger to use instead of the module logger. Defaults to None.
+        """
+        if custom_logger is not None:
+            self.logger = custom_logger
+        else:
+            self.logger = logger
+
+        self.on_finished = on_finished
+        self.spin = spin
+
+        self.name = None
+        self.state = IDLE
+        self._steps = None
+        self._thread = None
+        self._pause_requested = False
+        self._stop_requested = False
+        # Everything that changes the state goes through this, and notifying it wakes up a wait early
+        self._condition = threading.Condition()
+
+    @log_on_start(logging.INFO, "Starting automation routine {name}", logger=logger)
+    def start(self, name:str, steps):
+        """Starts running a routine
+
+        Args:
+            name (str): Name of the routine, for logging
+            steps (generator): The routine's steps, e.g routine_module.steps(**kwargs)
+        """
+        with self._condition:
+            if self.state != IDLE:
+                raise RuntimeError(f"Can't start {name}, {self.name} is still {self.state}")
+            self.name = name
+            self._steps = steps
+            self._pause_requested = False
+            self._stop_requested = False
+            self.state = RUNNING
+        self._thread = threading.Thread(target=self._run, name=f"routine {name}", daemon=True)
+        self._thread.start()
+
+    def pause(self):
+        """Pauses the routine at the next step boundary (straight away, if it's waiting between steps)"""
+        with self._condition:
+            if self.state == RUNNING:
+                self._pause_requested = True
+                self.state = PAUSED
+                self._condition.notify_all()
+
+    def resume(self):
+        """Picks a paused routine back up where it left off"""
+        with self._condition:
+            if self.state == PAUSED:
+                self._pause_requested = False
+                self.state = RUNNING
+                self._condition.notify_all()
+
+    def stop(self, timeout:float=5.0):
+        """Stops the routine at the next step boundary and lets it clean up. Works whether it's running or paused
+
+        Args:
+            timeout (float, optional): How long to wait for the routine to wrap up, in seconds. Defaults to 5.0.
+
+        Returns:
+            stopped (bool): Whether the routine is done (False if it's stuck in a step that hasn't returned yet)
+        """
+        with self._condition:
+            if self.state == IDLE:
+                return True
+            self._stop_requested = True
+            self.state = STOPPING
+            self._condition.notify_all()
+        return self.join(timeout)
+
+    def join(self, timeout:float=None):
+        """Waits for the routine to end
+
+        Returns:
+            done (bool): Whether it ended before the timeout
+        """
+        if self._thread is None:
+            return True
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def is_active(self):
+        """Whether there's a routine running or paused"""
+        return self.state != IDLE
+
+    def _run(self):
+        """Scheduler thread - steps through the routine, waiting in between"""
+        steps = self._steps
+        outcome = FINISHED
+        deadline = time.monotonic()
+        try:
+            while True:
+                # Step boundary - this is the only place we ever pause or stop
+                deadline = self._wait_until(deadline, sleep=False)
+                if deadline is None:
+                    outcome = STOPPED
+                    break
+                try:
+                    delay = next(steps)
+                except StopIteration:
+                    break
+                if delay:
+                    deadline += delay
+                else:
+                    # No wait, but don't let time spent in the step count towards the next wait either
+                    deadline = max(deadline, time.monotonic())
+                deadline = self._wait_until(deadline)
+                if deadline is None:
+                    outcome = STOPPED
+                    break
+        except Exception as e:
+            outcome = ERROR
+            self.logger.error(f"Automation routine {self.name} failed: {e}")
+        finally:
+            try:
+                # Raises GeneratorExit inside the routine so its finally: blocks get to run
+                steps.close()
+            except Exception as e:
+                self.logger.error(f"Automation routine {self.name} failed while cleaning up: {e}")
+            name = self.name
+            with self._condition:
+                self.state = IDLE
+                self._steps = None
+            self.logger.info(f"Automation routine {name} {outcome}")
+            if self.on_finished is not None:
+                self.on_finished(name, outcome)
+
+    def _wait_until(self, deadline:float, sleep:bool=True):
+        """Waits until the deadline (time.monotonic()). Time spent paused pushes the deadline back, so the wait picks up
+        where it left off and the rest of the schedule moves back with it
+
+        Args:
+            deadline (float): When to stop waiting, on the time.monotonic() clock
+            sleep (bool, optional): If False, only wait out a pause, not the deadline itself. Defaults to True.
+
+        Returns:
+            deadline (float): The deadline, pushed back by however long we were paused. None if we've been told to stop
+        """
+        with self._condition:
+            while True:
+                if self._stop_requested:
+                    return None
+                if self._pause_requested:
+                    paused_at = time.monotonic()
+                    while self._pause_requested and not self._stop_requested:
+                        self._condition.wait()
+                    deadline += time.monotonic() - paused_at
+                    continue
+                if not sleep:
+                    return deadline
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return deadline
+                if remaining > self.spin:
+                    self._condition.wait(remaining - self.spin)
+                else:
+                    # Nearly there - let go of the lock briefly instead of trusting the OS to wake us on time
+                    self._condition.release()
+                    try:
+                        time.sleep(0)
+                    finally:
+                        self._condition.acquire()
+
+def run_steps(steps, name:str="routine", custom_logger:logging.Logger=None):
+    """Runs a routine's steps to the end on the calling thread's behalf, e.g to run a routine from the command line
+
+    Args:
+        steps (generator): The routine's steps
+        name (str, optional): Name of the routine, for logging. Defaults to "routine".
+        custom_logger (logging.Logger, optional): Logger to use instead of the module logger. Defaults to None.
+    """
+    scheduler = RoutineScheduler(custom_logger=custom_logger)
+    scheduler.start(name, steps)
+    try:
+        scheduler.join()
+    except KeyboardInterrupt:
+        # Ctrl+C stops the routine cleanly instead of leaving the valves wherever they were
+        scheduler.stop()
@@ -0,0 +1,269 @@
+# -------------
+# Valve sequences
+#
+# Most automation routines are just "open these valves, wait, close those, wait until the pressure drops, ...". Instead
+# of writing a Python routine for each one, they can be written out in config/valve_sequences.yaml:
+#
+#   Evacuate line:
+#     steps:
+#       - close: all
+#       - open: [Button 1, Button 2]
+#       - wait: 5
+#       - wait until: {sensor: Pressure sensor, channel: Pressure (Torr), below: 10, timeout: 600}
+#       - close: [Button 2]
+#       - repeat: 3
+#         steps:
+#           - open: [Button 3]
+#           - wait: 2
+#           - close: [Button 3]
+#           - wait: 1
+#
+# Valves can be named by their button (from the "Pneumatic valves" section of sensor_comms.yaml) or by pin number.
+#
+# When the routines get loaded, each sequence gets compiled into a flat timeline: repeats are unrolled, and every open
+# and close that happens at the same moment gets merged into a single set_pins() command (so the valves switch together,
+# in one serial frame). Each transition's time is worked out ahead of time, measured from the start of the sequence (or
+# from the last "wait until", since we can't know ahead of time how long those take). The scheduler then runs each
+# transition at its precomputed time instead of sleeping for each wait in turn, so the timing error stays the same
+# size no matter how long the sequence runs, instead of growing with every step.
+# -------------
+
+import time
+import yaml
+
+try:
+    from automation_routines._scheduler import run_steps
+except ImportError:
+    from _scheduler import run_steps
+
+import logging
+from logdecorator import log_on_start , log_on_end , log_on_error
+from app_logging import get_logger
+logger = get_logger(__name__)
+
+# Timeline event kinds
+SET = "set"
+UNTIL = "until"
+
+# Comparisons a "wait until" can make, and how long to wait between checks by default (s)
+COMPARISONS = {"below": lambda value, limit: value < limit,
+               "above": lambda value, limit: value > limit}
+DEFAULT_POLL = 0.5
+
+# Pins the Arduino will switch (the same check as ArduinoInterface.validate_and_format_pin - 0 and 1 are its serial port)
+VALID_PINS = range(2, 70)
+
+def compile_sequence(name:str, steps:list, pin_map:dict):
+    """Compiles a sequence's steps into a flat timeline of batched valve transitions
+
+    Args:
+        name (str): Name of the sequence, for error messages
+        steps (list): The sequence's steps, as loaded from the yaml
+        pin_map (dict): "valve name": pin number for every valve we know about
+
+    Returns:
+        timeline (list): List of (time, kind, payload) events in the order they happen. time is in seconds since the
+            start of the sequence, or since the last UNTIL event. For SET events the payload is {pin: 0 or 1}, for UNTIL
+            events it's the condition dict
+
+        **duration** (float): How long the sequence takes, not counting any "wait until"s
+    """
+    timeline = []
+    state = {}      # What we've set each pin to so far
+    pending = {}    # Changes that happen at the current time but haven't been added to the timeline yet
+    clock = {"t": 0.0, "total": 0.0}
+
+    def flush():
+        # Drop anything that doesn't actually change a valve, and emit the rest as one transition
+        changes = {pin: value for pin, value in pending.items() if state.get(pin) != value}
+        if changes:
+            timeline.append((clock["t"], SET, changes))
+            state.update(changes)
+        pending.clear()
+
+    def pins_for(valves, where):
+        if valves == "all":
+            valves = list(pin_map)
+        if not isinstance(valves, list):
+            valves = [valves]
+        pins = []
+        for valve in valves:
+            if isinstance(valve, int) and not isinstance(valve, bool):
+                pin = valve
+            elif valve in pin_map:
+                pin = pin_map[valve]
+            else:
+                raise ValueError(f"{where}: don't know which pin {valve!r} is")
+            # Catch a bad pin now, rather than partway through a run when the Arduino interface refuses it
+            if pin not in VALID_PINS:
+                raise ValueError(f"{where}: pin {pin} ({valve}) isn't one the Arduino can switch "
+                                 f"({VALID_PINS.start}-{VALID_PINS.stop - 1})")
+            pins.append(pin)
+        return sorted(set(pins))
+
+    def walk(steps, path):
+        if not isinstance(steps, list):
+            raise ValueError(f"{path}: steps should be a list")
+        for i, step in enumerate(steps):
+            where = f"{path} step {i+1}"
+            if not isinstance(step, dict):
+                raise ValueError(f"{where}: expected something like 'open: [Button 1]', got {step!r}")
+            if "repeat" in step:
+                times = step["repeat"]
+                if not isinstance(times, int) or times < 0 or set(step) != {"repeat", "steps"}:
+                    raise ValueError(f"{where}: repeat needs a whole number of times and its own steps")
+                for _ in range(times):
+                    walk(step["steps"], f"{where} (repeat)")
+                continue
+            if len(step) != 1:
+                raise ValueError(f"{where}: one action per step, got {list(step)}")
+            action, value = next(iter(step.items()))
+            if action in ("open", "close"):
+                for pin in pins_for(value, where):
+                    pending[pin] = 1 if action == "open" else 0
+            elif action == "wait":
+                if not isinstance(value, (int, float)) or value < 0:
+                    raise ValueError(f"{where}: wait needs a number of seconds, got {value!r}")
+                flush()
+                clock["t"] += value
+                clock["total"] += value
+            elif action == "wait until":
+                condition = dict(value) if isinstance(value, dict) else {}
+                comparisons = [key for key in COMPARISONS if key in condition]
+                if "sensor" not in condition or "channel" not in condition or len(comparisons) != 1:
+                    raise ValueError(f"{where}: wait until needs a sensor, a channel, and one of {list(COMPARISONS)}")
+                condition.setdefault("poll", DEFAULT_POLL)
+                condition.setdefault("timeout", None)
+                condition.setdefault("on timeout", "stop")
+                if condition["on timeout"] not in ("stop", "continue"):
+                    raise ValueError(f"{where}: 'on timeout' should be stop or continue")
+                flush()
+                timeline.append((clock["t"], UNTIL, condition))
+                # Everything after this is timed from when the condition comes true
+                clock["t"] = 0.0
+            else:
+                raise ValueError(f"{where}: unknown action {action!r}")
+
+    walk(steps, name)
+    flush()
+    return timeline, clock["total"]
+
+def connect_arduino(**kwargs):
+    """Gets hold of the Arduino the same way TestRoutine does: the GUI's own interface if it gave us one, or the serial
+    port straight from the config otherwise"""
+    if kwargs.get("arduino") is not None:
+        return kwargs["arduino"]
+    from sensor_interfaces.arduino_interface import ArduinoInterface
+    with open("config/sensor_comms.yaml", "r") as stream:
+        comms_config = yaml.safe_load(stream)
+    return ArduinoInterface(serial_port=comms_config["Arduino"]["serial port"],
+                            baud_rate=comms_config["Arduino"]["baud rate"])
+
+
+class SequenceRoutine():
+    """A compiled valve sequence. Looks like a routine module to the GUI - it has steps() and run()"""
+    def __init__(self, name:str, definition:dict, pin_map:dict) -> None:
+        """
+        Args:
+            name (str): Name of the sequence
+            definition (dict): The sequence's entry in valve_sequences.yaml
+            pin_map (dict): "valve name": pin number for every valve we know about
+        """
+        self.name = name
+        self.description = definition.get("description", "")
+        self.close_on_stop = definition.get("close on stop", True)
+        self.timeline, self.duration = compile_sequence(name, definition.get("steps", []), pin_map)
+        # Every pin the sequence touches, so we can close them all if it gets stopped
+        self.pins = sorted({pin for _, kind, payload in self.timeline if kind == SET for pin in payload})
+
+    def __repr__(self):
+        return f"SequenceRoutine({self.name!r}, {len(self.timeline)} events, {self.duration:g} s)"
+
+    def steps(self, **kwargs):
+        """Runs the timeline, one transition per step. kwargs are the same as any other routine's - "arduino", "logger",
+        and "sensor_data" ({sensor name: SensorBuffer}) for any "wait until"s"""
+        routine_logger = kwargs.get("logger") or logger
+        arduino = connect_arduino(**kwargs)
+        sensor_data = kwargs.get("sensor_data") or {}
+
+        def check_reply(future):
+            if future.exception() is not None:
+                routine_logger.error(f"{self.name}: valve command failed: {future.exception()}")
+
+        elapsed = 0.0
+        completed = False
+        try:
+            for at, kind, payload in self.timeline:
+                if at > elapsed:
+                    yield at - elapsed
+                    elapsed = at
+                if kind == SET:
+                    # Don't wait on the reply here - the next transition's time is already fixed, so we just check it
+                    # came back fine whenever it does. No Future at all means it never got sent (port closed, bad pin)
+                    future = arduino.set_pins(payload)
+                    if future is None:
+                        raise ConnectionError(f"{self.name}: couldn't send valve command {payload} - is the Arduino "
+                                              f"connected?")
+                    future.add_done_callback(check_reply)
+                    continue
+                # UNTIL - check the condition every poll seconds until it comes true or we run out of time
+                yield from self._wait_until(payload, sensor_data, routine_logger)
+                # Start the clock over from now - the zero wait resyncs the scheduler to the current time
+                elapsed = 0.0
+                yield
+            completed = True
+        finally:
+            # Stopped or failed partway through - don't leave valves open
+            if not completed and self.close_on_stop and self.pins:
+                if arduino.set_pins({pin: 0 for pin in self.pins}) is None:
+                    routine_logger.error(f"{self.name}: couldn't close valves {self.pins} after stopping - check them by hand")
+
+    def _wait_until(self, condition:dict, sensor_data:dict, routine_logger:logging.Logger):
+        """Steps that wait on a sensor reading. Only counts readings that came in after we started waiting"""
+        sensor, channel = condition["sensor"], condition["channel"]
+        comparison = next(key for key in COMPARISONS if key in condition)
+        limit = condition[comparison]
+        started = time.time()
+        while True:
+            try:
+                window = sensor_data[sensor].window(1)
+                if len(window) and window[0][sensor_data[sensor].time_key] >= started and \
+                        COMPARISONS[comparison](window[0][channel], limit):
+                    return
+            except (KeyError, ValueError, IndexError) as e:
+                routine_logger.warning(f"{self.name}: can't read {sensor} {channel}: {e}")
+            if condition["timeout"] is not None and time.time() - started > condition["timeout"]:
+                if condition["on timeout"] == "continue":
+                    routine_logger.warning(f"{self.name}: {sensor} {channel} never went {comparison} {limit}, carrying on")
+                    return
+                raise TimeoutError(f"{self.name}: {sensor} {channel} never went {comparison} {limit}")
+            yield condition["poll"]
+
+    def run(self, **kwargs):
+        run_steps(self.steps(**kwargs), name=self.name, custom_logger=kwargs.get("logger"))
+
+
+def load_sequences(filepath:str="config/valve_sequences.yaml", comms_filepath:str="config/sensor_comms.yaml"):
+    """Loads and compiles every sequence in the valve sequence config. Sequences that don't compile get logged and left
+    out, rather than taking the rest down with them
+
+    Returns:
+        sequences (dict): "sequence name": SequenceRoutine
+    """
+    try:
+        with open(filepath, "r") as stream:
+            config = yaml.safe_load(stream) or {}
+        with open(comms_filepath, "r") as stream:
+            valves = yaml.safe_load(stream).get("Pneumatic valves", {}) or {}
+    except FileNotFoundError as e:
+        logger.warning(f"Couldn't load valve sequences: {e}")
+        return {}
+    pin_map = {button: valve["digital pin"] for button, valve in valves.items() if "digital pin" in valve}
+
+    sequences = {}
+    for name, definition in (config.get("Sequences") or {}).items():
+        try:
+            sequences[name] = SequenceRoutine(name, definition or {}, pin_map)
+        except (ValueError, TypeError) as e:
+            logger.error(f"Couldn't compile valve sequence {name}: {e}")
+    return sequences
@@ -1,21 +1,36 @@
 ###
 # Example setup for an automation routine. I suggest setting them all up this way - 
-# a class to manage the routine itself with a single entry point (run_routine). These script
-# MUST have a function called run() in order for the GUI to understand them. 
+# a class to manage the routine itself with a single entry point (steps). These scripts
+# MUST have a function called steps() in order for the GUI to understand them (old scripts with just
+# a run() function still work, but they can't be paused or stopped partway through).
+#
+# steps() is a generator: do a bit of work, then "yield" how many seconds to wait before the next bit.
+# The GUI's scheduler (see _scheduler.py) does the waiting, and it can only pause or stop the routine at
+# a yield - so never leave the valves half-set when you yield, and put anything that has to happen even
+# if the routine gets stopped (like closing the valves) in a finally: block.
 # 
-# Another thing to note is that I've set up run() to take an arbitrary input: run(**kwargs)
+# Another thing to note is that I've set up steps() to take an arbitrary input: steps(**kwargs)
 # It looks like magic, but it just means "keyworded argument". Whatever we give the function gets
 # turned into a dictionary with the key-value pairs we specified. This lets us stay a little more
 # flexible and backwards compatible - if I add a new script with an input we haven't used for
 # old scripts, the old scripts can just ignore the new input. Doesn't work in reverse - we can't stop
 # using established inputs willy nilly - but such is life.
+#
+# ROUTINE_INFO is optional. The GUI reads it straight out of this file without importing it (see _registry.py), so
+# keep it to plain strings/numbers. "name" is what shows up in the dropdown (defaults to the file name).
 ###
 
-import time
 import logging
 import yaml
 
 from sensor_interfaces.arduino_interface import ArduinoInterface
+from automation_routines._scheduler import run_steps
+from app_logging import get_logger
+
+ROUTINE_INFO = {
+    "name": "test_routine",
+    "description": "Closes every valve, opens and closes them one at a time, then opens and closes them all at once",
+}
 
 class TestRoutine:
     def __init__(self, **kwargs):
@@ -30,20 +45,21 @@ class TestRoutine:
         try:
             self.logger = kwargs["logger"]
         except KeyError:
-            self.logger = logging.getLogger(__name__)
-            fh = logging.StreamHandler()
-            fh.setLevel(logging.DEBUG)
-            self.logger.addHandler(fh)
+            self.logger = get_logger(__name__)
 
-        # Set up our instance of the arduino.
-        try:
-            with open("config/sensor_comms.yaml", 'r') as stream:
-                comms_config = yaml.safe_load(stream)
-        except FileNotFoundError as e:
-            self.logger.error(f"Error in loading the sensor_comms configuration file: {e} Check your file storage and directories")
-        
-        self.arduino = ArduinoInterface(serial_port=comms_config["Arduino"]["serial port"], 
-                                        baud_rate=comms_config["Arduino"]["baud rate"])
+        # Set up our instance of the arduino. The GUI runs us in its own process and just hands us its ArduinoInterface, so
+        # the port stays open (and the Arduino doesn't reset). Run on our own, we open the port ourselves
+        if kwargs.get("arduino") is not None:
+            self.arduino = kwargs["arduino"]
+        else:
+            try:
+                with open("config/sensor_comms.yaml", 'r') as stream:
+                    comms_config = yaml.safe_load(stream)
+            except FileNotFoundError as e:
+                self.logger.error(f"Error in loading the sensor_comms configuration file: {e} Check your file storage and directories")
+            
+            self.arduino = ArduinoInterface(serial_port=comms_config["Arduino"]["serial port"], 
+                                            baud_rate=comms_config["Arduino"]["baud rate"])
         
 
         # Read in the Arduino pin configuration set up in our yaml
@@ -54,18 +70,38 @@ class TestRoutine:
         except KeyError:
             self.pin_config_dict = {}
 
-    def run_routine(self):
+    def steps(self):
+        pins = []
         for button in self.pin_config_dict:
             try:
                 pin = self.pin_config_dict[button]["digital pin"]
             except KeyError as e:
                 self.logger.error(f"Could not find corresponding arduino pin for button {button} ({e})")
-            
-            self.arduino.set_pin_high(pin)
-            time.sleep(0.5)
-            self.arduino.set_pin_low(pin)
-            time.sleep(0.5)
+                continue
+            pins.append(pin)
 
-def run(**kwargs):
+        try:
+            # Start from a known state - every valve closed, all switched in one command
+            self.arduino.set_pins({pin: 0 for pin in pins})
+            yield
+
+            # Walk through the valves one at a time
+            for pin in pins:
+                self.arduino.set_pin_high(pin)
+                yield 0.5
+                self.arduino.set_pin_low(pin)
+                yield 0.5
+
+            # Then open and close the whole grid at once
+            self.arduino.set_pins({pin: 1 for pin in pins})
+            yield 0.5
+        finally:
+            # Whether we got to the end or got stopped partway, leave every valve closed
+            self.arduino.set_pins({pin: 0 for pin in pins})
+
+def steps(**kwargs):
     myRoutine = TestRoutine(**kwargs)
-    myRoutine.run_routine()
\ No newline at end of file
+    return myRoutine.steps()
+
+def run(**kwargs):
+    run_steps(steps(**kwargs), name=__name__, custom_logger=kwargs.get("logger"))
@@ -10,51 +10,58 @@ from PyQt5 import QtWidgets, QtCore
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
-from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT  as NavigationToolbar
 # from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 
-import matplotlib.pyplot as plt
 import numpy as np
 import yaml
 import sys
 import time
-import multiprocessing
-import os
-import psutil
-from collections import deque
+from datetime import datetime
+from zoneinfo import ZoneInfo
 from functools import partial
-import concurrent.futures
 import traceback
-import pandas as pd
 import logging
 from logdecorator import log_on_start , log_on_end , log_on_error
 from pathlib import Path
 
-from pyqt_helpers.live_plots import MyFigureCanvas
+from pyqt_helpers.data_buffer import SensorBuffer
 from pyqt_helpers.circle_button import CircleButton
 from pyqt_helpers.custom_logging import GUIHandler
+from pyqt_helpers.metrics_widget import MetricsWidget
 from pyqt_helpers.lines import VLine, HLine
 from pyqt_helpers.helpers import *
 
-from main_pipeline.sensor import Sensor
-from main_pipeline.interpreter import Interpreter
-from main_pipeline.writer import Writer
 from main_pipeline.bus import Bus
+from main_pipeline.acquisition import AcquisitionEngine
+from main_pipeline.registry import SensorRegistry
+from main_pipeline.interpreter import Interpreter, load_derived_config, derived_channel_names
+from main_pipeline import metrics as pipeline_metrics
+from main_pipeline.metrics import metrics
 
 import automation_routines
 
-# Set up a logger for this module
-logger = logging.getLogger("GUI")
-# Set the lowest-severity log message the logger will handle (debug = lowest, critical = highest)
-logger.setLevel(logging.DEBUG)
-# Create a handler that saves logs to the log folder named as the current date
-# fh = logging.FileHandler(f"logs\\{time.strftime('%Y-%m-%d', time.localtime())}.log")
-fh = logging.StreamHandler()
-fh.setLevel(logging.DEBUG)
-logger.addHandler(fh)
-# Create a formatter to specify our log format
-formatter = logging.Formatter("%(levelname)s: %(asctime)s - %(name)s:  %(message)s", datefmt="%H:%M:%S")
-fh.setFormatter(formatter)
+import app_logging
+
+logger = app_logging.get_logger("GUI")
+
+## --------------------- DEFERRED IMPORTS --------------------- ##
+# matplotlib (for the plots) and pandas (pulled in by the data pipeline) take the best part of a second to import, and
+# the window doesn't need either of them to show up. So they get imported on a background thread once the window is up
+# (see ApplicationWindow._background_startup), and these get filled in then
+MyFigureCanvas = None
+NavigationToolbar = None
+Sensor = None
+Writer = None
+Reader = None
+
+def load_deferred_modules():
+    """Imports the slow-to-import plotting and data pipeline modules into the globals above"""
+    global MyFigureCanvas, NavigationToolbar, Sensor, Writer, Reader
+    from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+    from pyqt_helpers.live_plots import MyFigureCanvas
+    from main_pipeline.sensor import Sensor
+    from main_pipeline.writer import Writer
+    from main_pipeline.reader import Reader
 
 class ApplicationWindow(QWidget):
     """
@@ -65,6 +72,14 @@ class ApplicationWindow(QWidget):
         ways to this inheriting, which make some of the syntax slightly different in between applications. Ah well.
         
     """
+    # Emitted (from the scheduler's thread) when an automation routine ends, with the routine name and how it ended.
+    # Qt delivers it on the GUI thread, so the slot can touch the widgets
+    routine_finished = pyqtSignal(str, str)
+    # Start-up happens in stages (see __init__). startup_progress carries a message about what we're doing now, and
+    # startup_finished fires once the hardware and plots are ready to go
+    startup_progress = pyqtSignal(str)
+    startup_finished = pyqtSignal()
+
     def __init__(self):
         """Constructor, called when the class is instantiated"""
         # Initialize the inherited class (QWidget)
@@ -84,11 +99,22 @@ class ApplicationWindow(QWidget):
         self.norm10 = QFont("Helvetica", 10)
 
         self.logger = logger
+        # Add the log file (and set the console level) from the diagnostics config
+        app_logging.configure(app_logging.load_config("config/diagnostics.yaml"))
+
+        # Start-up happens in stages, so the window shows up straight away instead of after everything's loaded:
+        #   1. (here) Build the window skeleton - everything that only needs the config files - and show it. The plots
+        #      are a placeholder, and the controls that talk to hardware are locked
+        #   2. (_background_startup, on a worker thread) Import the plotting and data pipeline libraries and probe the
+        #      hardware, reporting progress in the status panel
+        #   3. (_finish_startup, back here) Set up the rest of the pipeline, swap the real plots in, unlock the controls,
+        #      and start the timers
+        self.startup_time = time.perf_counter()
+        self.startup_complete = False
+        self.startup_cancelled = False
 
         status_layout = self.build_status_layout()
-
-        # Initialize the main sense-interpret-save data pipeline
-        self.init_data_pipeline()
+        self.startup_progress.connect(self._on_startup_progress)
 
         self.data_dict = {
             "all data": {},
@@ -109,10 +135,8 @@ class ApplicationWindow(QWidget):
         with open("config/sensor_comms.yaml", "r") as stream:
             self.sensor_comms = yaml.safe_load(stream)
 
-        # Get today's date
-        current_time = time.time()
-        date = epoch_to_pacific_time(current_time).date
-        self.date_str = str(date[0])
+        # Get today's date (in Pacific time)
+        self.date_str = str(datetime.now(ZoneInfo("America/Los_Angeles")).date())
         
         # Pneumatic grid variables
         with open("config/button_locs.yaml", "r") as stream:
@@ -124,6 +148,9 @@ class ApplicationWindow(QWidget):
         self.num_buttons = len(self.button_locs)
         self.pneumatic_grid_buttons = []
         self.pneumatic_autonomous_controls = {}
+        self.autonomous_control = False
+        # Initialize the plotting flag
+        self.data_collection = False
         
         # Create the main GUI panels
         # We can arrange things in a QGridLayout by specifying (row, column, rowspan, columnspan)
@@ -131,7 +158,7 @@ class ApplicationWindow(QWidget):
         main_layout.addLayout(status_layout, 2, 0)
         main_layout.addLayout(self.build_control_layout(), 0, 0)
         main_layout.addLayout(self.build_pneum_ctrl_layout(), 1, 0)
-        main_layout.addLayout(self.build_plotting_layout(), 0, 1, 1, 2)
+        main_layout.addLayout(self.build_plotting_placeholder(), 0, 1, 1, 2)
         main_layout.addLayout(self.build_pneumatic_layout(), 1, 1, 2, 2)
 
         main_layout.setColumnStretch(0, 0)
@@ -141,41 +168,113 @@ class ApplicationWindow(QWidget):
         main_layout.setRowStretch(2, 1)
 
         self.setLayout(main_layout)
+
+        # Lock every control that's enabled right now until the hardware's ready - they all expect self.sensor to exist.
+        # _finish_startup unlocks exactly these again
+        self.startup_locked_widgets = [widget for widget in self.findChildren(QWidget)
+                                       if isinstance(widget, (QAbstractButton, QLineEdit, QComboBox)) and widget.isEnabled()]
+        for widget in self.startup_locked_widgets:
+            widget.setEnabled(False)
         
         # Create a threadpool for this class, so we can do threading later
         self.threadpool = QThreadPool()
             
-        # Initiate two timers that both trigger every X ms:
-        timer_update = 1000
+        # Initiate two timers that both trigger every X ms (they get started once start-up finishes):
+        self.timer_update = 1000
         # One for updating the plots...
         self.plot_figs_timer = QTimer()
         self.plot_figs_timer.timeout.connect(self.update_plots)
-        self.plot_figs_timer.start(timer_update)
-        # ...and one for collecting, processing, and saving data
+        # ...and one for starting/stopping the acquisition engine and grabbing the data it's collected. The engine
+        # runs on its own threads at its own rates, this timer just picks up the results
         self.execution_timer = QTimer()
         self.execution_timer.timeout.connect(self.run_data_collection)
-        self.execution_timer.start(timer_update)
         
-        # Show the window
+        # Show the window, then kick off the slow part of start-up once the event loop has had a chance to draw it
         self.show()
+        QTimer.singleShot(0, self._start_background_startup)
+
+    ## --------------------- STAGED STARTUP --------------------- ##
+
+    def _start_background_startup(self):
+        """Starts stage 2 of start-up (importing libraries and probing hardware) on a worker thread"""
+        logger.info(f"Window up in {time.perf_counter() - self.startup_time:.2f} s, loading the rest in the background")
+        worker = Worker(self._background_startup)
+        worker.signals.result.connect(self._finish_startup)
+        worker.signals.error.connect(self._on_startup_error)
+        self.threadpool.start(worker)
+
+    def _background_startup(self):
+        """Stage 2 of start-up, on a worker thread: everything slow that doesn't touch the widgets
+
+        Returns:
+            sensor (Sensor): The sensor object, with the hardware probed and connected (or simulated)
+        """
+        self.startup_progress.emit("Loading plotting and data libraries...")
+        load_deferred_modules()
+        self.startup_progress.emit("Looking for sensor hardware...")
+        return Sensor(custom_logger=logger, debug=False)
+
+    def _on_startup_progress(self, message:str):
+        logger.info(message)
+
+    def _on_startup_error(self, error:tuple):
+        exctype, value, _ = error
+        logger.critical(f"Start-up failed, hardware controls will stay locked: {exctype.__name__}: {value}")
+
+    def _finish_startup(self, sensor):
+        """Stage 3 of start-up, back on the GUI thread: hook the hardware up to the rest of the pipeline and the widgets
+
+        Args:
+            sensor (Sensor): The sensor object _background_startup made
+        """
+        if self.startup_cancelled:
+            sensor.shutdown_sensors()
+            sensor.close_arduino_serial()
+            return
+        self.startup_progress.emit("Setting up the data pipeline and plots...")
+        self.sensor = sensor
+        # Initialize the main sense-interpret-save data pipeline
+        self.init_data_pipeline()
+        # Swap the real plots in for the placeholder
+        self.plotting_placeholder.deleteLater()
+        self.plotting_area.addLayout(self.build_plotting_layout())
+        for widget in self.startup_locked_widgets:
+            widget.setEnabled(True)
+        self.plot_figs_timer.start(self.timer_update)
+        self.execution_timer.start(self.timer_update)
+        if self.metrics_widget is not None:
+            self.metrics_widget.start()
+        self.startup_complete = True
+        logger.info(f"Start-up finished in {time.perf_counter() - self.startup_time:.2f} s")
+        self.startup_finished.emit()
 
     def __del__(self):
         """Destructor, called when the class is destroyed
         """
-        self.sensor.shutdown_sensors()
+        if getattr(self, "startup_complete", False):
+            self.sensor.shutdown_sensors()
     
     def closeEvent(self, event):
         """This method overwrites the default QWidget closeEvent that triggers when the window "X" is clicked.
         It ensures we can shutdown sensors cleanly by opening a QMessageBox to prompt the user to quit/cancel
         """
-
-        try:
-            if self.multiprocess.is_alive():
-                self.p.kill()
-                self.multiprocess.terminate()
-                self.multiprocess.join()
-        except AttributeError:
-            pass
+        # The log panel's going away with the window, so stop sending it records (the console and log file keep going)
+        app_logging.remove_handler(self.GUI_log_handler)
+        # If we're closed before start-up finished, there's no pipeline to shut down yet - _finish_startup will just
+        # let go of the hardware when the background stage is done
+        if not self.startup_complete:
+            self.startup_cancelled = True
+            return
+        # Stop the acquisition threads so they aren't left polling sensors after the window is gone, and make sure
+        # any data still waiting in the writer makes it to the disk
+        self.acquisition.stop()
+        self.writer.close_file()
+        # Stop any automation routine, so it gets to close its valves on the way out
+        self.routine_scheduler.stop()
+        # Write out the last stretch of metrics
+        if self.metrics_widget is not None:
+            self.metrics_widget.stop()
+        metrics.stop_dumping()
         
         # self.check_close_event()
         # # If we actually want to shut down, shutdown the sensors and then accept the closeEvent
@@ -451,9 +550,11 @@ class ApplicationWindow(QWidget):
             # to execute and the following arguments are its inputs. I use this to pass each sensor button function into a general
             # "_on_sensor_button" method that updates the sensor status as well as executing the desired callback whenever the button
             # is pressed
+            # The sensors don't exist yet when the buttons get made (see _finish_startup), so the buttons look up the methods
+            # through _call_sensor when they're pressed
         sensor_buttons = {}
-        sensor_buttons.update({"Arduino": {"Start Arduino": partial(self._on_sensor_button, "Arduino", self.sensor.arduino.initialize_arduino),
-                                           "Stop Arduino": partial(self._on_sensor_button, "Arduino", self.sensor.arduino.shutdown_arduino)}})
+        sensor_buttons.update({"Arduino": {"Start Arduino": partial(self._on_sensor_button, "Arduino", partial(self._call_sensor, "arduino", "initialize_arduino")),
+                                           "Stop Arduino": partial(self._on_sensor_button, "Arduino", partial(self._call_sensor, "arduino", "shutdown_arduino"))}})
 
         # sensor_buttons.update({"Picarro Gas": {"Start Picarro":
         #                                        partial(self._on_sensor_button, "Picarro Gas", self.sensor.gas_picarro.initialize_picarro)}})
@@ -463,10 +564,14 @@ class ApplicationWindow(QWidget):
             # sensor and which input parameter we're sending, which gets read from a dictionary in _send_control_input and saved to 
             # that dictionary in _save_control_input
         input_buttons = {}
-        input_buttons.update({"Arduino": {"Arduino Input": partial(self._send_control_input, "Arduino", "Arduino control 1", self.sensor.arduino.send_command)}})      
+        input_buttons.update({"Arduino": {"Arduino Input": partial(self._send_control_input, "Arduino", "Arduino control 1", partial(self._call_sensor, "arduino", "send_command"))}})      
 
         return title_buttons, sensor_buttons, input_buttons
         
+    def _call_sensor(self, device:str, method:str, *args):
+        """Calls a method of one of self.sensor's devices, e.g _call_sensor("arduino", "send_command", command)"""
+        return getattr(getattr(self.sensor, device), method)(*args)
+
     def _on_sensor_button(self, sensor:str, initialization_function):
         """Method that calls the function passed into initialization_function, gets the initialization result,
         and uses it to update the appropriate sensor status.
@@ -736,6 +841,12 @@ class ApplicationWindow(QWidget):
         files_exist_flag = False
         for data in self.current_data_paths:
             path = self.current_data_paths[data]
+            # The writer makes the data file (with the right header) itself, so just check if it's there already
+            if data == "all data":
+                if Path(path).exists():
+                    files_exist_flag = True
+                    break
+                continue
             # Try to make it. If the filename exists, 'x' will raise a FileExistsError
             try:
                 write_new_csv_dict(path, self.data_dict[data])
@@ -765,6 +876,9 @@ class ApplicationWindow(QWidget):
         # Finally, now that the user is done editing, do some internal cleaning up - 
         # Update our internal metadata
         self.data_dict["metadata"] = metadata
+        # Point the writer at the new data file. It appends if the file already has data in it
+        sensor_channels = {sensor: list(self.big_data_dict[sensor]["Data"].keys()) for sensor in self.sensor_names}
+        self.writer.open_file(self.current_data_paths["all data"], sensor_channels)
         # Activate data collection (eventually)
         print("Data collection currently deactivated")
         # self.data_collection = True
@@ -999,7 +1113,7 @@ class ApplicationWindow(QWidget):
         # Automation routine section
         label = self.default_label("Automation Routine", self.norm12)
         pneum_control_layout.addWidget(label, alignment=Qt.AlignHCenter|Qt.AlignBottom)
-        # Get the available routines
+        # Get the available routines. This only reads their names - they get imported when they're started
         self.auto_routine_dict = automation_routines.get_automation_routines()
         # Make a combobox to let the user choose the automation routine
         dropdown = QComboBox()
@@ -1041,73 +1155,83 @@ class ApplicationWindow(QWidget):
                 pneumatic_button.setDisabled(True)
             for _, control in self.pneumatic_autonomous_controls.items():
                 control.setEnabled(True)
-            self.sensor.close_arduino_serial()
-        # If button is unchecked, lock out autonomous controls
+            self.autonomous_control = True
+            # Pick up any routines that have been added or edited since we last looked
+            if not self.routine_scheduler.is_active():
+                self._refresh_routines()
+        # If button is unchecked, lock out autonomous controls, and stop any routine that's going so it doesn't fight
+        # with whoever is clicking the valves
         else:
             button.setText("Enable Autonomous Valve Control")
             for pneumatic_button in self.pneumatic_grid_buttons:
                 pneumatic_button.setEnabled(True)
             for _, control in self.pneumatic_autonomous_controls.items():
                 control.setDisabled(True)
-            self.sensor.open_arduino_serial()
+            self.autonomous_control = False
+            self.routine_scheduler.stop(timeout=0.5)
+
+    def _refresh_routines(self):
+        """Looks for new or changed automation routines and updates the dropdown, keeping the current selection if it's
+        still there. Only re-reads routine files that have changed, so it's cheap"""
+        self.auto_routine_dict = automation_routines.get_automation_routines()
+        dropdown = self.pneumatic_autonomous_controls["dropdown"]
+        current = dropdown.currentText()
+        dropdown.clear()
+        dropdown.addItems(self.auto_routine_dict.keys())
+        if current in self.auto_routine_dict:
+            dropdown.setCurrentText(current)
 
     def _on_start_autonomous(self, routine_select:QComboBox):
         routine_name = routine_select.currentText()
-        logger.info(f"Starting autonomous routine: {routine_name}")
-        
-        # try to get our process status
-        try:
-            status = self.p.status()
-        # we have not yet started - self.p doesn't exist
-        except:
-            pid = os.getpid()
-            arduino = self.sensor.arduino
-            self.multiprocess = multiprocessing.Process(target=self.auto_routine_dict[routine_name].run,
-                                            # kwargs={"logger": logger, "arduino": arduino}
-                                            kwargs={"logger": logger}
-                                            )
-            self.multiprocess.start()
-            self.p = psutil.Process(self.multiprocess.pid)
-        # we have started - self.p does exist
+
+        # If the routine is paused, pick it back up where it left off
+        if self.routine_scheduler.state == automation_routines._scheduler.PAUSED:
+            logger.info(f"Resuming autonomous routine: {self.routine_scheduler.name}")
+            self.routine_scheduler.resume()
+        # Otherwise start it fresh. Routines run in this process and use our ArduinoInterface directly, so starting one
+        # is just importing it (if we haven't yet) and building its generator
+        elif not self.routine_scheduler.is_active():
+            logger.info(f"Starting autonomous routine: {routine_name}")
+            routine = self.auto_routine_dict[routine_name]
+            kwargs = {"logger": logger, "arduino": self.sensor.arduino, "sensor_data": self.data_buffers}
+            # This is where the routine's module actually gets imported (or reloaded, if it's been edited)
+            try:
+                steps = routine.steps(**kwargs)
+            except Exception as e:
+                logger.error(f"Couldn't start {routine_name}: {e}")
+                return
+            self.routine_scheduler.start(routine_name, steps)
         else:
-            if status == "stopped": # we're suspended
-                self.p.resume()
-            elif status == "sleeping" or status == "running": # we're running
-                pass 
-            else: # something has gone Wrong
-                logger.warning(f"Unknown process status: {status}")
+            logger.warning(f"Routine {self.routine_scheduler.name} is still {self.routine_scheduler.state}")
+            return
 
+        routine_select.setDisabled(True)
         self.pneumatic_autonomous_controls["start"].setDisabled(True)
         self.pneumatic_autonomous_controls["pause"].setEnabled(True)
         self.pneumatic_autonomous_controls["stop"].setEnabled(True)
 
     def _on_pause_autonomous(self, routine_select:QComboBox):
-        routine_name = routine_select.currentText()
-        logger.info(f"Pausing autonomous routine: {routine_name}")
-
-        # Try to get our process status
-        try:
-            self.p.status()
-        # If we can't, the process doesn't exist. We're have nothing to pause, so don't do anything
-        except:
-            pass
-        # If we can, pause the process
-        else:
-            self.p.suspend()
+        # The routine finishes whatever step it's on, then waits
+        logger.info(f"Pausing autonomous routine: {self.routine_scheduler.name}")
+        self.routine_scheduler.pause()
 
         self.pneumatic_autonomous_controls["start"].setEnabled(True)
+        self.pneumatic_autonomous_controls["pause"].setDisabled(True)
 
     def _on_stop_autonomous(self, routine_select:QComboBox):
-        routine_name = routine_select.currentText()
-        logger.info(f"Stopping autonomous routine: {routine_name}")
-
-        # If our process is alive, kill it
-        if self.multiprocess.is_alive():
-            self.p.kill()
-            self.multiprocess.terminate()
-            self.multiprocess.join()
-
-        self.pneumatic_autonomous_controls["start"].setEnabled(True)
+        # The routine finishes whatever step it's on, then gets to clean up (e.g close its valves) before it ends. The
+        # buttons get reset in _on_routine_finished once it has
+        logger.info(f"Stopping autonomous routine: {self.routine_scheduler.name}")
+        if not self.routine_scheduler.stop(timeout=0.5):
+            logger.info(f"Waiting on {self.routine_scheduler.name} to finish its current step")
+
+    def _on_routine_finished(self, routine_name:str, outcome:str):
+        """Resets the autonomous controls once a routine ends, however it ended"""
+        if outcome == automation_routines._scheduler.ERROR:
+            logger.error(f"Autonomous routine {routine_name} stopped with an error")
+        # Only turn the controls back on if we're still in autonomous mode
+        self.pneumatic_autonomous_controls["dropdown"].setEnabled(self.autonomous_control)
+        self.pneumatic_autonomous_controls["start"].setEnabled(self.autonomous_control)
         self.pneumatic_autonomous_controls["pause"].setDisabled(True)
         self.pneumatic_autonomous_controls["stop"].setDisabled(True)
             
@@ -1122,13 +1246,16 @@ class ApplicationWindow(QWidget):
         list_widget = QTextEdit(self)
         # list_widget.setMaximumHeight(int(pneum_widget.height()*0.75))
 
+        # The log panel sits behind the shared logging queue like the console and log file do, and shows everything
+        # logged to the GUI logger (which is also what the pipeline classes get as their custom_logger)
         handler = GUIHandler(list_widget, level=logging.DEBUG)
-        self.logger.addHandler(handler)
         formatter = logging.Formatter("%(levelname)s: %(asctime)s - %(name)s:  %(message)s", datefmt="%H:%M:%S")
         handler.setFormatter(formatter)
+        handler.addFilter(logging.Filter(logger.name))
+        app_logging.add_handler(handler)
         self.GUI_log_handler = handler
 
-        self.logger.info("Getting logger {0} - {1}".format(id(logger), logger.handlers))
+        self.logger.info("Getting logger {0} - {1}".format(id(logger), logging.getLogger().handlers))
         self.logger.debug("This is normal text")
         self.logger.warning("Watch out")
         self.logger.error("Something has gone wrong")
@@ -1136,10 +1263,31 @@ class ApplicationWindow(QWidget):
 
         status_panel.addWidget(list_widget, alignment=Qt.AlignTop)
 
+        # Live summary of how long each stage of the pipeline is taking (see config/diagnostics.yaml). It starts
+        # refreshing once start-up is done and there's a pipeline to watch
+        self.metrics_config = pipeline_metrics.load_config("config/diagnostics.yaml")
+        if self.metrics_config.get("enabled", False):
+            status_panel.addWidget(self.default_label("Pipeline Metrics", self.bold12))
+            self.metrics_widget = MetricsWidget(metrics, refresh_s=self.metrics_config.get("widget refresh (s)", 2), parent=self)
+            self.metrics_widget.setMaximumHeight(200)
+            status_panel.addWidget(self.metrics_widget, alignment=Qt.AlignTop)
+        else:
+            self.metrics_widget = None
+
         return status_panel
 
     ## --------------------- DATA STREAMING / LIVE PLOTTING --------------------- ##
 
+    def build_plotting_placeholder(self):
+        """Builds the spot the plots go in, with a placeholder until they're ready (see _finish_startup)"""
+        self.plotting_area = QVBoxLayout()
+        self.plotting_placeholder = QLabel("Loading plots...", self)
+        self.plotting_placeholder.setFont(self.norm16)
+        self.plotting_placeholder.setAlignment(Qt.AlignCenter)
+        self.plotting_placeholder.setMinimumHeight(int(self.height()/2.25))
+        self.plotting_area.addWidget(self.plotting_placeholder)
+        return self.plotting_area
+
     def build_plotting_layout(self):
         """
         A method to build the central plotting panel. Uses a QTabWidget to give us a conveinent way to display 
@@ -1155,9 +1303,6 @@ class ApplicationWindow(QWidget):
         label.setAlignment(Qt.AlignHCenter | Qt.AlignTop)
         plotting_layout.addWidget(label)
 
-        # Initialize the plotting flag
-        self.data_collection = False
-
         # Create some object variables to hold plotting information - the QTabWidget that displays the figs, and a dictionary
         # to hold onto the figure objects themselves for later updating
         self.plot_tab = QTabWidget(self)
@@ -1178,6 +1323,8 @@ class ApplicationWindow(QWidget):
                                  ylabels=list(self.big_data_dict[sensor]["Data"].keys()),
                                  num_subplots=num_subplots,
                                  x_range=self.default_plot_length, # Set xlimit range of each axis
+                                 blit=True, # Only redraw what's changed, so redraw cost doesn't grow with the number of points
+                                 decimate=True, # Only plot as many points as the axis has pixels to show
                                  )
             toolbar = NavigationToolbar(canvas=fig, parent=self, coordinates=False)
             # Create a button to plot the entire day of data in a separate window
@@ -1200,7 +1347,7 @@ class ApplicationWindow(QWidget):
         return plotting_layout
 
     def _thread_plots(self):
-        """Method to update the live plots with the buffers stored in self.big_data_dict
+        """Method to update the live plots with the buffers stored in self.data_buffers
         """
         # Grab the name of the current QTabWidget tab we're on (which sensor data we're displaying)
         plot_name = self.plot_tab.currentWidget().objectName()
@@ -1210,16 +1357,18 @@ class ApplicationWindow(QWidget):
             # Grab the updated x and y values from the big data buffer
             x_data_list, y_data_list = self.get_xy_data_from_buffer(plot_name)
             # Pass the updated data into the figure object and redraw the axes
-            fig.update_data(x_new=x_data_list, y_new=y_data_list)
-            fig.update_canvas()
+            with metrics.timer("plot redraw"):
+                fig.update_data(x_new=x_data_list, y_new=y_data_list)
+                fig.update_canvas()
     
     def update_plots(self):
-        """Method to start a thread that will update the live plots with the buffers stored in self.big_data_dict
+        """Method to update the live plots with the buffers stored in self.data_buffers
         """
         # If the data collection flag is active...
         if self.data_collection:
-            worker = Worker(self._thread_plots)
-            self.threadpool.start(worker)
+            # The live plots blit straight onto the widget, which Qt only allows from the GUI thread - so no worker thread here.
+            # Blitting only redraws the lines, so this is cheap enough not to hold up the GUI
+            self._thread_plots()
 
     def get_xy_data_from_buffer(self, plot_name:str):
         """Method to parse the big data buffer and pull out the sensor channels we're interested in plotting.
@@ -1229,21 +1378,20 @@ class ApplicationWindow(QWidget):
                 main page plots
 
         Returns:
-            x_data_list (list): List of deques from self.big_data_dict - timestamp for each sensor channel
+            x_data_list (list): List of arrays from self.data_buffers - timestamp for each sensor channel
 
-            **y_data_list** (list): List of deques from self.big_data_dict - data for each sensor channel
+            **y_data_list** (list): List of arrays from self.data_buffers - data for each sensor channel
         """
         # Try to extract "plot_name" from the big buffer - if it's a sensor, we'll be able to pull the data directly
         try:
-            # Extract data from the buffer
-            num_subplots = len(self.big_data_dict[plot_name]["Data"].keys())
-            t = self.big_data_dict[plot_name]["Time (epoch)"]
-            y = list(self.big_data_dict[plot_name]["Data"].values())
-            # Convert from UTC epoch time to pacific time, passing in the y_data too to ensure the arrays
-            # stay the same shape
-            t_pacific_time, y_data_list = epoch_to_pacific_time(t, y)
+            # Grab a snapshot of the buffer. It's one small copy, so the plots can hang onto it without it shifting
+            # underneath them as new samples come in. The plots take epoch time as-is (the axes show it in Pacific time)
+            buffer = self.data_buffers[plot_name]
+            window = buffer.window().copy()
+            num_subplots = len(buffer.channels)
             # All sensor channels have the same timestamp, so make n_subplots copies of the time
-            x_data_list = [t_pacific_time]*num_subplots 
+            x_data_list = [window[buffer.time_key]]*num_subplots
+            y_data_list = [window[channel] for channel in buffer.channels]
             
         # If we can't find it in the buffer (and we should never get here since all dict keys are passed in externally), 
         # something went wrong. The plots safely don't update if we pass in None, so do that
@@ -1255,8 +1403,8 @@ class ApplicationWindow(QWidget):
         return x_data_list, y_data_list
 
     def _get_entire_day_data(self, sensor):
-        """Method that reads the big data saving csv, pulls out the channels of the sensor we want,
-        and returns them.
+        """Method that reads the day's data file and pulls out the channels of the sensor we want. If there's a binary
+        copy of the file we memory-map it, so we get views into the file instead of parsing the whole csv.
 
         Args:
             sensor (str): The name of the sensor, must match a key in self.big_data_dict
@@ -1266,44 +1414,47 @@ class ApplicationWindow(QWidget):
         """
         # Grab the filepath of the data csv from the writer object
         filepath = self.writer.get_data_directory()
-        # Grab the data channels we have for this sensor - we'll use these to get data from the csv
-        channels = list(self.big_data_dict[sensor]["Data"].keys())
-        # Add time so we can get that too
-        channels.append("time (epoch)")
-        # The data is saved to the csv in the form "Sensor Name": "Channel Name", so format it here
-        cols = [f"{sensor}: {channel}" for channel in channels]
+        # The data is saved in the form "Sensor Name: Channel Name", so format it here
+        time_column = f"{sensor}: time (epoch)"
+        cols = [f"{sensor}: {channel}" for channel in self.big_data_dict[sensor]["Data"].keys()]
         try:
-            data = pd.read_csv(filepath, delimiter=',', header=0, usecols=cols)
-        except FileNotFoundError as e:
-            logger.warning(f"Error in accessing csv data: {e}")
+            data = self.reader.read_window(filepath, time_column, cols)
+        except (FileNotFoundError, TypeError, KeyError) as e:
+            logger.warning(f"Error in accessing saved data: {e}")
             data = {}
 
         return sensor, data
     
     def _update_entire_day_plot(self, result):
         """Method that triggers when the threaded self._get_entire_day_data finishes, 
-        giving us the dictionary of sensor data pulled from the csv file. 
+        giving us the dictionary of sensor data pulled from the data file. 
 
         Args:
             result (tuple): tuple of (sensor: *str*, data: *dict*)
         """
         # The thread retuns the name of the sensor and the dictionary of data
         sensor, data = result
+        if not data or len(data[f"{sensor}: time (epoch)"]) == 0:
+            logger.warning(f"No saved data for {sensor} today, nothing to plot")
+            return
         # Grab some metadata from the big_data_dict - the channels of data we have for this sensor, and the 
         # number of subplots we need to display them all
         channels = list(self.big_data_dict[sensor]["Data"].keys())
         num_subplots = len(channels)
-        # Pull the time from the data input and convert it from UTC epoch time to Pacific time
-        t = (data[f"{sensor}: time (epoch)"]).values
-        y = [data[f"{sensor}: {channel}"] for channel in channels]
-        t_pacific_time, y_data = epoch_to_pacific_time(t, y)
+        # Pull the time from the data input, dropping rows where this sensor didn't report. The plot takes epoch 
+        # time as-is (the axes show it in Pacific time)
+        t = np.asarray(data[f"{sensor}: time (epoch)"])
+        has_time = ~np.isnan(t)
+        y_data = [np.asarray(data[f"{sensor}: {channel}"])[has_time] for channel in channels]
+        t = t[has_time]
         # Create a figure and toolbar with the data for each sensor channel
-        fig = MyFigureCanvas(x_init=[t_pacific_time]*num_subplots,
+        fig = MyFigureCanvas(x_init=[t]*num_subplots,
                              y_init=y_data,
                              num_subplots=num_subplots,
                              xlabels=["Datetime"]*num_subplots,
                              ylabels=channels,
                              x_range=len(t),
+                             decimate=True, # A full day can be millions of points - only plot what the screen can show
                              )
         toolbar = NavigationToolbar(fig, self)
         # Create another window, add the widgets, and show the window
@@ -1332,28 +1483,46 @@ class ApplicationWindow(QWidget):
         """Creates objects of the Sensor(), Interpreter(), and Display() classes, and sets busses and delay times 
         for each sense/interpret/save process (see run_data_collection for how these are all used)
         """
-        # Create each main object of the pipeline
-        self.sensor = Sensor(custom_logger=logger, debug=False)
-        self.interpreter = Interpreter()
+        # Create each main object of the pipeline. The Sensor's already been made by now, in the background, since probing
+        # the hardware is slow (see _background_startup)
+        self.interpreter = Interpreter(custom_logger=logger, derived_config=self.derived_config)
         self.writer = Writer()
-
-        # Initialize a bus for each thread we plan to spin up later
-        self.abakus_bus = Bus()
-        self.flowmeter_sli2000_bus = Bus()
-        self.flowmeter_sls1500_bus = Bus()
-        self.laser_bus = Bus()
-        self.picarro_gas_bus = Bus()
-        self.bronkhorst_bus = Bus()
+        self.reader = Reader(custom_logger=logger)
+        # Automation routines run in this process, one step at a time, so they can be paused and stopped cleanly
+        self.routine_scheduler = automation_routines.RoutineScheduler(on_finished=self.routine_finished.emit,
+                                                                      custom_logger=logger)
+        self.routine_finished.connect(self._on_routine_finished)
+
+        # Make a bus and a producer for every sensor source in sensor_comms.yaml (see main_pipeline/registry.py), so
+        # adding an instrument there is all it takes to get it read. The interpreter publishes on a bus of its own
+        self.sensor_registry = SensorRegistry(sensor=self.sensor, custom_logger=logger)
+        self.sensor_busses = self.sensor_registry.busses
         self.main_interp_bus = Bus()
 
+        # Set up the acquisition engine. Every sensor source gets a producer thread that runs at its own poll rate from
+        # sensor_comms.yaml, so a slow instrument never holds up a fast one, and the interpret/save step gets a thread
+        # of its own. Nothing runs until data collection starts (see run_data_collection)
+        self.acquisition = AcquisitionEngine(custom_logger=logger)
+        self.sensor_registry.add_producers(self.acquisition)
+        self.acquisition.set_pipeline(self._thread_data_collection, rate_hz=1)
+
+        # Turn on the pipeline metrics (and the periodic dump to file) if the config asks for them, and keep an eye on
+        # whether the interpreter's keeping up with the high-rate sources
+        metrics.configure(self.metrics_config)
+        self.sensor_registry.add_gauges(self.interpreter)
+
     def init_data_buffer(self):
         """Method to read in and save the sensor_data configuration yaml file
 
         Updates:
-            **self.big_data_dict**: *dict* - Holds buffer of data with key-value pairs 'Sensor Name':deque[data buffer]
+            **self.big_data_dict**: *dict* - The sensor data configuration, with key-value pairs 'Sensor Name':{"Time (epoch)":[], "Data":{channels}}
+
+            **self.data_buffers**: *dict* - Holds the live data buffers with key-value pairs 'Sensor Name':SensorBuffer
 
             **self.sensor_names**: *list* - Sensor names that correspond to the buffer dict keys
 
+            **self.derived_config**: *dict* - The derived channel config, handed on to the Interpreter
+
         """
         # Read in the sensor data config file to initialize the data buffer. 
         # Creates a properly formatted, empty dictionary to store timestamps and data readings to each sensor
@@ -1364,95 +1533,89 @@ class ApplicationWindow(QWidget):
             logger.error(f"Error in loading the sensor data config file: {e}")
             self.big_data_dict = {}
 
-        # Comb through the keys, set the timestamp to the current time and the data to zero
+        # The interpreter adds the derived channels (rolling means, slopes, integrals...) to each sensor's data, so give
+        # them a column in the buffers, plots, and data file like any other channel
+        self.derived_config = load_derived_config("config/derived_channels.yaml")
+        for name, derived_channels in derived_channel_names(self.derived_config).items():
+            try:
+                for channel in derived_channels:
+                    self.big_data_dict[name]["Data"].setdefault(channel, [])
+            except (KeyError, TypeError, AttributeError):
+                logger.warning(f"Derived channels for {name}, which isn't in sensor_data.yaml - they won't show up")
+
+        # Comb through the keys and make a fixed-size buffer for each sensor, with a time column and a column for each channel
         sensor_names = self.big_data_dict.keys()
         self.instrument_names = list(sensor_names)
         self.sensor_names = list(sensor_names)
+        self.data_buffers = {}
         for name in sensor_names:
             try:
                 channels = self.big_data_dict[name]["Data"].keys()
-                self.big_data_dict[name]["Time (epoch)"] = deque([np.nan], maxlen=self.max_buffer_length)
-                for channel in channels:
-                    self.big_data_dict[name]["Data"][channel] = deque([np.nan], maxlen=self.max_buffer_length)
-            except KeyError as e:
+                self.data_buffers[name] = SensorBuffer(channels, max_length=self.max_buffer_length)
+            except (KeyError, AttributeError) as e:
                 print(f"Trouble reading {name} sensor data: {e}")
                 self.sensor_names.remove(name)
 
         # Grab the names of the sensors from the dictionary
 
     def _thread_data_collection(self):
-        """Method to spin up threads for each sensor, plus the interpreter and the writer. 
-        Allows us to take, process, and save data (mostly) simultaneously
+        """Method that runs the interpreter and the writer once. This is the pipeline step of the acquisition engine, so it 
+        gets called on the engine's pipeline thread while the sensor producers keep filling up their busses on threads of their own
 
         Returns:
             data (dict): Big dictionary of processed sensor data, has the same structure as self.big_data_dict
         """
-        # Create a ThreadPoolExecutor to accomplish a bunch of tasks at once. These threads pass data between themselves with busses (which handle
-        # proper locking, so we're not trying to read and write at the same time) and return a big dictionary of the most recent processed sensor data
-        try:
-            with concurrent.futures.ThreadPoolExecutor() as self.executor:
-                self.executor.submit(self.sensor.abakus_producer, self.abakus_bus)
-                self.executor.submit(self.sensor.flowmeter_sli2000_producer, self.flowmeter_sli2000_bus)
-                self.executor.submit(self.sensor.flowmeter_sls1500_producer, self.flowmeter_sls1500_bus)
-                self.executor.submit(self.sensor.laser_producer, self.laser_bus)
-                self.executor.submit(self.sensor.picarro_gas_producer, self.picarro_gas_bus)
-                self.executor.submit(self.sensor.bronkhorst_producer, self.bronkhorst_bus)
-                self.executor.submit(self.interpreter.main_consumer_producer, self.abakus_bus, self.flowmeter_sli2000_bus,
-                                            self.flowmeter_sls1500_bus, self.laser_bus, self.picarro_gas_bus, self.bronkhorst_bus, 
-                                            self.main_interp_bus)
-
-                eWriter = self.executor.submit(self.writer.write_consumer, self.main_interp_bus)
-        except RuntimeError as e:
-            logger.warning(f"Encountered Error in data threading: {e}")
-
-        # Get the processed data from the final class (also blocks until everything has completed its task)
-        data = eWriter.result()
+        # The busses handle proper locking, so we can read whatever the producers have published most recently
+        with metrics.timer("interpret"):
+            self.interpreter.main_consumer_producer(self.sensor_busses, self.main_interp_bus)
+        # Save the processed data and hand it back to the engine, which queues it up for run_data_collection
+        with metrics.timer("write"):
+            data = self.writer.write_consumer(self.main_interp_bus)
         return data
     
     def _update_buffer(self, new_data:dict):
-        """Method to update the self.big_data_dict buffer with new data from the sensor pipeline.
+        """Method to update the self.data_buffers with new data from the sensor pipeline.
         
         Args:
             new_data (dict): Most recent data update. Should have the same key/value structure as big_data_dict
-            use_noise (bool): Adds some random noise if true. For testing only
         """
-        # For each sensor, grab the timestamp and the data from each sensor channel
+        # For each sensor, grab the timestamp and the data from each sensor channel and add them to its buffer
         for name in self.sensor_names:
-            # Grab and append the timestamp
             try:    # Check if the dictionary key exists... 
-                new_time = new_data[name]["Time (epoch)"]  
-                self.big_data_dict[name]["Time (epoch)"].append(new_time)
+                new_time = new_data[name]["Time (epoch)"]
+                ch_data = new_data[name]["Data"]
             except KeyError as e:   # ... otherwise log an exception
-                logger.warning(f"Error updating the {name} buffer timestamp: {e}")
+                logger.warning(f"Error updating the {name} buffer: {e}")
+                continue
             except TypeError as e:  # Sometimes due to threading shenanigans it comes through as "NoneType", check for that too
-                logger.warning(f"Error updating the {name} buffer timestamp: {e}")
-                pass
+                logger.warning(f"Error updating the {name} buffer: {e}")
+                continue
             
-            # Grab and append the data from each channel
-            channels = list(self.big_data_dict[name]["Data"].keys())
-            for channel in channels:
-                try:    # Check if the dictionary key exists... 
-                    ch_data = new_data[name]["Data"][channel]
-                    self.big_data_dict[name]["Data"][channel].append(ch_data)
-                except KeyError:    # ... otherwise log an exception
-                    logger.warning(f"Error updating the {name} buffer data: {e}")
-                    pass
-                except TypeError as e: 
-                    logger.warning(f"Error updating the {name} buffer data: {e}")
-                    pass
+            # The interpreter hands over a whole batch of samples per sensor, so add them all in one go. Any channels missing
+            # from the update get saved as np.nan so every column stays the same length
+            try:
+                self.data_buffers[name].extend(new_time, ch_data)
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Error updating the {name} buffer data: {e}")
     
     def run_data_collection(self):
-        """Method to complete the entire sense/interpret/save data pipeline once. This is called by a timer way back in __init__, so gets triggered every time that
-        timer fires. It spins up a bunch of threads to gather data from each sensor, pass raw data into the interpretor class, and save the processed data
+        """Method to keep the acquisition engine in step with the data collection flag and pull its results into our internal data buffer. 
+        This is called by a timer way back in __init__, so gets triggered every time that timer fires. The engine does the actual sensing,
+        interpreting, and saving on its own threads, so nothing here blocks on a sensor read
         """
-        # If data collection is active...
+        # If data collection is active, make sure the engine is running...
         if self.data_collection:
-            # Set up a thread to go query all the instruments once and process their results
-            worker = Worker(self._thread_data_collection)
-            # Once that's finished, trigger the method to save the results to our internal data buffer
-            worker.signals.result.connect(self._update_buffer)
-            # Spin up the thread
-            self.threadpool.start(worker)
+            if not self.acquisition.is_running():
+                self.acquisition.start()
+        # ...and if it isn't, make sure it's stopped. Don't wait for the threads here - a producer stuck on a serial read
+        # would freeze the window (closeEvent is the one place that waits for them)
+        elif self.acquisition.is_running():
+            self.acquisition.stop(timeout=0)
+
+        # Save whatever the engine has produced since the last tick to our internal data buffer
+        with metrics.timer("GUI buffer update"):
+            for data in self.acquisition.get_results():
+                self._update_buffer(data)
 
 ###################################### HELPER CLASSES ######################################
 
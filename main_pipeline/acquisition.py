@@ -0,0 +1,289 @@
+# -------------
+# The acquisition engine
+#
+# Instead of spinning up a fresh ThreadPoolExecutor every time a timer fires, this keeps one long-lived thread per
+# sensor (plus one for the interpret/save pipeline) running for as long as data collection is active. Each thread
+# runs at its own rate on a fixed schedule - deadlines are computed from the start time, not from "whenever the last
+# call finished", so the timing doesn't drift. If a call runs long (like a serial read hanging until its timeout),
+# we skip the ticks we missed and count them as overruns instead of firing a burst of catch-up calls.
+#
+# The pipeline thread hands its results to the GUI through a bounded queue. If the GUI falls behind, the oldest
+# results get dropped (and counted) so memory can't grow without bound.
+#
+# Every call each worker makes is timed into the pipeline metrics (see metrics.py) under the worker's name, along with
+# how late it started and its overruns/errors, so "Arduino producer" is how long a sensor read takes.
+# -------------
+
+import time
+import queue
+import threading
+
+try:
+    from main_pipeline.bus import Bus
+    from main_pipeline.metrics import metrics
+except ImportError:
+    from bus import Bus
+    from metrics import metrics
+
+import logging
+from logdecorator import log_on_start , log_on_end , log_on_error
+
+from app_logging import get_logger
+logger = get_logger(__name__)
+
+class PeriodicWorker():
+    """Class that calls a function over and over at a fixed rate on its own persistent thread"""
+    def __init__(self, name:str, function, args:tuple=(), rate_hz:float=1.0, custom_logger:logging.Logger=None,
+                 on_stop=None) -> None:
+        """
+        Args:
+            name (str): Name of the worker, used for the thread name and logging
+            function (method): Whatever we want to call every tick
+            args (tuple, optional): Arguments to pass to the function. Defaults to ().
+            rate_hz (float, optional): How many times per second to call the function. Defaults to 1.0.
+            custom_logger (logging.Logger, optional): Logger to use instead of the module logger. Defaults to None.
+            on_stop (method, optional): Called with no arguments on the worker's own thread once it's been stopped, after
+                its last call - e.g to tell a sensor to stop streaming. Defaults to None.
+        """
+        if rate_hz <= 0:
+            raise ValueError(f"Worker rate must be positive, got {rate_hz} Hz for {name}")
+
+        self.name = name
+        self.function = function
+        self.args = args
+        self.on_stop = on_stop
+        self.period = 1.0 / rate_hz
+
+        if custom_logger is not None:
+            self.logger = custom_logger
+        else:
+            self.logger = logger
+
+        # Counters so we can see how well the worker is keeping up
+        self.ticks = 0      # Number of times we've called the function
+        self.overruns = 0   # Number of ticks we skipped because a call ran past its deadline
+        self.errors = 0     # Number of calls that raised an exception
+
+        self._stop_event = threading.Event()
+        self._thread = None
+        # The lock keeps start() and the thread deciding to exit from crossing over. _running stays True from start()
+        # until the thread actually decides to quit, and _generation goes up with every start(), so a thread that gets
+        # restarted before it noticed it was stopped knows to start its schedule over
+        self._lock = threading.Lock()
+        self._running = False
+        self._generation = 0
+
+    def start(self):
+        """Starts the worker thread. If it's still finishing its last call after a stop(), it just carries on instead
+        of a second thread getting started next to it"""
+        with self._lock:
+            self._stop_event.clear()
+            self._generation += 1
+            if self._running:
+                return
+            self._running = True
+            # Daemon thread, so a serial read that's hung forever can't keep the app from closing
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Asks the worker to stop after its current call finishes"""
+        self._stop_event.set()
+
+    def join(self, timeout:float=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def is_running(self):
+        """Whether the worker's been started and not asked to stop (it might still be finishing a call after a stop)"""
+        return self._running and not self._stop_event.is_set()
+
+    def _run(self):
+        """Main worker loop. Runs the function, then sleeps until the next deadline on the schedule"""
+        generation = None
+        lateness_stage = f"{self.name} start lateness"
+        while True:
+            with self._lock:
+                stopping = self._stop_event.is_set()
+                if not stopping and generation != self._generation:
+                    # First time around, or we got restarted - start the schedule from now
+                    generation = self._generation
+                    next_deadline = time.monotonic()
+            if stopping:
+                # Clean up on this thread, so it can't cross over with a call to the function
+                if self.on_stop is not None:
+                    try:
+                        self.on_stop()
+                    except Exception as e:
+                        self.logger.warning(f"Error stopping {self.name} worker: {e}")
+                with self._lock:
+                    if self._stop_event.is_set():
+                        self._running = False
+                        return
+                # Got restarted while we were stopping - keep going
+                continue
+            start = time.monotonic()
+            try:
+                self.function(*self.args)
+            except Exception as e:
+                self.errors += 1
+                metrics.incr(f"{self.name} errors")
+                self.logger.warning(f"Error in {self.name} worker: {e}")
+            self.ticks += 1
+            if metrics.enabled:
+                metrics.record(self.name, time.monotonic() - start)
+                metrics.record(lateness_stage, max(start - next_deadline, 0.0))
+
+            # Deadlines are always a whole number of periods after the start, so timing errors don't add up
+            next_deadline += self.period
+            now = time.monotonic()
+            # If we blew through one or more deadlines, skip them rather than firing a burst of catch-up calls
+            if now > next_deadline:
+                missed = int((now - next_deadline) // self.period) + 1
+                self.overruns += missed
+                metrics.incr(f"{self.name} overruns", missed)
+                next_deadline += missed * self.period
+            # Waiting on the event (instead of time.sleep) means stop() takes effect right away
+            self._stop_event.wait(next_deadline - now)
+
+
+class AcquisitionEngine():
+    """Class that runs the sense > interpret > save pipeline continuously, with one persistent thread per sensor"""
+    @log_on_end(logging.INFO, "Acquisition engine initiated", logger=logger)
+    def __init__(self, max_queue_length:int=100, custom_logger:logging.Logger=None) -> None:
+        """
+        Args:
+            max_queue_length (int, optional): How many pipeline results we hold onto before dropping the oldest. Defaults to 100.
+            custom_logger (logging.Logger, optional): Logger to use instead of the module logger. Defaults to None.
+        """
+        if custom_logger is not None:
+            self.logger = custom_logger
+        else:
+            self.logger = logger
+
+        self.producers = {}     # "sensor name": PeriodicWorker
+        self.pipeline = None    # PeriodicWorker for the interpret/save step
+        self.results = queue.Queue(maxsize=max_queue_length)
+        self.dropped_results = 0
+        metrics.add_gauge("pipeline results waiting", self.results.qsize)
+
+    def add_producer(self, name:str, producer, bus:Bus, rate_hz:float=1.0, on_stop=None):
+        """Registers a sensor producer. It gets its own thread that calls producer(bus) rate_hz times a second.
+
+        Args:
+            name (str): Sensor name
+            producer (method): Producer method that reads the sensor and writes the result to the bus
+            bus (Bus): Bus the producer writes to
+            rate_hz (float, optional): Sampling rate. Defaults to 1.0.
+            on_stop (method, optional): Called on the producer's thread whenever the engine stops, e.g to stop a
+                sensor streaming while collection is paused. Defaults to None.
+        """
+        if name in self.producers and self.producers[name].is_alive():
+            self.logger.warning(f"Producer {name} is already running, stop the engine before replacing it")
+            return
+        self.producers[name] = PeriodicWorker(f"{name} producer", producer, (bus,), rate_hz, self.logger, on_stop=on_stop)
+
+    def set_pipeline(self, pipeline, rate_hz:float=1.0):
+        """Registers the interpret/save step. Whatever it returns (unless None) is queued up for get_results().
+
+        Args:
+            pipeline (method): Method that reads the sensor busses, processes and saves the data, and returns it
+            rate_hz (float, optional): How often to run the pipeline step. Defaults to 1.0.
+        """
+        self.pipeline = PeriodicWorker("pipeline", self._run_pipeline, (pipeline,), rate_hz, self.logger)
+
+    def _run_pipeline(self, pipeline):
+        """Calls the pipeline step and queues its result, dropping the oldest result if the queue is full"""
+        result = pipeline()
+        if result is None:
+            return
+        while True:
+            try:
+                self.results.put_nowait(result)
+                return
+            except queue.Full:
+                # Nobody's keeping up with us - make room by throwing out the oldest result
+                try:
+                    self.results.get_nowait()
+                    self.dropped_results += 1
+                    metrics.incr("dropped pipeline results")
+                except queue.Empty:
+                    pass
+
+    @log_on_start(logging.INFO, "Starting acquisition engine", logger=logger)
+    def start(self):
+        """Starts all the producer threads and the pipeline thread"""
+        for worker in self.producers.values():
+            worker.start()
+        if self.pipeline is not None:
+            self.pipeline.start()
+
+    @log_on_start(logging.INFO, "Stopping acquisition engine", logger=logger)
+    def stop(self, timeout:float=2.0):
+        """Stops all the threads, waiting up to timeout seconds in all (not each) for them to finish their current calls.
+        With timeout=0 it just asks them to stop and returns straight away - handy on the GUI thread, where a producer
+        stuck on a serial read shouldn't freeze the window. The threads are daemons, and start() picks up any that are
+        still finishing, so nothing needs them to be gone"""
+        workers = list(self.producers.values())
+        if self.pipeline is not None:
+            workers.append(self.pipeline)
+        for worker in workers:
+            worker.stop()
+        if timeout <= 0:
+            return
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+        for worker in workers:
+            if worker.is_alive():
+                self.logger.warning(f"{worker.name} worker didn't stop within {timeout} s, leaving it to finish on its own")
+
+    def is_running(self):
+        """Whether the engine's been started and not stopped (some threads might still be finishing up after a stop)"""
+        workers = list(self.producers.values())
+        if self.pipeline is not None:
+            workers.append(self.pipeline)
+        return any(worker.is_running() for worker in workers)
+
+    def get_results(self):
+        """Grabs everything the pipeline has produced since we last asked, without blocking
+
+        Returns:
+            results (list): Pipeline results, oldest first
+        """
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def get_stats(self):
+        """Returns a dictionary of worker counters, handy for figuring out who's falling behind
+
+        Returns:
+            stats (dict): {"worker name": {"ticks":int, "overruns":int, "errors":int}, ..., "dropped results":int}
+        """
+        stats = {}
+        workers = list(self.producers.values())
+        if self.pipeline is not None:
+            workers.append(self.pipeline)
+        for worker in workers:
+            stats.update({worker.name: {"ticks": worker.ticks, "overruns": worker.overruns, "errors": worker.errors}})
+        stats.update({"dropped results": self.dropped_results})
+        return stats
+
+
+if __name__ == "__main__":
+    bus = Bus()
+    engine = AcquisitionEngine()
+    engine.add_producer("Dummy sensor", lambda b: b.write(time.time()), bus, rate_hz=10)
+    engine.set_pipeline(bus.read, rate_hz=2)
+    engine.start()
+    time.sleep(2)
+    engine.stop()
+    print(engine.get_results())
+    print(engine.get_stats())
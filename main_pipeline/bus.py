@@ -4,21 +4,141 @@
 # Not much going on here, just a small class with two methods. This can read and write a message (with
 # locking, so we don't get errors if two calls try to read/write at the same time) so is really handy
 # for passing information around between classes and methods.
+#
+# There's also a RingBus for high-rate sensor channels, which keeps every sample (up to a fixed capacity)
+# instead of just the latest one, so consumers don't lose anything they didn't read in time.
+#
+# With pipeline metrics on (see metrics.py), a Bus times how long each message sits there before someone first reads it
+# ("bus transit"), and a RingBus records how old each sample is when it gets drained ("ring bus sample age") and counts
+# the samples consumers missed.
 # -------------
 
+import time
+import numpy as np
 from readerwriterlock import rwlock
 
+try:
+    from main_pipeline.metrics import metrics
+except ImportError:
+    from metrics import metrics
+
 class Bus():
     """Class that sets up a bus to pass information around with read/write locking"""
     def __init__(self):
         self.message = None
         self.lock = rwlock.RWLockWriteD() # sets up a lock to prevent simultanous reading and writing
+        self.written_at = None  # When the current message was written, until someone reads it (metrics only)
 
     def write(self, message):
         with self.lock.gen_wlock():
             self.message = message
+            if metrics.enabled:
+                self.written_at = time.perf_counter()
 
     def read(self):
         with self.lock.gen_rlock():
             message = self.message
-        return message
\ No newline at end of file
+            written_at, self.written_at = self.written_at, None
+        if written_at is not None:
+            metrics.record("bus transit", time.perf_counter() - written_at)
+        return message
+
+
+class RingBus():
+    """Class that sets up a fixed-size ring of timestamped samples that one producer writes to and any number of consumers
+    can drain, without locking. Unlike Bus, which only holds the latest message, every sample stays available until the
+    ring wraps around and overwrites it.
+
+    Each sample gets a sequence number (0, 1, 2, ...). Consumers hang onto a cursor (the sequence number of the next sample
+    they want) and call drain() to get everything written since then. If a consumer is so slow that the producer has lapped
+    it, drain() tells it how many samples it missed instead of blocking the producer. Each consumer keeps its own count of
+    those - drain() never changes the ring, so only the producer ever writes to it.
+    """
+    def __init__(self, capacity:int=1024, num_channels:int=1):
+        """
+        Args:
+            capacity (int, optional): How many samples the ring holds before overwriting the oldest. Defaults to 1024.
+            num_channels (int, optional): How many values each sample has (not counting the timestamp). Defaults to 1.
+        """
+        self.capacity = capacity
+        self.num_channels = num_channels
+        # Preallocate everything up front so writing a sample never allocates
+        self.times = np.full(capacity, np.nan)
+        self.values = np.full((capacity, num_channels), np.nan)
+        # Sequence number of the next sample to be written (also the total number of samples written so far). Only
+        # the producer ever changes this, and it only does so after the sample is fully in the ring
+        self.head = 0
+
+    def write(self, message):
+        """Adds one sample to the ring. Only ever call this from one thread (the producer).
+
+        Args:
+            message (tuple): (timestamp, values) - values can be a single number or one number per channel
+        """
+        timestamp, values = message
+        i = self.head % self.capacity
+        self.times[i] = timestamp
+        self.values[i] = values
+        # Publish the sample only once it's been written
+        self.head += 1
+
+    def read(self):
+        """Grabs the most recent sample, to stand in for Bus.read() 
+
+        Returns:
+            message (tuple): (timestamp, values array), or None if nothing has been written yet
+        """
+        while True:
+            head = self.head
+            if head == 0:
+                return None
+            i = (head - 1) % self.capacity
+            message = (self.times[i], self.values[i].copy())
+            # If the producer lapped us while we were copying, the sample we grabbed might be torn - just get the newer one
+            if self.head - self.capacity < head - 1:
+                return message
+
+    def new_cursor(self):
+        """Returns a cursor pointing at the next sample to be written, for consumers that only care about new data"""
+        return self.head
+
+    def drain(self, cursor:int=0):
+        """Grabs every sample written since the cursor, without blocking the producer.
+
+        Args:
+            cursor (int, optional): Sequence number of the first sample we want. Defaults to 0 (everything still in the ring).
+
+        Returns:
+            times (np.ndarray): Timestamps, shape (n,)
+
+            **values** (np.ndarray): Channel values, shape (n, num_channels)
+
+            **sequence** (np.ndarray): Sequence number of each sample, shape (n,)
+
+            **cursor** (int): Cursor to pass in next time
+
+            **missed** (int): How many samples since the old cursor were overwritten before we got to them
+        """
+        head = self.head
+        # Anything older than one lap behind the head has already been overwritten
+        start = max(cursor, head - self.capacity)
+        sequence = np.arange(start, head)
+        idx = sequence % self.capacity
+        # Fancy indexing hands us copies, so the producer can keep writing while we work with them
+        times = self.times[idx]
+        values = self.values[idx]
+
+        # The producer might have started overwriting the oldest samples while we were copying them. It can be writing
+        # at most one sample past the head it's published, so anything older than that minus a lap is suspect
+        oldest_safe = self.head - self.capacity + 1
+        torn = min(oldest_safe, head) - start
+        if torn > 0:
+            times, values, sequence = times[torn:], values[torn:], sequence[torn:]
+            start += torn
+
+        missed = start - cursor if cursor < start else 0
+        if metrics.enabled and len(times):
+            metrics.record_many("ring bus sample age", time.time() - times)
+            metrics.incr("ring bus missed samples", missed)
+
+        return times, values, sequence, head, missed
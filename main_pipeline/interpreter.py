@@ -1,38 +1,453 @@
 # -------------
 # The interpreter class
+#
+# Takes the raw readings off each sensor's bus and turns them into the channels in sensor_data.yaml - volts into Torr,
+# and so on - using the calibrations in config/calibrations.yaml. Each channel's calibration gets compiled once, when
+# the Interpreter is made, into a function that works on a whole NumPy array at a time. Every pipeline tick we grab
+# everything that's come in since the last one (all of it, for RingBusses), and calibrate each channel in one go, so
+# it doesn't cost much more to interpret 1000 samples than 1.
+#
+# After calibrating, the Interpreter works out any derived channels from config/derived_channels.yaml - rolling means,
+# rolling slopes (e.g leak rates while a flask is sealed), integrated flow, and so on - and adds them to each sensor's
+# data like any other channel, so they get plotted and saved without anybody recomputing them from the whole buffer.
+# Rolling statistics keep running sums in a ring of recent samples (see WindowedStats), so each new sample costs the
+# same no matter how long the window is.
 # -------------
 
 import numpy as np
-import time
 import yaml
-import copy
 
 try:
-    from main_pipeline.bus import Bus
+    from main_pipeline.bus import Bus, RingBus
+    from main_pipeline.metrics import metrics
 except ImportError:
-    from bus import Bus
+    from bus import Bus, RingBus
+    from metrics import metrics
 
 import logging
 from logdecorator import log_on_start , log_on_end , log_on_error
 
-# Set up a logger for this module
-logger = logging.getLogger(__name__)
-# Set the lowest-severity log message the logger will handle (debug = lowest, critical = highest)
-logger.setLevel(logging.DEBUG)
-# Create a handler that saves logs to the log folder named as the current date
-# fh = logging.FileHandler(f"logs\\{time.strftime('%Y-%m-%d', time.localtime())}.log")
-fh = logging.StreamHandler()
-fh.setLevel(logging.DEBUG)
-logger.addHandler(fh)
-# Create a formatter to specify our log format
-formatter = logging.Formatter("%(levelname)s: %(asctime)s - %(name)s:  %(message)s", datefmt="%H:%M:%S")
-fh.setFormatter(formatter)
+from app_logging import get_logger
+logger = get_logger(__name__)
+
+def compile_calibration(spec, where:str="calibration"):
+    """Turns a calibration from calibrations.yaml into a function that calibrates a whole array of raw values at once
+
+    Args:
+        spec (dict or list): One calibration ({"type": ..., ...}), a list of them to apply in order, or None for no
+            calibration
+        where (str, optional): Where the calibration came from, for error messages. Defaults to "calibration".
+
+    Returns:
+        calibrate (method): Function that takes an array of raw values and returns an array of calibrated ones
+    """
+    if spec is None:
+        return lambda x: x
+    if isinstance(spec, list):
+        steps = [compile_calibration(step, f"{where} step {i+1}") for i, step in enumerate(spec)]
+        def calibrate(x):
+            for step in steps:
+                x = step(x)
+            return x
+        return calibrate
+    if not isinstance(spec, dict) or "type" not in spec:
+        raise ValueError(f"{where}: expected something like {{type: linear, scale: 1, offset: 0}}, got {spec!r}")
+
+    kind = spec["type"]
+    if kind == "linear":
+        scale = float(spec.get("scale", 1.0))
+        offset = float(spec.get("offset", 0.0))
+        return lambda x: x*scale + offset
+    if kind == "polynomial":
+        coefficients = np.asarray(spec.get("coefficients", []), dtype=float)
+        if coefficients.ndim != 1 or len(coefficients) == 0:
+            raise ValueError(f"{where}: polynomial needs a list of coefficients, lowest power first")
+        return lambda x: np.polynomial.polynomial.polyval(x, coefficients)
+    if kind == "table":
+        xp = np.asarray(spec.get("x", []), dtype=float)
+        fp = np.asarray(spec.get("y", []), dtype=float)
+        if xp.ndim != 1 or len(xp) < 2 or xp.shape != fp.shape:
+            raise ValueError(f"{where}: table needs x and y lists of the same length (at least 2 points)")
+        if np.any(np.diff(xp) <= 0):
+            raise ValueError(f"{where}: table x values have to go up")
+        out_of_range = spec.get("out of range", "clamp")
+        if out_of_range == "clamp":
+            return lambda x: np.interp(x, xp, fp)
+        if out_of_range == "nan":
+            return lambda x: np.interp(x, xp, fp, left=np.nan, right=np.nan)
+        raise ValueError(f"{where}: 'out of range' should be clamp or nan")
+    raise ValueError(f"{where}: unknown calibration type {kind!r}")
+
+
+class WindowedStats():
+    """Rolling statistics (count, mean, standard deviation, least-squares slope) over the last window_s seconds of a
+    channel, updated a batch of samples at a time.
+
+    Instead of the samples themselves, we store running totals of 1, t, x, t^2, t*x, and x^2 after each sample. The totals
+    over any stretch of samples are then just the difference between two rows, so the stats for each new sample come
+    from a binary search (to find where its window starts) and one subtraction - no matter how many samples are in the
+    window. Rows older than the window get thrown out every so often (compacting the arrays), which is also when the
+    totals and the time origin get reset, so the totals never get big enough to lose precision. NaN samples are left
+    out of the stats.
+    """
+    # Columns of the running totals
+    N, T, X, TT, TX, XX = range(6)
+
+    def __init__(self, window_s:float, capacity:int=1024) -> None:
+        """
+        Args:
+            window_s (float): Length of the window, in seconds
+            capacity (int, optional): Rows to allocate up front. Grows (doubling) if the window needs more. Defaults to 1024.
+        """
+        if window_s <= 0:
+            raise ValueError(f"Window has to be longer than 0 s, got {window_s}")
+        self.window_s = float(window_s)
+        self.t0 = None                          # Epoch time that self.t is measured from
+        self.t = np.full(capacity, -np.inf)     # Sample times, relative to t0
+        self.totals = np.zeros((capacity, 6))   # Running totals after each sample
+        # Rows begin...end-1 are the samples in the window of the newest sample. Row begin-1 is the totals from before
+        # the first of them (row 0 starts out as all zeros)
+        self.begin = 1
+        self.end = 1
+
+    def __len__(self):
+        return self.end - self.begin
+
+    def _make_room(self, m:int):
+        """Makes sure there's room for m more rows, compacting (and growing, if need be) the arrays"""
+        if self.end + m <= len(self.t):
+            return
+        needed = self.end - self.begin + 1 + m
+        size = len(self.t)
+        while needed > size // 2:
+            size *= 2
+        keep = slice(self.begin - 1, self.end)
+        t = self.t[keep]
+        totals = self.totals[keep] - self.totals[self.begin - 1]
+        # Move the time origin up to the start of the window, adjusting the totals that depend on it to match
+        shift = t[1] if len(t) > 1 else 0.0
+        n, st, sx = totals[:, self.N].copy(), totals[:, self.T].copy(), totals[:, self.X]
+        totals[:, self.T] = st - shift*n
+        totals[:, self.TT] += -2*shift*st + shift**2*n
+        totals[:, self.TX] -= shift*sx
+        self.t0 += shift
+        if size != len(self.t):
+            self.t = np.full(size, -np.inf)
+            self.totals = np.zeros((size, 6))
+        self.t[:len(t)] = t - shift
+        self.totals[:len(t)] = totals
+        self.begin, self.end = 1, len(t)
+
+    def update(self, times, values):
+        """Adds a batch of samples and works out the stats for each of them, over the window ending at that sample
+
+        Args:
+            times (array_like): Epoch times, in order
+            values (array_like): Channel values
+
+        Returns:
+            stats (dict): {"count", "mean", "std", "slope"} - arrays, one value per sample. slope is in units per second
+        """
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        m = len(times)
+        if m == 0:
+            return {key: np.empty(0) for key in ("count", "mean", "std", "slope")}
+        if self.t0 is None:
+            self.t0 = times[0]
+        self._make_room(m)
+
+        t = times - self.t0
+        valid = np.isfinite(t) & np.isfinite(values)
+        tv = np.where(valid, t, 0.0)
+        xv = np.where(valid, values, 0.0)
+        increments = np.stack([valid.astype(float), tv, xv, tv*tv, tv*xv, xv*xv], axis=1)
+        new = slice(self.end, self.end + m)
+        self.t[new] = t
+        self.totals[new] = self.totals[self.end - 1] + np.cumsum(increments, axis=0)
+
+        # First row inside each new sample's window, then the totals over the window are one subtraction
+        starts = self.begin + np.searchsorted(self.t[self.begin:self.end + m], t - self.window_s, side="left")
+        sums = self.totals[new] - self.totals[starts - 1]
+        self.end += m
+        # Forget the rows that have fallen out of the newest sample's window
+        self.begin += int(np.searchsorted(self.t[self.begin:self.end], t[-1] - self.window_s, side="left"))
+
+        n, st, sx, stt, stx, sxx = sums.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = sx/n
+            variance = np.maximum(sxx/n - mean**2, 0.0)
+            spread = n*stt - st**2
+            slope = np.where(spread > 0, (n*stx - st*sx)/spread, np.nan)
+        return {"count": n, "mean": mean, "std": np.sqrt(variance), "slope": slope}
+
+
+class RunningIntegral():
+    """Running time integral of a channel (trapezoid rule), e.g flow rate > total volume. NaN samples are skipped"""
+    def __init__(self) -> None:
+        self.total = 0.0
+        self.last = None    # (time, value) of the last good sample
+
+    def update(self, times, values):
+        """
+        Returns:
+            totals (np.ndarray): The integral up to each sample, in value-seconds
+        """
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        valid = np.isfinite(times) & np.isfinite(values)
+        if not valid.any():
+            return np.full(len(times), self.total)
+        t, x = times[valid], values[valid]
+        # Pick up from the last sample of the previous batch (the very first sample just starts the integral at 0)
+        previous = self.last if self.last is not None else (t[0], x[0])
+        t = np.concatenate([[previous[0]], t])
+        x = np.concatenate([[previous[1]], x])
+        running = self.total + np.cumsum(0.5*(x[1:] + x[:-1])*np.diff(t))
+        # Each sample gets the total up to the last good sample at or before it
+        latest = np.cumsum(valid) - 1
+        totals = np.where(latest >= 0, running[np.maximum(latest, 0)], self.total)
+        self.total = running[-1]
+        self.last = (t[-1], x[-1])
+        return totals
+
+
+# Kinds of derived channel, and which WindowedStats result each one uses
+ROLLING = {"rolling mean": "mean", "rolling std": "std", "rolling slope": "slope"}
+INTEGRAL = "integral"
+
+def load_derived_config(filepath:str="config/derived_channels.yaml"):
+    """Reads the derived channel config
+
+    Returns:
+        config (dict): {"sensor name": {"channel name": {...}}}, or {} if the file isn't there
+    """
+    try:
+        with open(filepath, "r") as stream:
+            return yaml.safe_load(stream) or {}
+    except FileNotFoundError as e:
+        logger.warning(f"Couldn't load the derived channel config, there won't be any: {e}")
+        return {}
+
+def derived_channel_names(config:dict):
+    """Returns {"sensor name": [derived channel names]} for a derived channel config, so the buffers and the data file
+    can make room for them"""
+    return {sensor: list(channels or {}) for sensor, channels in config.items()}
+
+
+class DerivedChannels():
+    """Class that works out the derived channels (rolling stats, integrals) for each batch of interpreted data"""
+    def __init__(self, config:dict, custom_logger:logging.Logger=None) -> None:
+        """
+        Args:
+            config (dict): The derived channel config, see load_derived_config
+            custom_logger (logging.Logger, optional): Logger to use instead of the module logger. Defaults to None.
+        """
+        self.logger = custom_logger if custom_logger is not None else logger
+        self.config = config
+        self.reset()
+
+    def reset(self):
+        """(Re)builds every derived channel from the config, starting their rolling windows and integrals over"""
+        self.channels = {}  # "sensor": [(name, input channel, kind, state, scale)]
+        # Rolling channels on the same input with the same window share one WindowedStats
+        self._stats = {}    # (sensor, input channel, window): WindowedStats
+        for sensor, channels in self.config.items():
+            compiled = []
+            for name, spec in (channels or {}).items():
+                try:
+                    compiled.append(self._compile(sensor, name, spec or {}))
+                except (KeyError, TypeError, ValueError) as e:
+                    self.logger.error(f"Couldn't set up derived channel {sensor}: {name}, leaving it out: {e}")
+            self.channels[sensor] = compiled
+
+    def _compile(self, sensor:str, name:str, spec:dict):
+        kind = spec["type"]
+        scale = float(spec.get("scale", 1.0))
+        if kind in ROLLING:
+            window = float(spec["window (s)"])
+            key = (sensor, spec["input"], window)
+            if key not in self._stats:
+                self._stats[key] = WindowedStats(window)
+            state = self._stats[key]
+        elif kind == INTEGRAL:
+            state = RunningIntegral()
+        else:
+            raise ValueError(f"unknown type {kind!r}, should be one of {list(ROLLING) + [INTEGRAL]}")
+        return (name, spec["input"], kind, state, scale)
+
+    def update(self, data:dict):
+        """Adds the derived channels to a batch of interpreted data, in place
+
+        Args:
+            data (dict): Interpreted data, see Interpreter.interpret
+        """
+        for sensor, channels in self.channels.items():
+            if sensor not in data:
+                continue
+            times = data[sensor]["Time (epoch)"]
+            values = data[sensor]["Data"]
+            # Shared WindowedStats only get updated once per batch
+            results = {}
+            for name, source, kind, state, scale in channels:
+                if source not in values:
+                    values[name] = np.full(len(times), np.nan)
+                    continue
+                if kind == INTEGRAL:
+                    values[name] = state.update(times, values[source])*scale
+                    continue
+                if id(state) not in results:
+                    results[id(state)] = state.update(times, values[source])
+                values[name] = results[id(state)][ROLLING[kind]]*scale
+
 
 class Interpreter():
     """Class that reads data from each sensor bus, does some processing, and republishes on an Interpreter bus."""
     @log_on_end(logging.INFO, "Interpreter class initiated", logger=logger)
-    def __init__(self) -> None:
-        pass
+    def __init__(self, custom_logger:logging.Logger=None, filepath:str="config/calibrations.yaml",
+                 derived_config:dict=None) -> None:
+        """
+        Args:
+            custom_logger (logging.Logger, optional): Logger to use instead of the module logger. Defaults to None.
+            filepath (str, optional): Calibration config. Defaults to "config/calibrations.yaml".
+            derived_config (dict, optional): Derived channel config. Defaults to None (load config/derived_channels.yaml).
+        """
+        if custom_logger is not None:
+            self.logger = custom_logger
+        else:
+            self.logger = logger
+
+        try:
+            with open(filepath, "r") as stream:
+                config = yaml.safe_load(stream) or {}
+        except FileNotFoundError as e:
+            self.logger.error(f"Error in loading the calibration config file: {e}. Nothing will get interpreted")
+            config = {}
+        self.sensors = self.compile_config(config)
+        if derived_config is None:
+            derived_config = load_derived_config()
+        self.derived = DerivedChannels(derived_config, custom_logger=self.logger)
+
+        self._cursors = {}          # "source": RingBus cursor
+        self.missed = {}            # "source": RingBus samples we lost because the producer lapped us (running total)
+        self._last_timestamps = {}  # "source": timestamp of the last reading we took off a plain Bus
+        self._missing_sources = set()   # Sources we've already warned don't have a bus
+
+    def compile_config(self, config:dict):
+        """Compiles every sensor's channel calibrations. A sensor with a bad calibration gets logged and left out,
+        rather than taking the others down with it
+
+        Returns:
+            sensors (dict): "sensor name": {"source": str, "channels": [(channel, input index, calibrate function)]}
+        """
+        sensors = {}
+        for sensor, sensor_config in config.items():
+            try:
+                # Which sensor_comms.yaml source it comes off - whether that source exists only gets checked once we
+                # see the busses (see main_consumer_producer), since those come from the sensor registry
+                source = str(sensor_config["source"])
+                channels = []
+                for channel, channel_config in (sensor_config.get("channels") or {}).items():
+                    channel_config = channel_config or {}
+                    index = int(channel_config.get("input", 0))
+                    calibrate = compile_calibration(channel_config.get("calibration"), f"{sensor}: {channel}")
+                    channels.append((channel, index, calibrate))
+                sensors[sensor] = {"source": source, "channels": channels}
+            except (KeyError, TypeError, ValueError) as e:
+                self.logger.error(f"Couldn't set up the {sensor} calibration, it won't be interpreted: {e}")
+        return sensors
+
+    def read_source(self, source:str, bus):
+        """Grabs every raw reading that's come in on a bus since last time
+
+        Args:
+            source (str): Name of the source, as in sensor_comms.yaml
+            bus (Bus or RingBus): The source's bus
+
+        Returns:
+            times (np.ndarray): Timestamps, shape (n,)
+
+            **values** (np.ndarray): Raw values, shape (n, number of values per reading)
+        """
+        if isinstance(bus, RingBus):
+            times, values, _, self._cursors[source], missed = bus.drain(self._cursors.get(source, 0))
+            if missed:
+                self.missed[source] = self.missed.get(source, 0) + missed
+                self.logger.warning(f"Interpreter fell behind and lost {missed} {source} samples")
+            return times, values
+
+        # A plain Bus only has the latest reading - only take it if it's new
+        message = bus.read()
+        if message is None:
+            return np.empty(0), np.empty((0, 0))
+        timestamp, values = message
+        if self._last_timestamps.get(source) == timestamp:
+            return np.empty(0), np.empty((0, 0))
+        self._last_timestamps[source] = timestamp
+        return np.atleast_1d(np.asarray(timestamp, dtype=float)), np.atleast_2d(np.asarray(values, dtype=float))
+
+    def interpret(self, raw:dict):
+        """Calibrates a batch of raw readings from each source
+
+        Args:
+            raw (dict): "source": (times, values), as returned by read_source
+
+        Returns:
+            data (dict): Interpreted data, same structure as big_data_dict but with an array per channel - {"sensor name":
+                {"Time (epoch)": times, "Data": {"channel": values}}}
+        """
+        data = {}
+        for sensor, setup in self.sensors.items():
+            times, values = raw.get(setup["source"], (np.empty(0), np.empty((0, 0))))
+            channels = {}
+            for channel, index, calibrate in setup["channels"]:
+                if len(times) == 0:
+                    channels[channel] = np.empty(0)
+                elif index < values.shape[1]:
+                    channels[channel] = calibrate(values[:, index])
+                else:
+                    self.logger.warning(f"{sensor}: {channel} wants input {index}, but {setup['source']} only sends "
+                                        f"{values.shape[1]} values")
+                    channels[channel] = np.full(len(times), np.nan)
+            data[sensor] = {"Time (epoch)": times, "Data": channels}
+        return data
+
+    def main_consumer_producer(self, busses:dict, main_interp_bus:Bus):
+        """Consumer-producer method that takes everything new off the sensor busses, calibrates it, adds the derived
+        channels, and publishes the result on the interpreter bus. Publishes every time, even if nothing came in (the arrays are just empty), so
+        the writer never sees the same batch twice
+
+        Args:
+            busses (dict): "source": Bus or RingBus, one for each source in sensor_comms.yaml (see SensorRegistry.busses)
+            main_interp_bus (Bus): Bus to publish the interpreted data on
+
+        Returns:
+            data (dict): The interpreted data, see interpret()
+        """
+        # Only read the sources somebody's actually using
+        raw = {}
+        for source in {setup["source"] for setup in self.sensors.values()}:
+            if source not in busses:
+                if source not in self._missing_sources:
+                    self._missing_sources.add(source)
+                    self.logger.warning(f"No {source} source in sensor_comms.yaml, so the sensors calibrated from it "
+                                        f"won't get any data")
+                continue
+            try:
+                raw[source] = self.read_source(source, busses[source])
+            except (TypeError, ValueError) as e:
+                self.logger.warning(f"Couldn't read the {source} bus: {e}")
+        metrics.incr("interpreted samples", sum(len(times) for times, _ in raw.values()))
+        data = self.interpret(raw)
+        self.derived.update(data)
+        main_interp_bus.write(data)
+        return data
 
 if __name__ == "__main__":
-    interp = Interpreter()
\ No newline at end of file
+    import time
+    interp = Interpreter()
+    arduino_bus = RingBus(capacity=1024, num_channels=1)
+    interp_bus = Bus()
+    for i in range(5):
+        arduino_bus.write((time.time(), 0.5 + i))
+    print(interp.main_consumer_producer({"Arduino": arduino_bus}, interp_bus))
@@ -0,0 +1,338 @@
+# -------------
+# Pipeline metrics
+#
+# A lightweight way to see where the time goes in the sense > interpret > write > plot pipeline. Anything in the
+# pipeline can:
+#   - time a stage:         with metrics.timer("interpret"): ...     (or metrics.record("interpret", seconds))
+#   - count something:      metrics.incr("Arduino producer overruns")
+#   - report a level:       metrics.add_gauge("writer rows waiting", lambda: len(writer._rows))
+#
+# Stage timings go into histograms with fixed, log-spaced buckets (8 per decade, 1 us to 1000 s), so recording a value
+# is a lookup and an increment no matter how many we've recorded, and memory never grows. Gauges are functions that only
+# get called when someone asks for a snapshot, so they cost nothing on the hot path.
+#
+# Everything hangs off one shared Metrics object (metrics, below), set up from config/diagnostics.yaml. When it's
+# disabled, timer() hands back a do-nothing context manager and record()/incr() return straight away, so the
+# instrumentation can stay in place for good.
+# -------------
+
+import os
+import json
+import time
+import bisect
+import threading
+import numpy as np
+import yaml
+
+import logging
+from logdecorator import log_on_start , log_on_end , log_on_error
+from app_logging import get_logger
+logger = get_logger(__name__)
+
+# Upper edges of the histogram buckets, in seconds: 1 us to 1000 s, 8 buckets per decade. Anything bigger goes in one
+# last overflow bucket
+BUCKET_EDGES = tuple(float(edge) for edge in np.logspace(-6, 3, 9*8 + 1))
+
+class Histogram():
+    """Latency histogram with fixed log-spaced buckets"""
+    def __init__(self) -> None:
+        self.counts = [0]*(len(BUCKET_EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds:float):
+        i = bisect.bisect_left(BUCKET_EDGES, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def record_many(self, seconds):
+        """Records a whole array of values in one go"""
+        seconds = np.asarray(seconds, dtype=float)
+        seconds = seconds[np.isfinite(seconds)]
+        if len(seconds) == 0:
+            return
+        counts = np.bincount(np.searchsorted(BUCKET_EDGES, seconds, side="left"), minlength=len(self.counts))
+        with self._lock:
+            self.counts = [a + int(b) for a, b in zip(self.counts, counts)]
+            self.count += len(seconds)
+            self.total += float(seconds.sum())
+            self.max = max(self.max, float(seconds.max()))
+
+    def copy_counts(self):
+        with self._lock:
+            return list(self.counts), self.count, self.total
+
+    @staticmethod
+    def summarize(counts:list, count:int, total:float, max_value:float=None):
+        """Turns bucket counts into summary stats. Percentiles are the upper edge of the bucket they land in, so
+        they're accurate to within a bucket (about 33%)
+
+        Returns:
+            stats (dict): {"count", "mean", "p50", "p95", "p99", "max"}, times in seconds
+        """
+        stats = {"count": count, "mean": total/count if count else None}
+        cumulative = np.cumsum(counts)
+        for name, quantile in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            if not count:
+                stats[name] = None
+                continue
+            i = int(np.searchsorted(cumulative, quantile*count, side="left"))
+            stats[name] = BUCKET_EDGES[i] if i < len(BUCKET_EDGES) else float("inf")
+        if max_value is None:
+            # Only have the buckets to go on - use the top edge of the highest one with anything in it
+            nonzero = np.flatnonzero(counts)
+            max_value = (BUCKET_EDGES[nonzero[-1]] if nonzero[-1] < len(BUCKET_EDGES) else float("inf")) if len(nonzero) else None
+        stats["max"] = max_value
+        if max_value is not None:
+            # A percentile can't be bigger than the biggest value we actually saw
+            for name in ("p50", "p95", "p99"):
+                if stats[name] is not None:
+                    stats[name] = min(stats[name], max_value)
+        return stats
+
+    def stats(self):
+        counts, count, total = self.copy_counts()
+        return self.summarize(counts, count, total, self.max if count else None)
+
+
+class _Timer():
+    """Context manager that records how long its block took"""
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage:str) -> None:
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer():
+    """Stand-in for _Timer when metrics are off - does nothing at all"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+
+class Metrics():
+    """Class that collects stage timings, counters, and gauges from all over the pipeline"""
+    def __init__(self, enabled:bool=False) -> None:
+        self.enabled = enabled
+        self.started = time.time()
+        self._histograms = {}   # "stage": Histogram
+        self._counters = {}     # "counter": int
+        self._gauges = {}       # "gauge": function that returns the current value
+        self._lock = threading.Lock()
+        self._dumper = None
+
+    def configure(self, config:dict):
+        """Sets metrics up from the "Metrics" section of diagnostics.yaml. Starts (or stops) the periodic dump to file
+
+        Args:
+            config (dict): {"enabled": bool, "dump interval (s)": float, "dump file": str}
+        """
+        self.enabled = bool(config.get("enabled", False))
+        self.stop_dumping()
+        dump_file = config.get("dump file")
+        interval = config.get("dump interval (s)", 0) or 0
+        if self.enabled and dump_file and interval > 0:
+            self.start_dumping(dump_file, interval)
+
+    def timer(self, stage:str):
+        """Returns a context manager that records how long its block takes under stage"""
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, stage)
+
+    def timed(self, stage:str):
+        """Decorator version of timer()"""
+        def decorator(function):
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+            wrapper.__name__ = function.__name__
+            wrapper.__doc__ = function.__doc__
+            return wrapper
+        return decorator
+
+    def _histogram(self, stage:str):
+        try:
+            return self._histograms[stage]
+        except KeyError:
+            with self._lock:
+                return self._histograms.setdefault(stage, Histogram())
+
+    def record(self, stage:str, seconds:float):
+        """Records one timing (in seconds) for a stage"""
+        if not self.enabled:
+            return
+        self._histogram(stage).record(seconds)
+
+    def record_many(self, stage:str, seconds):
+        """Records an array of timings (in seconds) for a stage at once"""
+        if not self.enabled:
+            return
+        self._histogram(stage).record_many(seconds)
+
+    def incr(self, counter:str, n:int=1):
+        """Adds n to a counter"""
+        if not self.enabled or not n:
+            return
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+
+    def add_gauge(self, name:str, function):
+        """Registers a function that reports some level (like how many rows are waiting to be written). It only gets
+        called when we take a snapshot"""
+        with self._lock:
+            self._gauges[name] = function
+
+    def remove_gauge(self, name:str):
+        with self._lock:
+            self._gauges.pop(name, None)
+
+    def snapshot(self):
+        """Grabs the current state of everything
+
+        Returns:
+            snapshot (dict): {"time": epoch, "uptime (s)": float, "stages": {stage: stats}, "counters": {...},
+                "gauges": {...}}. Stage stats are in seconds, see Histogram.summarize
+        """
+        with self._lock:
+            histograms = dict(self._histograms)
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        gauge_values = {}
+        for name, function in gauges.items():
+            try:
+                gauge_values[name] = function()
+            except Exception as e:
+                gauge_values[name] = None
+                logger.debug(f"Couldn't read gauge {name}: {e}")
+        now = time.time()
+        return {"time": now,
+                "uptime (s)": now - self.started,
+                "stages": {stage: histogram.stats() for stage, histogram in sorted(histograms.items())},
+                "counters": dict(sorted(counters.items())),
+                "gauges": gauge_values}
+
+    def reset(self):
+        """Forgets all the timings and counters (gauges stay registered)"""
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+        self.started = time.time()
+
+    def start_dumping(self, filepath:str, interval:float):
+        """Starts appending a line of JSON to filepath every interval seconds, with the stats for just that interval"""
+        self.stop_dumping()
+        self._dumper = MetricsDumper(self, filepath, interval)
+        self._dumper.start()
+
+    def stop_dumping(self):
+        if self._dumper is not None:
+            self._dumper.stop()
+            self._dumper = None
+
+
+class MetricsDumper():
+    """Class that periodically appends metrics to a file on its own thread, one JSON object per line. Each line has the
+    stage stats for that interval only (so a slow spell stands out instead of getting averaged away), plus counter
+    totals, how much each counter went up by, and the gauges"""
+    def __init__(self, metrics:Metrics, filepath:str, interval:float=60) -> None:
+        self.metrics = metrics
+        self.filepath = filepath
+        self.interval = interval
+        self._previous_counts = {}
+        self._previous_counters = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @log_on_end(logging.INFO, "Dumping pipeline metrics to {self.filepath} every {self.interval} s", logger=logger)
+    def start(self):
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics dumper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the thread, writing out one last interval on the way"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(2)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.dump()
+        self.dump()
+
+    def interval_snapshot(self):
+        """Stats since the last call, see MetricsDumper"""
+        with self.metrics._lock:
+            histograms = dict(self.metrics._histograms)
+            counters = dict(self.metrics._counters)
+        stages = {}
+        for stage, histogram in sorted(histograms.items()):
+            counts, count, total = histogram.copy_counts()
+            previous_counts, previous_count, previous_total = self._previous_counts.get(stage, ([0]*len(counts), 0, 0.0))
+            self._previous_counts[stage] = (counts, count, total)
+            if count == previous_count:
+                continue
+            counts = [a - b for a, b in zip(counts, previous_counts)]
+            stages[stage] = Histogram.summarize(counts, count - previous_count, total - previous_total)
+        increases = {name: value - self._previous_counters.get(name, 0) for name, value in counters.items()
+                     if value != self._previous_counters.get(name, 0)}
+        self._previous_counters = counters
+        snapshot = self.metrics.snapshot()
+        snapshot.update({"interval (s)": self.interval, "stages": stages, "counter increases": increases})
+        return snapshot
+
+    def dump(self):
+        try:
+            line = json.dumps(self.interval_snapshot(), default=float)
+            with open(self.filepath, "a") as f:
+                f.write(line + "\n")
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Couldn't dump metrics to {self.filepath}: {e}")
+
+
+def load_config(filepath:str="config/diagnostics.yaml"):
+    """Reads the "Metrics" section of the diagnostics config
+
+    Returns:
+        config (dict): The section, or {} (metrics off) if the file or section isn't there
+    """
+    try:
+        with open(filepath, "r") as stream:
+            return (yaml.safe_load(stream) or {}).get("Metrics", {}) or {}
+    except FileNotFoundError as e:
+        logger.warning(f"Couldn't load the diagnostics config, metrics are off: {e}")
+        return {}
+
+# The one Metrics object everything shares. Off until someone configures it (the GUI does, from diagnostics.yaml)
+metrics = Metrics()
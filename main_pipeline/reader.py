@@ -0,0 +1,356 @@
+# -------------
+# The reader class
+#
+# Pulls historical data back off the disk for plotting. If there's a binary copy of the day's data (see storage.py),
+# we memory-map it: the operating system only loads the parts of the file we actually touch, and what we hand back
+# are views into the file rather than copies. Since the timestamps only go up, we can binary search for the start and
+# end of a time window, so opening a whole day's file and grabbing a window takes milliseconds and barely any RAM.
+#
+# If there's no binary copy, we fall back to the columnar (Parquet) copy, then to the csv. The csv only ever grows during
+# the day, so we don't re-read it from the top every time someone asks for it. We keep the rows we've already parsed in
+# memory and only parse whatever got added since, and keep a small index next to the csv (dataFull.csv.idx) recording
+# the byte offset and time range of every block of rows. With the index, asking for a time window means jumping
+# straight to the block it starts in instead of parsing everything before it.
+# -------------
+
+import io
+import csv
+import json
+import time
+import yaml
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+try:
+    from main_pipeline import storage
+    from main_pipeline.storage import BinaryBackend
+except ImportError:
+    import storage
+    from storage import BinaryBackend
+
+import logging
+from logdecorator import log_on_start , log_on_end , log_on_error
+
+from app_logging import get_logger
+logger = get_logger(__name__)
+
+def bisect_time(times, t, side="left"):
+    """Binary search for t in a column of timestamps that only go up, but might have NaN gaps (rows where that sensor
+    didn't report). Only touches a handful of values, so it's fast even on a memory-mapped column.
+
+    Args:
+        times (array_like): Timestamp column, increasing apart from NaNs
+        t (float): Time to search for
+        side (str, optional): "left" gives the first index with times >= t, "right" the first with times > t. Defaults to "left".
+
+    Returns:
+        idx (int): Index where t would go
+    """
+    lo, hi = 0, len(times)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        # If we landed on a gap, walk forward to the next real timestamp
+        probe = mid
+        while probe < hi and np.isnan(times[probe]):
+            probe += 1
+        if probe == hi:
+            # Nothing but gaps between mid and hi, so the answer is at or before mid
+            hi = mid
+            continue
+        value = times[probe]
+        if value < t or (side == "right" and value == t):
+            lo = probe + 1
+        else:
+            hi = mid
+    return lo
+
+class CSVIndex():
+    """Sidecar index for a data csv: where each block of rows starts in the file, and the range of timestamps in it.
+    Saved as JSON next to the csv, so it survives restarting the GUI"""
+    def __init__(self, filepath:str, every:int=1000) -> None:
+        """
+        Args:
+            filepath (str): Path of the data csv
+            every (int, optional): How many rows go in each block. Defaults to 1000.
+        """
+        self.filepath = filepath
+        self.path = str(filepath) + ".idx"
+        self.every = every
+        self.reset()
+
+    def reset(self):
+        """Forgets everything, back to an index of an empty file"""
+        self.header = None
+        self.header_bytes = 0   # Where the first row starts
+        self.size = 0           # How far into the file we've indexed - always the end of a complete line
+        self.rows = 0           # How many rows we've indexed
+        self.blocks = []        # [first row, byte offset, earliest time, latest time] for each block of rows
+
+    def load(self):
+        """Loads the saved index, if there is one and it still matches the csv. Otherwise we start from scratch
+
+        Returns:
+            loaded (bool): Whether we loaded a saved index
+        """
+        self.reset()
+        try:
+            with open(self.path, 'r') as idxfile:
+                saved = json.load(idxfile)
+            header, header_bytes = self.read_header(self.filepath)
+            # If the csv got replaced, shrank, or we changed the block size, the saved index is no use to us
+            if (saved["header"] != header or saved["header bytes"] != header_bytes or saved["every"] != self.every
+                    or saved["size"] > Path(self.filepath).stat().st_size):
+                return False
+            self.header = header
+            self.header_bytes = header_bytes
+            self.size = saved["size"]
+            self.rows = saved["rows"]
+            self.blocks = saved["blocks"]
+            return True
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+            return False
+
+    def save(self):
+        """Writes the index next to the csv. Goes through a temporary file so a crash can't leave half an index"""
+        saved = {"header": self.header, "header bytes": self.header_bytes, "every": self.every,
+                 "size": self.size, "rows": self.rows, "blocks": self.blocks}
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as idxfile:
+                json.dump(saved, idxfile)
+            Path(tmp_path).replace(self.path)
+        except OSError as e:
+            logger.warning(f"Couldn't save the csv index {self.path}: {e}")
+
+    @staticmethod
+    def read_header(filepath:str):
+        """Reads the column names from the first line of a data csv
+
+        Returns:
+            header (list): Column names
+
+            **header_bytes** (int): Length of the header line in bytes, i.e where the first row starts
+        """
+        with open(filepath, 'rb') as csvfile:
+            line = csvfile.readline()
+        if not line.endswith(b"\n"):
+            raise ValueError(f"{filepath} doesn't have a complete header yet")
+        header = next(csv.reader([line.decode("utf-8")]))
+        return header, len(line)
+
+    def add_rows(self, line_starts:np.ndarray, row_t_min:np.ndarray, row_t_max:np.ndarray, end:int):
+        """Adds newly parsed rows to the index
+
+        Args:
+            line_starts (np.ndarray): Byte offset of the start of each new row
+            row_t_min (np.ndarray): Earliest timestamp in each new row (np.nan if it has none)
+            row_t_max (np.ndarray): Latest timestamp in each new row
+            end (int): Byte offset of the end of the last new row
+        """
+        if len(line_starts) == 0:
+            return
+        # Split the new rows up by which block they land in, and get the time range of each piece in one go
+        rows = self.rows + np.arange(len(line_starts))
+        _, firsts = np.unique(rows // self.every, return_index=True)
+        with np.errstate(all="ignore"):
+            t_mins = np.fmin.reduceat(row_t_min, firsts)
+            t_maxs = np.fmax.reduceat(row_t_max, firsts)
+        for first, t_min, t_max in zip(firsts, t_mins, t_maxs):
+            t_min = None if np.isnan(t_min) else float(t_min)
+            t_max = None if np.isnan(t_max) else float(t_max)
+            if rows[first] % self.every == 0:
+                # Start of a new block
+                self.blocks.append([int(rows[first]), int(line_starts[first]), t_min, t_max])
+            elif t_min is not None:
+                # More rows for the block we were partway through
+                block = self.blocks[-1]
+                block[2] = t_min if block[2] is None else min(block[2], t_min)
+                block[3] = t_max if block[3] is None else max(block[3], t_max)
+        self.rows += len(line_starts)
+        self.size = end
+
+    def find(self, t_start:float):
+        """Finds the first block that might have data at or after t_start
+
+        Returns:
+            row (int): First row of the block
+
+            **offset** (int): Byte offset of the start of the block
+        """
+        for row, offset, _, t_max in self.blocks:
+            if t_max is not None and t_max >= t_start:
+                return row, offset
+        return self.rows, self.size
+
+
+class Reader():
+    """Class that reads time windows of saved data back off the disk"""
+    @log_on_end(logging.INFO, "Reader class initiated", logger=logger)
+    def __init__(self, custom_logger:logging.Logger=None) -> None:
+        if custom_logger is not None:
+            self.logger = custom_logger
+        else:
+            self.logger = logger
+
+        # Read in the data saving config file to see how big we want the csv index blocks
+        try:
+            with open("config/data_saving.yaml", 'r') as stream:
+                reader_config = yaml.safe_load(stream)["Reader"]
+        except (FileNotFoundError, KeyError, TypeError) as e:
+            self.logger.error(f"Error in loading the data saving config file: {e}. Using default reader settings")
+            reader_config = {}
+        self.index_every = int(reader_config.get("index every (rows)", 1000))
+
+        # Memory-mapped binary files we've opened, so we don't re-map them every time: {path: (file size, records)}
+        self._maps = {}
+        # csv indexes and the rows we've already parsed: {path: CSVIndex} and {path: {"start": byte offset, "frame": pd.DataFrame}}
+        self._indexes = {}
+        self._csv_cache = {}
+
+    def _map_binary(self, filepath:str):
+        """Memory-maps a binary data file as an array of records, one field per column. Re-maps it if the file has
+        grown since last time (the Writer is still appending to it)
+
+        Args:
+            filepath (str): Path of the main data csv
+
+        Returns:
+            records (np.memmap): Structured array view of the file
+        """
+        path = BinaryBackend.path_for(filepath)
+        size = Path(path).stat().st_size
+        try:
+            cached_size, records = self._maps[path]
+            if cached_size == size:
+                return records
+        except KeyError:
+            pass
+        columns, offset = BinaryBackend.read_header(path)
+        dtype = np.dtype([(column, "<f8") for column in columns])
+        # Ignore any partial record at the end - the Writer might be halfway through appending it
+        num_records = (size - offset) // dtype.itemsize
+        records = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(num_records,))
+        self._maps[path] = (size, records)
+        return records
+
+    def read_window(self, filepath:str, time_column:str, columns:list, t_start:float=None, t_end:float=None):
+        """Reads a time window of some columns out of a data file.
+
+        Args:
+            filepath (str): Path of the main data csv - the binary and Parquet copies sit next to it
+            time_column (str): Name of the timestamp column to slice on, e.g "Pressure sensor: time (epoch)"
+            columns (list): Names of the columns we want (the time column comes back too)
+            t_start (float, optional): Epoch time of the start of the window. Defaults to None (start of the file).
+            t_end (float, optional): Epoch time of the end of the window. Defaults to None (end of the file).
+
+        Returns:
+            data (dict): Dictionary of "column name": np.ndarray. From the binary copy these are views into the
+                memory-mapped file, not copies
+        """
+        columns = list(dict.fromkeys([time_column] + list(columns)))
+        if BinaryBackend.available(filepath):
+            try:
+                records = self._map_binary(filepath)
+                times = records[time_column]
+                lo = 0 if t_start is None else bisect_time(times, t_start, side="left")
+                hi = len(times) if t_end is None else bisect_time(times, t_end, side="right")
+                window = records[lo:hi]
+                return {column: window[column] for column in columns}
+            except (ValueError, KeyError, OSError) as e:
+                self.logger.warning(f"Couldn't read the binary copy of {filepath} ({e}), trying the other copies")
+
+        # No binary copy - read the columns from Parquet or the csv, then slice out the window
+        if storage.ParquetBackend.available(filepath):
+            frame = storage.ParquetBackend.read_columns(filepath, columns)
+        else:
+            frame = self._read_csv(filepath, t_start)
+        data = {column: frame[column].to_numpy(dtype=float) for column in columns}
+        times = data[time_column]
+        lo = 0 if t_start is None else bisect_time(times, t_start, side="left")
+        hi = len(times) if t_end is None else bisect_time(times, t_end, side="right")
+        return {column: values[lo:hi] for column, values in data.items()}
+
+    def _parse_csv_rows(self, filepath:str, header:list, start:int, end:int):
+        """Parses the rows between two byte offsets of a data csv
+
+        Args:
+            filepath (str): Path of the data csv
+            header (list): Column names
+            start (int): Byte offset of the start of the first row
+            end (int): Byte offset to stop at. Only complete lines before this get parsed
+
+        Returns:
+            frame (pd.DataFrame): The parsed rows
+
+            **line_starts** (np.ndarray): Byte offset of the start of each row
+
+            **end** (int): Byte offset of the end of the last complete row
+        """
+        with open(filepath, 'rb') as csvfile:
+            csvfile.seek(start)
+            chunk = csvfile.read(end - start)
+        # The Writer might be partway through a line - leave that for next time
+        newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+        if len(newlines) == 0:
+            return pd.DataFrame(columns=header, dtype=float), np.array([], dtype=np.int64), start
+        chunk = chunk[:newlines[-1] + 1]
+        line_starts = start + np.concatenate(([0], newlines[:-1] + 1))
+        frame = pd.read_csv(io.BytesIO(chunk), header=None, names=header, skip_blank_lines=False)
+        return frame, line_starts, start + len(chunk)
+
+    def _read_csv(self, filepath:str, t_start:float=None):
+        """Reads a data csv, parsing only the rows we haven't already got in memory. If we're only interested in data
+        after t_start, the index lets us skip straight to the block it's in.
+
+        Args:
+            filepath (str): Path of the data csv
+            t_start (float, optional): Epoch time of the earliest data we want. Defaults to None (everything).
+
+        Returns:
+            frame (pd.DataFrame): Every column of the csv, starting at (or a little before) t_start
+        """
+        path = str(filepath)
+        size = Path(path).stat().st_size
+        header, header_bytes = CSVIndex.read_header(path)
+
+        # Grab the index for this file, loading the saved one if we haven't got it in memory yet. If the file has been
+        # replaced since we last looked, everything we had is out of date
+        index = self._indexes.get(path)
+        if index is None or index.size > size or index.header != header:
+            index = CSVIndex(path, every=self.index_every)
+            self._indexes[path] = index
+            self._csv_cache.pop(path, None)
+            if not index.load():
+                index.header, index.header_bytes = header, header_bytes
+                index.size = header_bytes
+
+        # Figure out where we need to start parsing from
+        if t_start is None:
+            row, start = 0, index.header_bytes
+        else:
+            row, start = index.find(t_start)
+
+        # If we haven't got the rows from there in memory, parse them. The index already covers them, so we don't have
+        # to touch it
+        cache = self._csv_cache.get(path)
+        if cache is None or cache["start"] > start:
+            frame, _, _ = self._parse_csv_rows(path, index.header, start, index.size)
+            cache = {"start": start, "row": row, "frame": frame}
+            self._csv_cache[path] = cache
+
+        # Now parse whatever's been added since we last looked, tack it onto what we've got, and index it
+        if size > index.size:
+            tail, line_starts, end = self._parse_csv_rows(path, index.header, index.size, size)
+            if len(tail) > 0:
+                time_columns = [column for column in index.header if column.endswith("time (epoch)")]
+                times = tail[time_columns].to_numpy(dtype=float) if time_columns else np.full((len(tail), 1), np.nan)
+                index.add_rows(line_starts, np.fmin.reduce(times, axis=1), np.fmax.reduce(times, axis=1), end)
+                index.save()
+                cache["frame"] = pd.concat([cache["frame"], tail], ignore_index=True) if len(cache["frame"]) else tail
+
+        # The cache might go back further than we need, so skip the rows before where we started
+        return cache["frame"].iloc[row - cache["row"]:]
+
+if __name__ == "__main__":
+    myreader = Reader()
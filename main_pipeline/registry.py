@@ -0,0 +1,210 @@
+# -------------
+# The sensor registry
+#
+# Builds a producer and a bus for every sensor source listed in config/sensor_comms.yaml, so adding an instrument is a
+# config change instead of another hand-written bus, producer, and add_producer() call in the GUI. A source is any
+# entry in sensor_comms.yaml with a "type" (the Arduino's type defaults to "arduino", since it's always been there):
+#
+#   Flowmeter SLI2000:
+#     type: simulated
+#     poll rate (Hz): 5
+#
+# Each type is a plugin - a function, registered with @register_source_type("name"), that makes the producer and the
+# bus for a source (use make_bus, so every reading waits on a RingBus until the interpreter drains it, however much
+# faster than the pipeline the source is polled). Every source then gets its own thread in the acquisition engine at
+# its own poll rate, so a slow instrument never holds a fast one back. The Interpreter finds each source's bus by name
+# (the "source" of each sensor in calibrations.yaml).
+# -------------
+
+import time
+import yaml
+import numpy as np
+
+try:
+    from main_pipeline.bus import Bus, RingBus
+    from main_pipeline.metrics import metrics
+except ImportError:
+    from bus import Bus, RingBus
+    from metrics import metrics
+
+import logging
+from logdecorator import log_on_start , log_on_end , log_on_error
+
+from app_logging import get_logger
+logger = get_logger(__name__)
+
+# "type": function that makes a source's producer and bus, see register_source_type
+SOURCE_TYPES = {}
+
+# Types for the sources that were around before sources had to say what type they are
+DEFAULT_TYPES = {"Arduino": "arduino"}
+
+def register_source_type(name:str):
+    """Decorator that registers a source type. The function it decorates gets called once for each source of that type:
+
+        @register_source_type("my instrument")
+        def make_my_instrument(source_name, config, sensor, custom_logger):
+            ...
+            return producer, bus
+
+    where config is the source's section of sensor_comms.yaml, sensor is the Sensor object (for sources whose interface
+    it already holds, like the Arduino), and producer(bus) reads the instrument once and writes the result to the bus.
+    It can also return (producer, bus, on_stop), where on_stop() gets called on the producer's thread whenever data
+    collection stops - for instruments that need telling, like one that streams.
+    Get the bus from make_bus, so the source's "bus" and "bus capacity" settings work the same for every type.
+    """
+    def decorator(function):
+        SOURCE_TYPES[name] = function
+        return function
+    return decorator
+
+
+def make_bus(config:dict, num_channels:int):
+    """Makes the bus for a source. Sources are polled at their own rate but interpreted once a pipeline tick, so by
+    default this is a RingBus that keeps every reading until the interpreter drains it. "bus: latest" in the source's
+    config gives a plain Bus instead, which only keeps the newest reading - for sources where that's all that matters
+
+    Args:
+        config (dict): The source's section of sensor_comms.yaml
+        num_channels (int): Values per reading
+
+    Returns:
+        bus (RingBus or Bus): The bus
+    """
+    kind = config.get("bus", "ring")
+    if kind == "latest":
+        return Bus()
+    if kind != "ring":
+        raise ValueError(f"bus should be ring or latest, got {kind!r}")
+    return RingBus(capacity=int(config.get("bus capacity", 1024)), num_channels=num_channels)
+
+
+class Source():
+    """One sensor source: its producer, the bus it writes to, how often it runs, and what to do when it stops"""
+    def __init__(self, name:str, kind:str, producer, bus, rate_hz:float, config:dict, on_stop=None) -> None:
+        self.name = name
+        self.kind = kind
+        self.producer = producer
+        self.bus = bus
+        self.on_stop = on_stop
+        self.rate_hz = rate_hz
+        self.config = config
+
+    def __repr__(self):
+        return f"Source({self.name!r}, type={self.kind!r}, {self.rate_hz:g} Hz, {type(self.bus).__name__})"
+
+
+class SensorRegistry():
+    """Class that builds a Source for every sensor source in sensor_comms.yaml"""
+    @log_on_end(logging.INFO, "Sensor registry built", logger=logger)
+    def __init__(self, sensor=None, comms_config:dict=None, custom_logger:logging.Logger=None,
+                 filepath:str="config/sensor_comms.yaml") -> None:
+        """
+        Args:
+            sensor (Sensor, optional): The Sensor object, for source types that use the interfaces it holds. Defaults to None.
+            comms_config (dict, optional): The sensor comms config. Defaults to None (read it from filepath).
+            custom_logger (logging.Logger, optional): Logger to use instead of the module logger. Defaults to None.
+            filepath (str, optional): Sensor comms config. Defaults to "config/sensor_comms.yaml".
+        """
+        if custom_logger is not None:
+            self.logger = custom_logger
+        else:
+            self.logger = logger
+
+        if comms_config is None:
+            try:
+                with open(filepath, "r") as stream:
+                    comms_config = yaml.safe_load(stream) or {}
+            except FileNotFoundError as e:
+                self.logger.error(f"Error in loading the sensor comms config file: {e}. No sensors will be read")
+                comms_config = {}
+
+        self.sources = {}   # "source name": Source
+        for name, config in comms_config.items():
+            if not isinstance(config, dict):
+                continue
+            kind = config.get("type", DEFAULT_TYPES.get(name))
+            # Anything without a type isn't a sensor (like the pneumatic valves)
+            if kind is None:
+                continue
+            try:
+                self.sources[name] = self.build_source(name, kind, config, sensor)
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                self.logger.error(f"Couldn't set up sensor source {name}, it won't be read: {e}")
+
+    def build_source(self, name:str, kind:str, config:dict, sensor=None):
+        """Makes one source with its type's plugin
+
+        Returns:
+            source (Source): The source
+        """
+        if kind not in SOURCE_TYPES:
+            raise ValueError(f"unknown type {kind!r}, should be one of {list(SOURCE_TYPES)}")
+        rate_hz = float(config.get("poll rate (Hz)", 1.0))
+        if rate_hz <= 0:
+            raise ValueError(f"poll rate has to be above 0 Hz, got {rate_hz}")
+        producer, bus, *on_stop = SOURCE_TYPES[kind](name, config, sensor, self.logger)
+        return Source(name, kind, producer, bus, rate_hz, config, on_stop=on_stop[0] if on_stop else None)
+
+    @property
+    def busses(self):
+        """{"source name": bus} for every source"""
+        return {name: source.bus for name, source in self.sources.items()}
+
+    def add_producers(self, engine):
+        """Gives every source its own producer thread in the acquisition engine, at its own poll rate
+
+        Args:
+            engine (AcquisitionEngine): The engine
+        """
+        for name, source in self.sources.items():
+            engine.add_producer(name, source.producer, source.bus, rate_hz=source.rate_hz, on_stop=source.on_stop)
+
+    def add_gauges(self, consumer):
+        """Adds a pipeline metrics gauge for how many samples the consumer has missed off each RingBus source
+
+        Args:
+            consumer (Interpreter): Whatever drains the busses, with a {"source": samples missed} dict called missed
+        """
+        for name, source in self.sources.items():
+            if isinstance(source.bus, RingBus):
+                metrics.add_gauge(f"{name} ring bus overruns", lambda name=name: consumer.missed.get(name, 0))
+
+
+## --------------------- SOURCE TYPES --------------------- ##
+
+@register_source_type("arduino")
+def make_arduino_source(name:str, config:dict, sensor, custom_logger:logging.Logger):
+    """The Arduino, through the interface the Sensor already has open. If it's streaming, it stops while data collection
+    is paused, so we don't come back to a backlog of old samples"""
+    if sensor is None:
+        raise ValueError("the Arduino needs the Sensor object")
+    bus = make_bus(config, sensor.arduino.num_channels)
+    # The simulated Arduino doesn't have a serial transport, so these just show "--" there
+    metrics.add_gauge(f"{name} missed frames",
+                      lambda: getattr(getattr(sensor.arduino, "transport", None), "missed_frames", None))
+    metrics.add_gauge(f"{name} CRC errors",
+                      lambda: getattr(getattr(sensor.arduino, "transport", None), "crc_errors", None))
+    return sensor.arduino_producer, bus, sensor.stop_arduino_streaming
+
+@register_source_type("simulated")
+def make_simulated_source(name:str, config:dict, sensor, custom_logger:logging.Logger):
+    """Stand-in for an instrument that isn't wired up yet: readings of mean + random noise on each channel. Handy for
+    trying out calibrations and derived channels, or for seeing how the pipeline copes with more sensors"""
+    num_channels = int(config.get("channels", 1))
+    mean = float(config.get("mean", 0.0))
+    noise = float(config.get("noise", 1.0))
+    rng = np.random.default_rng()
+    def producer(bus:Bus):
+        bus.write((time.time(), mean + noise*rng.standard_normal(num_channels)))
+    return producer, make_bus(config, num_channels)
+
+
+if __name__ == "__main__":
+    registry = SensorRegistry(comms_config={"Flowmeter SLI2000": {"type": "simulated", "poll rate (Hz)": 5, "mean": 10},
+                                            "Pneumatic valves": {"Button 1": {"digital pin": 2}}})
+    print(registry.sources)
+    for source in registry.sources.values():
+        for _ in range(3):
+            source.producer(source.bus)
+        print(source.name, source.bus.drain()[:2])
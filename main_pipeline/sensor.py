@@ -10,24 +10,13 @@ from serial import SerialException
 import time
 import yaml
 import numpy as np
-import pandas as pd
 import datetime
 
 import logging
 from logdecorator import log_on_start , log_on_end , log_on_error
 
-# Set up a logger for this module
-logger = logging.getLogger(__name__)
-# Set the lowest-severity log message the logger will handle (debug = lowest, critical = highest)
-logger.setLevel(logging.DEBUG)
-# Create a handler that saves logs to the log folder named as the current date
-# fh = logging.FileHandler(f"logs\\{time.strftime('%Y-%m-%d', time.localtime())}.log")
-fh = logging.StreamHandler()
-fh.setLevel(logging.DEBUG)
-logger.addHandler(fh)
-# Create a formatter to specify our log format
-formatter = logging.Formatter("%(levelname)s: %(asctime)s - %(name)s:  %(message)s", datefmt="%H:%M:%S")
-fh.setFormatter(formatter)
+from app_logging import get_logger
+logger = get_logger(__name__)
 
 # Custom imports
 from main_pipeline.bus import Bus
@@ -35,7 +24,9 @@ from sensor_interfaces import sim_instruments
 
 ####### -------------------------------- Try to connect to all the sensors -------------------------------- #######
 # If we can connect, use the real sensor at the specified serial port and baud. if not, use simulated hardware. 
-# This allows us to have the entire process running even if we only want a few sensors online
+# This allows us to have the entire process running even if we only want a few sensors online.
+# This used to happen as soon as this module got imported, which held up everything that imported it (like the GUI
+# window showing up) while we waited on the serial port. Now it happens when the Sensor gets made - see find_arduino_interface
 
 # Load the sensor comms configuration file - dictionary with sensor serial ports and baud rates
 try:
@@ -44,16 +35,29 @@ try:
 except FileNotFoundError as e:
     logger.error(f"Error in loading the sensor_comms configuration file: {e} Check your file storage and directories")
 
-# Arduino
-try:
-    serial.Serial(port=comms_config["Arduino"]["serial port"], baudrate=comms_config["Arduino"]["baud rate"])
-    from sensor_interfaces.arduino_interface import ArduinoInterface
-    logger.info(f"Successfully connected to port {comms_config['Arduino']['serial port']}, using real Arduino hardware")
-except SerialException:
-    from sensor_interfaces.sim_instruments import ArduinoInterface
-    logger.info(f"Couldn't find Arduino at port {comms_config['Arduino']['serial port']}, shadowing sensor calls with substitute functions")
-except KeyError as e:
-    logger.warning(f"Key error in reading sensor_comms configuration file: {e}. Check that your dictionary keys match")
+def find_arduino_interface(config:dict, timeout:float=0.5):
+    """Checks whether the Arduino is plugged in, and returns the interface class to talk to it with - the real one if it's
+    there, the simulated one if it isn't
+
+    Args:
+        config (dict): The "Arduino" section of sensor_comms.yaml
+        timeout (float, optional): Longest we'll wait on the serial port, in seconds. Defaults to 0.5.
+
+    Returns:
+        ArduinoInterface (class): sensor_interfaces.arduino_interface.ArduinoInterface or sensor_interfaces.sim_instruments.ArduinoInterface
+    """
+    try:
+        # Just see if the port opens - let go of it straight away so the interface can open it for real
+        serial.Serial(port=config["serial port"], baudrate=config["baud rate"], timeout=timeout, write_timeout=timeout).close()
+        from sensor_interfaces.arduino_interface import ArduinoInterface
+        logger.info(f"Successfully connected to port {config['serial port']}, using real Arduino hardware")
+    except SerialException:
+        from sensor_interfaces.sim_instruments import ArduinoInterface
+        logger.info(f"Couldn't find Arduino at port {config['serial port']}, shadowing sensor calls with substitute functions")
+    except KeyError as e:
+        from sensor_interfaces.sim_instruments import ArduinoInterface
+        logger.warning(f"Key error in reading sensor_comms configuration file: {e}. Check that your dictionary keys match")
+    return ArduinoInterface
 
 
 class Sensor():
@@ -82,9 +86,14 @@ class Sensor():
         else:
             self.logger = logger
 
+        # This is the slow part - probing the serial port, and waiting for the Arduino to reset if it's there
+        ArduinoInterface = find_arduino_interface(comms_config["Arduino"])
         self.arduino = ArduinoInterface(serial_port=comms_config["Arduino"]["serial port"], 
                                         baud_rate=comms_config["Arduino"]["baud rate"],
-                                        custom_logger=custom_logger)
+                                        custom_logger=custom_logger,
+                                        num_channels=comms_config["Arduino"].get("analog channels", 1))
+        # If this is above 0, the Arduino streams samples with its own timestamps instead of being polled
+        self.arduino_stream_rate = comms_config["Arduino"].get("stream rate (Hz)", 0)
 
     def __del__(self):
         self.shutdown_sensors()
@@ -119,8 +128,55 @@ class Sensor():
 
         return self.sensor_status_dict
 
+    def get_poll_rate(self, name:str):
+        """Method to look up how often we should read a sensor, set in sensor_comms.yaml as "poll rate (Hz)"
+
+        Args:
+            name (str): Sensor name, must match a key in sensor_comms.yaml
+
+        Returns:
+            rate (float): Poll rate in Hz, defaults to 1 if it isn't in the config file
+        """
+        try:
+            return float(comms_config[name]["poll rate (Hz)"])
+        except (KeyError, TypeError, ValueError) as e:
+            self.logger.warning(f"No valid poll rate for {name} in sensor_comms.yaml ({e}), defaulting to 1 Hz")
+            return 1.0
+
+    def arduino_producer(self, arduino_bus:Bus):
+        """Producer method that queries the Arduino once and publishes the (timestamp, data) result on the bus. In
+        streaming mode, publishes every sample that's come in since last time instead, with the Arduino's timestamps
+
+        Args:
+            arduino_bus (Bus): Bus to write the Arduino reading to
+        """
+        if self.arduino_stream_rate > 0:
+            if not self.arduino.streaming:
+                self.arduino.start_streaming(self.arduino_stream_rate)
+            timestamps, data = self.arduino.read_samples()
+            for timestamp, values in zip(timestamps, data):
+                arduino_bus.write((timestamp, values))
+            return
+
+        timestamp, data = self.arduino.query()
+        # Nothing came in this time around
+        if data is None:
+            return
+        try:
+            arduino_bus.write((timestamp, data))
+        except ValueError:
+            # Text from the Arduino that isn't a reading, like its start-up message
+            self.logger.info(f"Arduino says: {data}")
+
+    def stop_arduino_streaming(self):
+        """Stops the Arduino streaming (if it is), e.g when data collection pauses. arduino_producer starts it again the
+        next time it runs, and start_streaming throws out any samples left over from before and starts the clock sync
+        over, so nothing stale ends up on the bus"""
+        if self.arduino.streaming:
+            self.arduino.stop_streaming()
+
     def close_arduino_serial(self):
-        self.arduino.ser.close()
+        self.arduino.close_pyserial()
 
     def open_arduino_serial(self):
         self.arduino.initialize_pyserial(port=comms_config["Arduino"]["serial port"], 
@@ -0,0 +1,430 @@
+# -------------
+# Storage backends for the Writer
+#
+# Each backend knows how to save batches of rows in one file format and how to read columns back out. The Writer
+# hands every flush to each backend listed in config/data_saving.yaml, so we can keep writing dataFull.csv (easy to
+# open in Excel, and what older scripts expect) alongside a columnar copy that's much faster to load.
+#
+# The columnar backend writes Parquet, which stores each column separately (and compressed), so reading one sensor's
+# channels for a whole day only touches those columns instead of parsing every row of text. It needs pyarrow - if
+# that isn't installed, we log a warning and stick with csv.
+#
+# Parquet files can't be read until they're finished, so rows go out in "parts" (small, complete Parquet files) in
+# a folder next to the csv. When the file is closed, the parts get stitched together into one dataFull.parquet.
+#
+# The binary backend writes dataFull.bin: a short header naming the columns, then every row as a fixed-width record
+# of float64s. Since every record is the same size, main_pipeline/reader.py can memory-map the file and jump straight
+# to the rows it wants without loading the rest.
+# -------------
+
+import os
+import csv
+import json
+import glob
+import shutil
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# pyarrow is optional - the csv backend works without it
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+import logging
+
+from app_logging import get_logger
+logger = get_logger(__name__)
+
+class CSVBackend():
+    """Saves rows to a plain csv, holding the file open between flushes"""
+    name = "csv"
+
+    def __init__(self, custom_logger:logging.Logger=None, **kwargs) -> None:
+        if custom_logger is not None:
+            self.logger = custom_logger
+        else:
+            self.logger = logger
+        self.filepath = None
+        self._file = None
+        self._csv_writer = None
+
+    @staticmethod
+    def path_for(filepath:str):
+        """Returns the path this backend saves to, given the path of the main data csv"""
+        return str(filepath)
+
+    def open(self, filepath:str, header:list):
+        """Opens the csv for appending, writing the header if the file is new or empty
+
+        Args:
+            filepath (str): Path of the main data csv
+            header (list): Column names
+        """
+        self.filepath = self.path_for(filepath)
+        # Check what's already in the file, if anything
+        try:
+            with open(self.filepath, 'r', newline='') as csvfile:
+                existing_header = next(csv.reader(line for line in csvfile if line.strip()), None)
+        except FileNotFoundError:
+            existing_header = None
+        if existing_header is not None and existing_header != header:
+            self.logger.warning(f"The header of {self.filepath} doesn't match the sensors we're saving - check config/sensor_data.yaml")
+
+        self._file = open(self.filepath, 'a', newline='')
+        self._csv_writer = csv.writer(self._file)
+        if existing_header is None:
+            self._csv_writer.writerow(header)
+            self._file.flush()
+
+    def write_rows(self, rows:list, fsync:bool=False):
+        """Writes a batch of rows and pushes them out to the disk
+
+        Args:
+            rows (list): List of rows, each with one value per column
+            fsync (bool, optional): Whether to force the data all the way onto the disk. Defaults to False.
+        """
+        if self._file is None:
+            return
+        self._csv_writer.writerows(rows)
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._csv_writer = None
+
+    @staticmethod
+    def read_columns(filepath:str, columns:list):
+        """Reads some of the columns out of a data csv
+
+        Args:
+            filepath (str): Path of the main data csv
+            columns (list): Names of the columns we want
+
+        Returns:
+            data (pd.DataFrame): The requested columns
+        """
+        return pd.read_csv(filepath, delimiter=',', header=0, usecols=columns)
+
+
+class ParquetBackend():
+    """Saves rows to chunked, compressed, columnar Parquet files (see the top of this file)"""
+    name = "parquet"
+
+    def __init__(self, custom_logger:logging.Logger=None, chunk_rows:int=600, chunk_interval:float=60, compression:str="zstd", **kwargs) -> None:
+        """
+        Args:
+            custom_logger (logging.Logger, optional): Logger to use instead of the module logger. Defaults to None.
+            chunk_rows (int, optional): Write out a part once we have this many rows... Defaults to 600.
+            chunk_interval (float, optional): ...or once it's been this many seconds since the last part. Defaults to 60.
+            compression (str, optional): Parquet compression codec, applied to each column. Defaults to "zstd".
+        """
+        if pa is None:
+            raise ImportError("The parquet storage backend needs pyarrow (pip install pyarrow)")
+        if custom_logger is not None:
+            self.logger = custom_logger
+        else:
+            self.logger = logger
+        self.chunk_rows = chunk_rows
+        self.chunk_interval = chunk_interval
+        self.compression = compression
+
+        self.filepath = None
+        self.header = []
+        self.schema = None
+        self._pending = []  # Rows we haven't put in a part yet
+        self._last_part = time.monotonic()
+        self._num_parts = 0
+
+    @staticmethod
+    def path_for(filepath:str):
+        """Returns the path this backend saves to, given the path of the main data csv"""
+        return str(Path(filepath).with_suffix(".parquet"))
+
+    @staticmethod
+    def parts_dir_for(filepath:str):
+        """Returns the folder where parts wait to be stitched together, given the path of the main data csv"""
+        return str(Path(filepath).with_suffix(".parquet.parts"))
+
+    def open(self, filepath:str, header:list):
+        """Gets ready to write parts for this data file. If there's already a finished Parquet file from earlier,
+        it becomes the first part so that we append to it instead of overwriting it.
+
+        Args:
+            filepath (str): Path of the main data csv
+            header (list): Column names
+        """
+        self.filepath = self.path_for(filepath)
+        self.parts_dir = self.parts_dir_for(filepath)
+        self.header = list(header)
+        # Everything gets saved as float64 - timestamps and readings alike
+        self.schema = pa.schema([(column, pa.float64()) for column in self.header])
+        Path(self.parts_dir).mkdir(parents=True, exist_ok=True)
+        existing_parts = sorted(glob.glob(os.path.join(self.parts_dir, "part-*.parquet")))
+        self._num_parts = len(existing_parts)
+        if Path(self.filepath).exists():
+            if pq.read_schema(self.filepath).names != self.header:
+                self.logger.warning(f"The columns of {self.filepath} don't match the sensors we're saving - check config/sensor_data.yaml")
+            # Parts are numbered in order, so put the old file in front of anything else
+            os.replace(self.filepath, os.path.join(self.parts_dir, "part-00000-previous.parquet"))
+        self._pending = []
+        self._last_part = time.monotonic()
+
+    def write_rows(self, rows:list, fsync:bool=False):
+        """Saves up rows, and writes them out as a part once there are enough of them or enough time has gone by
+
+        Args:
+            rows (list): List of rows, each with one value per column
+            fsync (bool, optional): Whether to force each part all the way onto the disk. Defaults to False.
+        """
+        self._pending.extend(rows)
+        if len(self._pending) >= self.chunk_rows or time.monotonic() - self._last_part >= self.chunk_interval:
+            self._write_part(fsync)
+
+    def _write_part(self, fsync:bool=False):
+        """Writes every pending row out as one complete Parquet file in the parts folder"""
+        self._last_part = time.monotonic()
+        if not self._pending or self.filepath is None:
+            return
+        # Take the rows off the pending list before writing, so if this part fails (full disk...) the error gets logged
+        # by the Writer and these rows are dropped from the Parquet copy, instead of being retried and failing forever
+        rows, self._pending = self._pending, []
+        # Blank cells (sensors that didn't report this row) become NaN, and so does anything that isn't a number
+        bad_cells = 0
+        values = np.full((len(rows), len(self.header)), np.nan)
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row[:len(self.header)]):
+                if value == "" or value is None:
+                    continue
+                try:
+                    values[i, j] = float(value)
+                except (TypeError, ValueError):
+                    bad_cells += 1
+        if bad_cells:
+            self.logger.warning(f"{bad_cells} cells in the last {len(rows)} rows weren't numbers, saved them to the parquet copy as NaN")
+        table = pa.Table.from_arrays([pa.array(values[:, i]) for i in range(len(self.header))], schema=self.schema)
+        part_path = os.path.join(self.parts_dir, f"part-{self._num_parts + 1:05d}.parquet")
+        # Write under a temporary name and then rename, so nobody reading the parts ever sees a half-written one
+        pq.write_table(table, part_path + ".tmp", compression=self.compression)
+        if fsync:
+            with open(part_path + ".tmp", 'rb') as part_file:
+                os.fsync(part_file.fileno())
+        os.replace(part_path + ".tmp", part_path)
+        self._num_parts += 1
+
+    def close(self):
+        """Writes out whatever's pending and stitches all the parts into the finished Parquet file"""
+        if self.filepath is None:
+            return
+        self._write_part()
+        parts = sorted(glob.glob(os.path.join(self.parts_dir, "part-*.parquet")))
+        try:
+            if parts:
+                # Each part becomes a row group of the finished file, so this never has to hold the whole day in memory
+                with pq.ParquetWriter(self.filepath, self.schema, compression=self.compression) as parquet_writer:
+                    for part in parts:
+                        parquet_writer.write_table(pq.read_table(part, schema=self.schema))
+        except (OSError, pa.ArrowException) as e:
+            # Leave the parts where they are so nothing gets lost - read_columns can still read them
+            self.logger.error(f"Couldn't combine the parquet parts in {self.parts_dir}: {e}")
+            Path(self.filepath).unlink(missing_ok=True)
+        else:
+            shutil.rmtree(self.parts_dir, ignore_errors=True)
+        self.filepath = None
+
+    @staticmethod
+    def read_columns(filepath:str, columns:list):
+        """Reads some of the columns out of the Parquet copy of a data file, including any parts that haven't been
+        stitched together yet. Only the requested columns are read off the disk.
+
+        Args:
+            filepath (str): Path of the main data csv
+            columns (list): Names of the columns we want
+
+        Returns:
+            data (pd.DataFrame): The requested columns
+        """
+        paths = []
+        if Path(ParquetBackend.path_for(filepath)).exists():
+            paths.append(ParquetBackend.path_for(filepath))
+        paths.extend(sorted(glob.glob(os.path.join(ParquetBackend.parts_dir_for(filepath), "part-*.parquet"))))
+        if not paths:
+            raise FileNotFoundError(f"No parquet data for {filepath}")
+        tables = [pq.read_table(path, columns=columns) for path in paths]
+        return pa.concat_tables(tables).to_pandas()
+
+    @staticmethod
+    def available(filepath:str):
+        """Returns whether there's Parquet data for this data file that we're able to read"""
+        if pq is None:
+            return False
+        return Path(ParquetBackend.path_for(filepath)).exists() or Path(ParquetBackend.parts_dir_for(filepath)).is_dir()
+
+
+class BinaryBackend():
+    """Saves rows as fixed-width float64 records in a binary file that can be memory-mapped (see the top of this file)"""
+    name = "binary"
+    # Every binary data file starts with this, then the length of the column list (4 bytes), then the column list itself
+    magic = b"COLDEXB1"
+
+    def __init__(self, custom_logger:logging.Logger=None, **kwargs) -> None:
+        if custom_logger is not None:
+            self.logger = custom_logger
+        else:
+            self.logger = logger
+        self.filepath = None
+        self._file = None
+        self._num_columns = 0
+
+    @staticmethod
+    def path_for(filepath:str):
+        """Returns the path this backend saves to, given the path of the main data csv"""
+        return str(Path(filepath).with_suffix(".bin"))
+
+    @classmethod
+    def make_header(cls, header:list):
+        """Builds the bytes that go at the start of the file. They're padded out to a multiple of 8 bytes so the 
+        records after them stay lined up for memory-mapping"""
+        columns = json.dumps(header).encode("utf-8")
+        length = len(cls.magic) + 4 + len(columns)
+        padding = b" " * (-length % 8)
+        columns += padding
+        return cls.magic + len(columns).to_bytes(4, "little") + columns
+
+    @classmethod
+    def read_header(cls, filepath:str):
+        """Reads the column list from the start of a binary data file
+
+        Returns:
+            columns (list): Column names
+
+            **offset** (int): Where the first record starts, in bytes
+        """
+        with open(filepath, 'rb') as binfile:
+            if binfile.read(len(cls.magic)) != cls.magic:
+                raise ValueError(f"{filepath} isn't a binary data file")
+            length = int.from_bytes(binfile.read(4), "little")
+            columns = json.loads(binfile.read(length).decode("utf-8"))
+        return columns, len(cls.magic) + 4 + length
+
+    def open(self, filepath:str, header:list):
+        """Opens the binary file for appending, writing the header if the file is new
+
+        Args:
+            filepath (str): Path of the main data csv
+            header (list): Column names
+        """
+        self.filepath = self.path_for(filepath)
+        self._num_columns = len(header)
+        if Path(self.filepath).exists() and Path(self.filepath).stat().st_size > 0:
+            existing_header, offset = self.read_header(self.filepath)
+            if existing_header != list(header):
+                # The records wouldn't line up with the header anymore, so don't touch the file
+                self.logger.error(f"The columns of {self.filepath} don't match the sensors we're saving - not saving a binary copy")
+                self.filepath = None
+                return
+            self._file = open(self.filepath, 'ab')
+            # If we got cut off partway through a record last time, drop the partial record so everything lines up
+            record_size = 8*self._num_columns
+            extra = (self._file.tell() - offset) % record_size
+            if extra:
+                self._file.truncate(self._file.tell() - extra)
+                self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(self.filepath, 'wb')
+            self._file.write(self.make_header(header))
+            self._file.flush()
+
+    def write_rows(self, rows:list, fsync:bool=False):
+        """Appends a batch of rows as fixed-width records
+
+        Args:
+            rows (list): List of rows, each with one value per column
+            fsync (bool, optional): Whether to force the data all the way onto the disk. Defaults to False.
+        """
+        if self._file is None:
+            return
+        # Blank cells (sensors that didn't report this row) become NaN
+        records = np.array([[np.nan if value == "" else value for value in row] for row in rows], dtype="<f8")
+        self._file.write(records.tobytes())
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def available(filepath:str):
+        """Returns whether there's a binary copy of this data file"""
+        return Path(BinaryBackend.path_for(filepath)).exists()
+
+
+# Backends the Writer can use, by the name we give them in config/data_saving.yaml
+BACKENDS = {
+    CSVBackend.name: CSVBackend,
+    ParquetBackend.name: ParquetBackend,
+    BinaryBackend.name: BinaryBackend,
+}
+
+def make_backends(names:list, custom_logger:logging.Logger=None, **kwargs):
+    """Builds the storage backends listed in the data saving config, skipping (with a warning) any we can't use
+
+    Args:
+        names (list): Backend names, e.g ["csv", "parquet"]
+        custom_logger (logging.Logger, optional): Logger to use instead of the module logger. Defaults to None.
+        **kwargs: Settings passed along to each backend
+
+    Returns:
+        backends (list): The backend objects
+    """
+    log = custom_logger if custom_logger is not None else logger
+    backends = []
+    for name in names:
+        try:
+            backends.append(BACKENDS[name](custom_logger=custom_logger, **kwargs))
+        except KeyError:
+            log.warning(f"Unknown storage backend '{name}' in data_saving.yaml, options are {list(BACKENDS.keys())}")
+        except ImportError as e:
+            log.warning(f"Can't use the {name} storage backend: {e}")
+    # Whatever happens, make sure we're saving the data somewhere
+    if not backends:
+        log.warning("No usable storage backends, falling back to csv")
+        backends.append(CSVBackend(custom_logger=custom_logger))
+    return backends
+
+def read_columns(filepath:str, columns:list):
+    """Reads some of the columns of a data file from the fastest copy we've got - Parquet if it's there, otherwise the csv
+
+    Args:
+        filepath (str): Path of the main data csv
+        columns (list): Names of the columns we want
+
+    Returns:
+        data (pd.DataFrame): The requested columns
+    """
+    if ParquetBackend.available(filepath):
+        return ParquetBackend.read_columns(filepath, columns)
+    return CSVBackend.read_columns(filepath, columns)
+
+def export_csv(filepath:str, csv_path:str=None):
+    """Writes the Parquet copy of a data file back out as a csv, for anything that needs the old format
+
+    Args:
+        filepath (str): Path of the main data csv (the Parquet copy sits next to it)
+        csv_path (str, optional): Where to save the exported csv. Defaults to None (overwrites the main data csv).
+    """
+    if csv_path is None:
+        csv_path = filepath
+    data = ParquetBackend.read_columns(filepath, columns=None)
+    data.to_csv(csv_path, index=False)
@@ -1,39 +1,221 @@
 # -------------
-# The display class
+# The writer class
+#
+# Holds the data file open and batches rows up in memory, then writes them all in one go once we've got enough
+# of them or enough time has gone by (set in config/data_saving.yaml). A background thread takes care of the
+# time-based flushes, so data still makes it to the disk even if nothing new comes in or the GUI is busy.
+#
+# Every flush goes to each of the storage backends listed in the config (see storage.py) - by default the csv
+# and a columnar Parquet copy.
 # -------------
 
 import time
 import yaml
-import csv
+import threading
+import numpy as np
 import pandas as pd
 
 # from gui import GUI
 try:
     from main_pipeline.bus import Bus
+    from main_pipeline import storage
+    from main_pipeline.metrics import metrics
 except ImportError:
     from bus import Bus
+    import storage
+    from metrics import metrics
 
 import logging
 from logdecorator import log_on_start , log_on_end , log_on_error
 
-# Set up a logger for this module
-logger = logging.getLogger(__name__)
-# Set the lowest-severity log message the logger will handle (debug = lowest, critical = highest)
-logger.setLevel(logging.DEBUG)
-# Create a handler that saves logs to the log folder named as the current date
-# fh = logging.FileHandler(f"logs\\{time.strftime('%Y-%m-%d', time.localtime())}.log")
-fh = logging.StreamHandler()
-fh.setLevel(logging.DEBUG)
-logger.addHandler(fh)
-# Create a formatter to specify our log format
-formatter = logging.Formatter("%(levelname)s: %(asctime)s - %(name)s:  %(message)s", datefmt="%H:%M:%S")
-fh.setFormatter(formatter)
+from app_logging import get_logger
+logger = get_logger(__name__)
 
 class Writer():
     """Class that reads the interpreted data and saves it to the disk"""
-    @log_on_end(logging.INFO, "Display class initiated", logger=logger)
-    def __init__(self) -> None:
-        pass
+    @log_on_end(logging.INFO, "Writer class initiated", logger=logger)
+    def __init__(self, custom_logger:logging.Logger=None) -> None:
+        
+        # If we've passed in a custom logger, use that. Otherwise, use the module logger
+        if custom_logger is not None:
+            self.logger = custom_logger
+        else:
+            self.logger = logger
+
+        # Read in the data saving config file to get our flush thresholds and storage backends
+        try:
+            with open("config/data_saving.yaml", 'r') as stream:
+                saving_config = yaml.safe_load(stream)
+            writer_config = saving_config["Writer"]
+            storage_config = saving_config["Storage"]
+        except (FileNotFoundError, KeyError, TypeError) as e:
+            self.logger.error(f"Error in loading the data saving config file: {e}. Using default writer settings")
+            writer_config = {}
+            storage_config = {}
+        self.flush_rows = int(writer_config.get("flush rows", 50))
+        self.flush_interval = float(writer_config.get("flush interval (s)", 5))
+        self.fsync = bool(writer_config.get("fsync", False))
+
+        self.backends = storage.make_backends(storage_config.get("backends", ["csv"]),
+                                              custom_logger=self.logger,
+                                              chunk_rows=int(storage_config.get("chunk rows", 600)),
+                                              chunk_interval=float(storage_config.get("chunk interval (s)", 60)),
+                                              compression=storage_config.get("compression", "zstd"))
+
+        self.filepath = None
+        self.header = []
+        self.columns = []   # (sensor, channel) for each column of the header - channel is None for the timestamp
+        self._is_open = False
+        self._rows = []     # Rows waiting to be written
+        self._last_flush = time.monotonic()
+        self._rows_lock = threading.Lock()  # Protects self._rows
+        self._file_lock = threading.Lock()  # Makes sure two flushes never write at the same time
+
+        # Background thread for time-based flushes
+        self._stop_event = threading.Event()
+        self._flush_thread = None
+
+        metrics.add_gauge("writer rows waiting", lambda: len(self._rows))
+
+    def __del__(self):
+        self.close_file()
+
+    def get_data_directory(self):
+        """Returns the path of the data file we're currently writing to (None if we haven't opened one)"""
+        return self.filepath
+
+    @log_on_end(logging.INFO, "Opened data file {filepath}", logger=logger)
+    def open_file(self, filepath:str, sensor_channels:dict):
+        """Method to start writing to a new data file. If the file is new (or empty) we give it a header; if it already
+        has data, we append to it.
+
+        Args:
+            filepath (str): Path to the data csv
+            sensor_channels (dict): Dictionary of "sensor name": [channel names], sets the columns of the file. Each sensor
+                gets a "Sensor: time (epoch)" column followed by a "Sensor: Channel" column per channel
+        """
+        # Finish up with whatever file we had open before
+        self.close_file()
+
+        self.columns = []
+        for sensor, channels in sensor_channels.items():
+            self.columns.append((sensor, None))
+            for channel in channels:
+                self.columns.append((sensor, channel))
+        self.header = [f"{sensor}: time (epoch)" if channel is None else f"{sensor}: {channel}" for sensor, channel in self.columns]
+
+        self.filepath = filepath
+        with self._file_lock:
+            for backend in self.backends:
+                backend.open(filepath, self.header)
+            self._is_open = True
+        self._last_flush = time.monotonic()
+
+        # Start the background flusher
+        self._stop_event.clear()
+        self._flush_thread = threading.Thread(target=self._flush_loop, name="writer flush", daemon=True)
+        self._flush_thread.start()
+
+    def close_file(self):
+        """Method to write out anything still waiting in memory and close the data file"""
+        self._stop_event.set()
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+            self._flush_thread = None
+        if self._is_open:
+            self.flush()
+            with self._file_lock:
+                for backend in self.backends:
+                    try:
+                        backend.close()
+                    except OSError as e:
+                        self.logger.error(f"Error closing the {backend.name} copy of {self.filepath}: {e}")
+                self._is_open = False
+
+    def write_row(self, row:list):
+        """Method to queue up one row for writing. If that brings us up to the flush threshold, flush right away.
+
+        Args:
+            row (list): One value per column of the header
+        """
+        self.write_rows([row])
+
+    def write_rows(self, rows:list):
+        """Method to queue up several rows for writing, see write_row
+
+        Args:
+            rows (list): List of rows, each with one value per column of the header
+        """
+        with self._rows_lock:
+            self._rows.extend(rows)
+            num_waiting = len(self._rows)
+        if num_waiting >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        """Method to write every waiting row to the disk in one go"""
+        # Swap the waiting rows out for an empty list, so whoever's adding rows only waits as long as the swap takes
+        with self._rows_lock:
+            rows, self._rows = self._rows, []
+        with self._file_lock:
+            self._last_flush = time.monotonic()
+            if not rows or not self._is_open:
+                return
+            # One backend having trouble shouldn't stop the others from saving
+            with metrics.timer("disk flush"):
+                for backend in self.backends:
+                    try:
+                        backend.write_rows(rows, fsync=self.fsync)
+                    except (OSError, ValueError) as e:
+                        self.logger.error(f"Error writing {len(rows)} rows to the {backend.name} copy of {self.filepath}: {e}")
+                        metrics.incr("disk write errors")
+
+    def _flush_loop(self):
+        """Runs on the background thread, flushing whenever flush_interval goes by without a flush"""
+        while not self._stop_event.wait(min(self.flush_interval, 1.0)):
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def format_rows(self, data:dict):
+        """Method to turn a dictionary of interpreted data into rows that match our header. Values can be single readings 
+        or arrays of readings; if sensors came back with different numbers of readings, the shorter ones get blank cells.
+
+        Args:
+            data (dict): Interpreted data, with the same key/value structure as big_data_dict
+
+        Returns:
+            rows (list): List of rows, each with one value per column of the header
+        """
+        columns = []
+        for sensor, channel in self.columns:
+            try:
+                if channel is None:
+                    value = data[sensor]["Time (epoch)"]
+                else:
+                    value = data[sensor]["Data"][channel]
+            except (KeyError, TypeError):
+                value = []
+            columns.append(np.atleast_1d(value))
+        num_rows = max((len(column) for column in columns), default=0)
+        rows = []
+        for i in range(num_rows):
+            rows.append([column[i] if i < len(column) else "" for column in columns])
+        return rows
+
+    def write_consumer(self, interp_bus:Bus):
+        """Consumer method that reads the latest interpreted data off the bus and saves it. If we don't have a data file 
+        open yet (no project started), the data just passes through.
+
+        Args:
+            interp_bus (Bus): The interpreter's bus
+
+        Returns:
+            data (dict): The data we read off the bus, so it can go on to the live plots
+        """
+        data = interp_bus.read()
+        if data is not None and self._is_open:
+            self.write_rows(self.format_rows(data))
+        return data
 
 if __name__ == "__main__":
-    mywriter = Writer()
\ No newline at end of file
+    mywriter = Writer()
@@ -1,51 +1,148 @@
 import sys
+import time
+import html
+import threading
+from collections import deque
 import logging
 from PyQt5 import QtWidgets, QtCore
 from PyQt5.QtGui import *
 
 
 class GUIHandler(logging.Handler, QtCore.QObject):
-    appendText = QtCore.pyqtSignal(str)
-    setBackgroundColor = QtCore.pyqtSignal(QColor)
-    setTextColor = QtCore.pyqtSignal(QColor)
-
-    def __init__(self, parent:QtWidgets.QTextEdit, level):
+    """Logging handler that shows log records in a QTextEdit.
+
+    Records can come in from any thread (sensor producers, the acquisition engine, routines...), so emit() doesn't touch
+    the widget at all - it just drops the record on a queue. A QTimer on the GUI thread drains the queue every
+    flush_interval_ms and adds everything that's come in as a single edit, so the widget gets updated once per
+    flush no matter how much is being logged. To keep a flood of messages from swamping the GUI:
+      - the same message repeated back to back gets shown once, then a "(repeated N more times)" line when something
+        else comes along (or every repeat_report_s, if it just keeps coming)
+      - at most max_pending records wait on the queue - past that the oldest get dropped, and the next flush says how many
+      - the widget only keeps the last max_lines lines
+    """
+    backgroundColors = {
+                        "DEBUG": QColor(25, 162, 135, 255),
+                        "INFO": QColor(151, 195, 214, 255),
+                        "WARNING": QColor(255, 149, 0, 255),
+                        "ERROR": QColor(189, 74, 28, 255),
+                        "CRITICAL": QColor(111, 0, 0, 255),
+    }
+
+    textColors = {
+                        "DEBUG": QColor(0, 0, 0, 255),
+                        "INFO": QColor(0, 0, 0, 255),
+                        "WARNING": QColor(0, 0, 0, 255),
+                        "ERROR": QColor(0, 0, 0, 255),
+                        "CRITICAL": QColor(255, 255, 255, 255),
+    }
+
+    def __init__(self, parent:QtWidgets.QTextEdit, level, flush_interval_ms:int=100, max_lines:int=2000,
+                 max_pending:int=5000, max_per_flush:int=200, repeat_report_s:float=5.0):
+        """
+        Args:
+            parent (QtWidgets.QTextEdit): The widget to show the logs in
+            level (int): Lowest log level to show
+            flush_interval_ms (int, optional): How often to add new records to the widget, in ms. Defaults to 100.
+            max_lines (int, optional): How many lines the widget keeps before dropping the oldest. Defaults to 2000.
+            max_pending (int, optional): How many records can wait for the next flush before we start dropping them. Defaults to 5000.
+            max_per_flush (int, optional): Most records to add in one flush - the rest wait for the next one. Defaults to 200.
+            repeat_report_s (float, optional): How often to report the count of a message that keeps repeating. Defaults to 5.0.
+        """
         super().__init__(level)
         QtCore.QObject.__init__(self)
-        
+
         # self.widget = parent QtWidgets.QTextEdit(parent)
         self.widget = parent
-
         self.widget.setReadOnly(True)
-        self.appendText.connect(self.widget.append)
-        self.setBackgroundColor.connect(self.widget.setTextBackgroundColor)
-        self.setTextColor.connect(self.widget.setTextColor)
-
-        self.backgroundColors = {
-                            "DEBUG": QColor(25, 162, 135, 255),
-                            "INFO": QColor(151, 195, 214, 255),
-                            "WARNING": QColor(255, 149, 0, 255),
-                            "ERROR": QColor(189, 74, 28, 255),
-                            "CRITICAL": QColor(111, 0, 0, 255),
-        }
-
-        self.textColors = {
-                            "DEBUG": QColor(0, 0, 0, 255),
-                            "INFO": QColor(0, 0, 0, 255),
-                            "WARNING": QColor(0, 0, 0, 255),
-                            "ERROR": QColor(0, 0, 0, 255),
-                            "CRITICAL": QColor(255, 255, 255, 255),
-        }
+        self.widget.document().setMaximumBlockCount(max_lines)
+
+        self.max_pending = max_pending
+        self.max_per_flush = max_per_flush
+        self._pending = deque()
+        self._pending_lock = threading.Lock()
+        self.dropped = 0            # Records thrown out because too many were waiting (total)
+        self._dropped_unreported = 0
+        self.repeat_report_s = repeat_report_s
+        self._last = None           # (levelname, message) of the last line we showed...
+        self._repeats = 0           # ...how many times it's repeated since...
+        self._repeats_since = 0.0   # ...this time
+
+        # Work out the colors once, rather than for every record
+        self._styles = {level: f"background-color:{self.backgroundColors[level].name()}; color:{self.textColors[level].name()}"
+                        for level in self.backgroundColors}
+
+        # The timer belongs to the GUI thread (wherever the handler was made), so update_widget() always runs there
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.update_widget)
+        self.timer.start(flush_interval_ms)
 
     def emit(self, record):
-        bg_color = self.backgroundColors[record.levelname]
-        self.setBackgroundColor.emit(bg_color)
-
-        txt_color = self.textColors[record.levelname]
-        self.setTextColor.emit(txt_color)
-
-        out = self.format(record)
-        self.appendText.emit(out)
+        with self._pending_lock:
+            if len(self._pending) >= self.max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+                self._dropped_unreported += 1
+            self._pending.append(record)
+
+    def update_widget(self):
+        """Adds everything that's come in since last time to the widget, in one go. Only call this from the GUI thread
+        (not named flush(), since logging calls that from whatever thread it likes on the way out)"""
+        with self._pending_lock:
+            if not self._pending and not self._dropped_unreported and not self._repeats:
+                return
+            count = min(len(self._pending), self.max_per_flush)
+            records = [self._pending.popleft() for _ in range(count)]
+            dropped, self._dropped_unreported = self._dropped_unreported, 0
+
+        lines = []
+        if dropped:
+            lines.append(self._line("WARNING", f"Log flood - dropped {dropped} messages"))
+        for record in records:
+            try:
+                text = self.format(record)
+            except Exception:
+                self.handleError(record)
+                continue
+            key = (record.levelname, record.getMessage())
+            if key == self._last:
+                self._repeats += 1
+                continue
+            if self._repeats:
+                lines.append(self._line(self._last[0], f"(repeated {self._repeats} more times)"))
+            self._last, self._repeats, self._repeats_since = key, 0, time.monotonic()
+            lines.append(self._line(record.levelname, text))
+        # Don't sit on a repeat count forever if the same message just keeps coming
+        if self._repeats and time.monotonic() - self._repeats_since >= self.repeat_report_s:
+            lines.append(self._line(self._last[0], f"(repeated {self._repeats} more times)"))
+            self._repeats, self._repeats_since = 0, time.monotonic()
+        if not lines:
+            return
+        # Add every line as its own block (so max_lines counts lines), but all inside one edit so the widget only lays
+        # itself out once. Keep following the end of the log, unless the user has scrolled up to read something
+        scrollbar = self.widget.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum() - 4
+        cursor = QTextCursor(self.widget.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.beginEditBlock()
+        for line in lines:
+            if not self.widget.document().isEmpty():
+                cursor.insertBlock()
+            cursor.insertHtml(line)
+        cursor.endEditBlock()
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
+
+    def _line(self, levelname:str, text:str):
+        style = self._styles.get(levelname, self._styles["INFO"])
+        return f'<span style="{style}; white-space:pre-wrap">{html.escape(text)}</span>'
+
+    def close(self):
+        try:
+            self.timer.stop()
+        except RuntimeError:
+            # The Qt side's already been deleted (e.g logging shutting down after the app closed)
+            pass
+        super().close()
 
 
 if __name__ == "__main__":
@@ -66,6 +163,8 @@ if __name__ == "__main__":
     log.warning("Watch out")
     log.error("Something has gone wrong")
     log.critical("Oh god everything is broken")
+    # A flood from another thread - shows up as one line plus a repeat count
+    threading.Thread(target=lambda: [log.info("Querying arduino") for _ in range(10000)]).start()
 
     widget.show()
-    sys.exit(app.exec_())
\ No newline at end of file
+    sys.exit(app.exec_())
@@ -0,0 +1,116 @@
+import numpy as np
+
+## --------------------- LIVE DATA BUFFER --------------------- ##
+class SensorBuffer():
+    """Fixed-size circular buffer holding the most recent data from one sensor. It's a single structured NumPy array
+    with a shared time column ("Time (epoch)") and one float column per data channel, allocated once up front so
+    memory use is capped at max_length samples no matter how long we run.
+
+    The trick is that the array is twice as long as it needs to be, and every sample gets written to both halves.
+    That way the most recent N samples are always sitting next to each other in memory, so we can hand out windows
+    as views (no copying) without ever having to unwrap the ring.
+    """
+    time_key = "Time (epoch)"
+
+    def __init__(self, channels:list, max_length:int=5000):
+        """
+        Args:
+            channels (list): Names of the data channels, e.g ["Pressure (Torr)"]
+            max_length (int, optional): How many samples we hold onto before overwriting the oldest. Defaults to 5000.
+        """
+        self.channels = list(channels)
+        self.max_length = max_length
+        self.dtype = np.dtype([(self.time_key, np.float64)] + [(channel, np.float64) for channel in self.channels])
+        self._data = np.full(2*max_length, np.nan, dtype=self.dtype)
+        self._next = 0      # Index (in the first half) where the next sample goes
+        self.length = 0     # How many valid samples we have, up to max_length
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def nbytes(self):
+        """How much memory the buffer is using, in bytes - fixed when the buffer is created"""
+        return self._data.nbytes
+
+    def append(self, timestamp:float, data:dict):
+        """Adds one sample to the buffer. O(1), no matter how full the buffer is.
+
+        Args:
+            timestamp (float): Epoch time of the sample
+            data (dict): Dictionary of "channel name": value. Any channel that's missing gets np.nan
+        """
+        row = (timestamp, *[data.get(channel, np.nan) for channel in self.channels])
+        self._data[self._next] = row
+        self._data[self._next + self.max_length] = row
+        self._next = (self._next + 1) % self.max_length
+        self.length = min(self.length + 1, self.max_length)
+
+    def extend(self, timestamps, data:dict):
+        """Adds a batch of samples to the buffer in one go.
+
+        Args:
+            timestamps (array_like): Epoch time of each sample
+            data (dict): Dictionary of "channel name": array_like of values, each the same length as timestamps
+        """
+        timestamps = np.atleast_1d(np.asarray(timestamps, dtype=np.float64))
+        n = len(timestamps)
+        if n == 0:
+            return
+        # If we got more than we can hold, only the newest max_length samples would survive anyway
+        keep = min(n, self.max_length)
+        idx = (self._next + np.arange(n - keep, n)) % self.max_length
+        columns = {self.time_key: timestamps}
+        for channel in self.channels:
+            try:
+                columns[channel] = np.broadcast_to(np.asarray(data[channel], dtype=np.float64), (n,))
+            except KeyError:
+                columns[channel] = np.full(n, np.nan)
+        for name, column in columns.items():
+            self._data[name][idx] = column[n - keep:]
+            self._data[name][idx + self.max_length] = column[n - keep:]
+        self._next = (self._next + n) % self.max_length
+        self.length = min(self.length + n, self.max_length)
+
+    def window(self, n:int=None):
+        """Returns the most recent n samples (oldest first) as a read-only view into the buffer - no copying.
+
+        Args:
+            n (int, optional): How many samples we want. Defaults to None (everything in the buffer).
+
+        Returns:
+            window (np.ndarray): Structured array view with a "Time (epoch)" field and one field per channel
+        """
+        if n is None or n > self.length:
+            n = self.length
+        end = self._next + self.max_length
+        view = self._data[end - n:end]
+        view.flags.writeable = False
+        return view
+
+    def window_since(self, t_start:float):
+        """Returns every sample with a timestamp at or after t_start, as a view. Assumes timestamps only go up.
+
+        Args:
+            t_start (float): Epoch time of the earliest sample we want
+
+        Returns:
+            window (np.ndarray): Structured array view, same as window()
+        """
+        full = self.window()
+        start = np.searchsorted(full[self.time_key], t_start, side="left")
+        return full[start:]
+
+    def get_time(self, n:int=None):
+        """Returns a view of the most recent n timestamps"""
+        return self.window(n)[self.time_key]
+
+    def get_channel(self, channel:str, n:int=None):
+        """Returns a view of the most recent n values of one channel"""
+        return self.window(n)[channel]
+
+    def clear(self):
+        """Empties the buffer without reallocating it"""
+        self._data.fill(np.nan)
+        self._next = 0
+        self.length = 0
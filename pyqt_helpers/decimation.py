@@ -0,0 +1,64 @@
+import numpy as np
+
+## --------------------- PLOT DECIMATION --------------------- ##
+# A plot can't show more detail than it has pixels, so there's no point handing matplotlib a million points for an
+# 800 pixel wide axis. These functions split the x-axis into bins (one per pixel column) and keep only the first,
+# minimum, maximum, and last point in each bin (the "M4" approach). Drawing just those points looks identical to
+# drawing everything - spikes and all - but costs a few thousand points instead of millions.
+
+def minmax_decimate_indices(x, y, num_bins:int):
+    """Method to pick which points to keep when decimating, binning by x value so gaps in the data stay gaps.
+
+    Args:
+        x (array_like): Numeric x values, sorted from low to high
+        y (array_like): y values, same length as x. np.nan is fine
+        num_bins (int): How many bins to split the x range into, usually the axis width in pixels
+
+    Returns:
+        idx (np.ndarray): Sorted indices of the points to keep
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    num_bins = max(int(num_bins), 1)
+    # If there's not much data, keep all of it
+    if n <= 4*num_bins:
+        return np.arange(n)
+
+    # Figure out where each bin starts. Empty bins just get dropped
+    edges = np.linspace(x[0], x[-1], num_bins + 1)
+    starts = np.unique(np.searchsorted(x, edges[:-1], side="left"))
+    starts = starts[starts < n]
+    ends = np.append(starts[1:], n)     # One past the last index of each bin
+    counts = ends - starts
+
+    # Find the index of the min and max in each bin without a Python loop: get each bin's min/max value, then find the
+    # first index in the bin that matches it. NaNs are swapped for +/-inf so they never win unless the whole bin is NaN
+    nan_mask = np.isnan(y)
+    y_for_min = np.where(nan_mask, np.inf, y)
+    y_for_max = np.where(nan_mask, -np.inf, y)
+    bin_mins = np.repeat(np.minimum.reduceat(y_for_min, starts), counts)
+    bin_maxs = np.repeat(np.maximum.reduceat(y_for_max, starts), counts)
+    positions = np.arange(n)
+    min_idx = np.minimum.reduceat(np.where(y_for_min == bin_mins, positions, n), starts)
+    max_idx = np.minimum.reduceat(np.where(y_for_max == bin_maxs, positions, n), starts)
+
+    # Keep the first, min, max, and last point of each bin, in order
+    idx = np.concatenate((starts, min_idx, max_idx, ends - 1))
+    return np.unique(idx)
+
+def minmax_decimate(x, y, num_bins:int):
+    """Method to decimate x and y for plotting, see minmax_decimate_indices
+
+    Args:
+        x (array_like): Numeric x values, sorted from low to high
+        y (array_like): y values, same length as x
+        num_bins (int): How many bins to split the x range into, usually the axis width in pixels
+
+    Returns:
+        x_decimated (np.ndarray): The x values we kept
+
+        **y_decimated** (np.ndarray): The matching y values
+    """
+    idx = minmax_decimate_indices(x, y, num_bins)
+    return np.asarray(x)[idx], np.asarray(y)[idx]
@@ -1,5 +1,4 @@
 import numpy as np
-import pandas as pd
 import csv
 
 ###################################### HELPER FUNCTIONS ######################################
@@ -55,6 +54,8 @@ def epoch_to_pacific_time(time, y_data=None):
         # If y_data is an array of arrays, apply the mask to each sub-array
         else:
             y_data = [np.array(y)[nan_mask] for y in y_data]
+    # pandas takes a while to import, so only pull it in when we actually need it (the GUI imports this module at start-up)
+    import pandas as pd
     # Convert t to datetime, specifying that it's in seconds
     t_datetime = pd.to_datetime(time, unit='s')
     # Current timezone is UTC
@@ -97,5 +98,14 @@ def overwrite_csv_dict(filepath:str, data:dict):
         writer.writerow(data)
 
 def append_csv_list(filepath:str, data:list):
-    pass
+    """Appends a single row to the end of a csv. Opens and closes the file every time, so for anything that 
+    happens more than once in a while, use main_pipeline.writer.Writer instead
+
+    Args:
+        filepath (str): Path to the csv
+        data (list): The row to add
+    """
+    with open(filepath, 'a', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(data)
         
\ No newline at end of file
@@ -1,21 +1,42 @@
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from collections import deque
 import time
+import numpy as np
 import matplotlib.pyplot as plt
 
 try:
-    from pyqt_helpers.helpers import epoch_to_pacific_time
+    from pyqt_helpers.decimation import minmax_decimate_indices
+    from pyqt_helpers.time_axis import set_time_axis
 except ModuleNotFoundError:
-    from helpers import epoch_to_pacific_time
+    from decimation import minmax_decimate_indices
+    from time_axis import set_time_axis
 
 ## --------------------- PLOTTING --------------------- ##
 class MyFigureCanvas(FigureCanvas):
-    """This is the FigureCanvas in which a live plot is drawn."""
-    def __init__(self, x_init:deque, y_init:deque, xlabels:list, ylabels:list, num_subplots=1, x_range=60, axis_titles=None) -> None:
+    """This is the FigureCanvas in which a live plot is drawn.
+
+    The x-data is plain epoch seconds (UTC) - we never convert it to datetimes. Instead, the x-axis ticks and labels
+    are in Pacific time (see time_axis.py), so only the handful of tick labels ever get converted.
+    
+    With blit=True, each subplot keeps one persistent line that gets new data with set_data(). We cache the background 
+    of each axis (everything except the line) after a full draw, so an update only has to paste that background back, 
+    draw the line on top, and repaint that one axis. The x-axis extends a bit past the current time and only jumps forward 
+    ("rolls over") once the data reaches the right edge - that, a resize, or data falling outside the y-limits are the
+    only times we pay for a full redraw. Blitting repaints the widget directly, so update_canvas() has to be called from
+    the GUI thread in this mode.
+
+    With decimate=True, we hang onto the full data but only hand the lines the points that matter at the current zoom:
+    the first/min/max/last point in each pixel column of the visible x range (see decimation.py). Zooming or panning 
+    with the NavigationToolbar recomputes it, so zooming in brings back the full detail.
+    """
+    def __init__(self, x_init:deque, y_init:deque, xlabels:list, ylabels:list, num_subplots=1, x_range=60, axis_titles=None, blit=False, x_headroom=0.2, decimate=False) -> None:
         """
-        :param x_init:          Initial x-data
+        :param x_init:          Initial x-data, in epoch seconds
         :param y_init:          Initial y-data
         :param x_range:         How much data we show on the x-axis, in x-axis units
+        :param blit:            Whether to redraw incrementally (see the class docstring)
+        :param x_headroom:      In blit mode, how far past the current time the x-axis extends, as a fraction of x_range
+        :param decimate:        Whether to decimate the data to the axis resolution (see the class docstring)
 
         """
         super().__init__(plt.Figure())
@@ -25,19 +46,39 @@ class MyFigureCanvas(FigureCanvas):
         self.y_data = y_init
         self.x_range = x_range
         self.num_subplots = num_subplots
+        self.blit_enabled = blit
+        self.x_headroom = x_headroom
+        self.decimate = decimate
+        # Float version of each subplot's x-data, which is what decimation bins on
+        self._x_keys = [np.asarray(x, dtype=float) for x in x_init] if decimate else None
 
         # Generate the number of subplots requested
         self.figure.subplots(num_subplots, 1)
         self.axs = self.figure.get_axes()
 
-        # Initialize each axis with the provided axes names and initial data
+        # Initialize each axis with the provided axes names and initial data. Hang onto the lines so we can update them 
+        # in place later. In blit mode they're "animated", meaning a full draw leaves them out of the cached background
+        self.lines = []
         for i, ax in enumerate(self.axs):
-            ax.plot(x_init[i], y_init[i], '.--')
+            line, = ax.plot(*self._get_line_data(i, ax), '.--', animated=blit)
+            self.lines.append(line)
+            set_time_axis(ax)
             ax.set_xlabel(xlabels[i])
             ax.set_ylabel(ylabels[i])
             if axis_titles is not None:
                 ax.set_title(axis_titles[i])
 
+        # Epoch time of the current right edge of the x-axis, in blit mode
+        self._x_max_epoch = None
+        # Cached axis backgrounds, refreshed after every full draw (which includes resizes)
+        self._backgrounds = None
+        if blit:
+            self.mpl_connect("draw_event", self._on_draw)
+        # Re-decimate whenever the visible x range changes (zooming, panning, or the live x-axis rolling over)
+        if decimate:
+            for ax in self.axs:
+                ax.callbacks.connect("xlim_changed", self._on_xlim_changed)
+
         # Set a figure size
         self.figure.set_figheight(4*num_subplots)
         self.figure.tight_layout()
@@ -56,25 +97,93 @@ class MyFigureCanvas(FigureCanvas):
         else:
             self.y_data = y_new
 
+        if self.decimate and x_new is not None:
+            self._x_keys = [np.asarray(x, dtype=float) for x in self.x_data]
+
     def update_canvas(self) -> None:
         """Method to update the plots based on the buffers stored in self.x_data and self.y_data"""
-        # Loop through the number of subplots in this figure
-        for i, ax in enumerate(self.axs):
-            # Clear the figure without resetting the axis bounds or ticks
-            for artist in ax.lines:
-                artist.remove()
-            # Plot the updated data
-            ax.plot(self.x_data[i], self.y_data[i], '.--')
+        # Update each persistent line with the newest data
+        for i, (ax, line) in enumerate(zip(self.axs, self.lines)):
+            line.set_data(*self._get_line_data(i, ax, ax.get_xlim()))
+
+        if self.blit_enabled:
+            self._blit_canvas()
+        else:
             # Make sure we aren't either plotting offscreen or letting the x axis get too long
-            # We can't do math directly with Timestamp objects, so do the math in epoch time and then convert
             current_time = time.time()
-            desired_x_min = current_time - self.x_range
-            current_time_datetime, _ = epoch_to_pacific_time(current_time)
-            x_min_datetime, _ = epoch_to_pacific_time(desired_x_min)
-            # Set the limits
-            ax.set_xlim([x_min_datetime, current_time_datetime])
-        # Finally, update the plot
-        self.draw()
+            for ax in self.axs:
+                ax.set_xlim([current_time - self.x_range, current_time])
+                ax.relim()
+                ax.autoscale_view(scalex=False)
+            # Finally, update the plot
+            self.draw()
+
+    def _blit_canvas(self):
+        """Redraws just the lines on top of the cached backgrounds, unless the axis limits need to change"""
+        full_redraw = self._backgrounds is None
+        # Roll the x-axis forward once the current time reaches the right edge
+        current_time = time.time()
+        if self._x_max_epoch is None or current_time > self._x_max_epoch:
+            self._x_max_epoch = current_time + self.x_range*self.x_headroom
+            for ax in self.axs:
+                ax.set_xlim([self._x_max_epoch - self.x_range - self.x_range*self.x_headroom, self._x_max_epoch])
+            full_redraw = True
+        # Expand the y-axis if the data has wandered outside it
+        for ax, line in zip(self.axs, self.lines):
+            y = np.asarray(line.get_ydata(), dtype=float)
+            y = y[np.isfinite(y)]
+            if len(y) == 0:
+                continue
+            y_low, y_high = ax.get_ylim()
+            if y.min() < y_low or y.max() > y_high:
+                ax.relim()
+                ax.autoscale_view(scalex=False)
+                full_redraw = True
+
+        if full_redraw:
+            # The draw_event callback recaches the backgrounds and draws the lines
+            self.draw()
+            return
+        for ax, line, background in zip(self.axs, self.lines, self._backgrounds):
+            self.restore_region(background)
+            ax.draw_artist(line)
+            self.blit(ax.bbox)
+
+    def _get_line_data(self, i, ax, xlim=None):
+        """Method to get the data a subplot's line should show - all of it, or the decimated version if decimation is on
+
+        Args:
+            i (int): Subplot index
+            ax (Axes): The subplot's axis, used to get its width in pixels
+            xlim (tuple, optional): Visible x range in axis units. Defaults to None (the whole data range).
+
+        Returns:
+            x (array_like): x-data for the line
+
+            **y** (array_like): y-data for the line
+        """
+        x, y = self.x_data[i], self.y_data[i]
+        if not self.decimate:
+            return x, y
+        keys = self._x_keys[i]
+        # Only decimate what's on screen, plus one point on either side so the line runs off the edges
+        lo, hi = 0, len(keys)
+        if xlim is not None and len(keys) > 0:
+            lo = max(np.searchsorted(keys, min(xlim), side="left") - 1, 0)
+            hi = min(np.searchsorted(keys, max(xlim), side="right") + 1, len(keys))
+        idx = minmax_decimate_indices(keys[lo:hi], np.asarray(y, dtype=float)[lo:hi], ax.bbox.width) + lo
+        return keys[idx], np.asarray(y)[idx]
+
+    def _on_xlim_changed(self, ax):
+        """Callback for whenever an axis' x-limits change - re-decimates that axis' line for the new view"""
+        i = self.axs.index(ax)
+        self.lines[i].set_data(*self._get_line_data(i, ax, ax.get_xlim()))
+
+    def _on_draw(self, event):
+        """Callback for every full draw - grabs fresh copies of the axis backgrounds and draws the lines on top of them"""
+        self._backgrounds = [self.copy_from_bbox(ax.bbox) for ax in self.axs]
+        for ax, line in zip(self.axs, self.lines):
+            ax.draw_artist(line)
 
 if __name__ == "__main__":
     import sys
@@ -86,7 +195,7 @@ if __name__ == "__main__":
     widget = QWidget()
     layout = QVBoxLayout()
 
-    x = deque([0, 1, 2, 3, 4])
+    x = deque(time.time() + np.arange(5))
     y = deque(np.random.randint(-5, 5, size=len(x)))
     plot = MyFigureCanvas([x], [y], ["x axis"], ["y axis"], num_subplots=1)
 
@@ -0,0 +1,76 @@
+import sys
+from PyQt5 import QtWidgets, QtCore
+from PyQt5.QtGui import *
+
+
+## --------------------- PIPELINE METRICS DISPLAY --------------------- ##
+class MetricsWidget(QtWidgets.QPlainTextEdit):
+    """Read-only box that shows a live summary of the pipeline metrics: p50/p95/max time for each stage, plus the
+    counters and gauges. Refreshes itself off a QTimer, and only ever touches the metrics from the GUI thread."""
+    def __init__(self, metrics, refresh_s:float=2.0, parent:QtWidgets.QWidget=None):
+        """
+        Args:
+            metrics (Metrics): The metrics to show, usually main_pipeline.metrics.metrics
+            refresh_s (float, optional): How often to refresh, in seconds. Defaults to 2.0.
+            parent (QtWidgets.QWidget, optional): Parent widget. Defaults to None.
+        """
+        super().__init__(parent)
+        self.metrics = metrics
+        self.setReadOnly(True)
+        self.setFont(QFont("Courier", 9))
+        self.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.refresh_ms = int(refresh_s*1000)
+
+    def start(self):
+        self.refresh()
+        self.timer.start(self.refresh_ms)
+
+    def stop(self):
+        self.timer.stop()
+
+    @staticmethod
+    def format_time(seconds):
+        if seconds is None:
+            return "--"
+        if seconds < 1e-3:
+            return f"{seconds*1e6:.0f}us"
+        if seconds < 1:
+            return f"{seconds*1e3:.1f}ms"
+        return f"{seconds:.2f}s"
+
+    def refresh(self):
+        if not self.metrics.enabled:
+            self.setPlainText("Pipeline metrics are off (see config/diagnostics.yaml)")
+            return
+        snapshot = self.metrics.snapshot()
+        lines = [f"{'stage':<34}{'count':>8}{'p50':>9}{'p95':>9}{'max':>9}"]
+        for stage, stats in snapshot["stages"].items():
+            lines.append(f"{stage[:33]:<34}{stats['count']:>8}" +
+                         "".join(f"{self.format_time(stats[key]):>9}" for key in ("p50", "p95", "max")))
+        for name, value in list(snapshot["counters"].items()) + list(snapshot["gauges"].items()):
+            lines.append(f"{name[:51]:<52}{'--' if value is None else value:>17}")
+        # Keep the scroll position, so the user can read further down without getting bounced back up every refresh
+        scroll = self.verticalScrollBar().value()
+        self.setPlainText("\n".join(lines))
+        self.verticalScrollBar().setValue(scroll)
+
+
+if __name__ == "__main__":
+    import time
+    sys.path.append(".")
+    from main_pipeline.metrics import Metrics
+
+    app = QtWidgets.QApplication(sys.argv)
+    metrics = Metrics(enabled=True)
+    for i in range(1000):
+        metrics.record("Dummy stage", 0.001*(1 + i % 10))
+    metrics.incr("Dummy overruns", 3)
+    metrics.add_gauge("Seconds since epoch", lambda: int(time.time()))
+
+    widget = MetricsWidget(metrics, refresh_s=1)
+    widget.start()
+    widget.show()
+    sys.exit(app.exec_())
@@ -0,0 +1,101 @@
+import numpy as np
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from matplotlib.ticker import Formatter, Locator
+
+## --------------------- TIME AXES --------------------- ##
+# The plots keep their x-data as plain epoch seconds (UTC). Converting every timestamp into a timezone-aware datetime on
+# every plot update is slow and pointless - only the handful of tick labels ever need to be shown in local time. So
+# instead, these tick the axis at nice round local times and label the ticks in Pacific time.
+#
+# The UTC offset only ever changes on the hour (daylight saving switches at 2 AM local time, which is on a UTC hour
+# too), so we look it up once per UTC hour and cache it. That keeps the labels right on either side of a DST switch.
+
+TIMEZONE = ZoneInfo("America/Los_Angeles")
+
+class TimezoneOffsets():
+    """Caches the UTC offset of a timezone for each hour, so we only ask the timezone database once per hour"""
+    def __init__(self, tz=TIMEZONE):
+        self.tz = tz
+        self._cache = {}    # {hours since epoch: offset in seconds}
+
+    def offset(self, t:float):
+        """Returns the UTC offset (in seconds) of the timezone at epoch time t"""
+        hour = int(t // 3600)
+        try:
+            return self._cache[hour]
+        except KeyError:
+            offset = datetime.fromtimestamp(hour*3600, self.tz).utcoffset().total_seconds()
+            self._cache[hour] = offset
+            return offset
+
+# One shared cache - the offsets are the same for every plot
+pacific_offsets = TimezoneOffsets()
+
+class PacificTimeLocator(Locator):
+    """Puts ticks on an epoch-seconds axis at round Pacific times (every 10 s, 5 min, 1 hour, etc.), picking the step
+    so we get at most max_ticks ticks"""
+    # Tick spacings we're happy with, in seconds
+    steps = [1, 2, 5, 10, 15, 30, 60, 2*60, 5*60, 10*60, 15*60, 30*60,
+             3600, 2*3600, 3*3600, 6*3600, 12*3600, 86400]
+
+    def __init__(self, max_ticks:int=7, offsets:TimezoneOffsets=pacific_offsets):
+        self.max_ticks = max_ticks
+        self.offsets = offsets
+
+    def __call__(self):
+        vmin, vmax = self.axis.get_view_interval()
+        return self.tick_values(vmin, vmax)
+
+    def tick_values(self, vmin, vmax):
+        if not (np.isfinite(vmin) and np.isfinite(vmax)) or vmax <= vmin:
+            return []
+        span = vmax - vmin
+        step = next((step for step in self.steps if span/step <= self.max_ticks), None)
+        if step is None:
+            # More than a week on screen, tick every however many days it takes
+            step = 86400*np.ceil(span / (86400*self.max_ticks))
+        # Round the first tick up to a multiple of the step in local time, then shift back to UTC
+        offset = self.offsets.offset(vmin)
+        first = np.ceil((vmin + offset) / step)*step - offset
+        return np.arange(first, vmax + 1e-9*step, step)
+
+class PacificTimeFormatter(Formatter):
+    """Labels an epoch-seconds axis in Pacific time. Shows seconds when zoomed in, and the date when zoomed way out"""
+    def __init__(self, offsets:TimezoneOffsets=pacific_offsets):
+        self.offsets = offsets
+
+    def _to_datetime(self, x):
+        # Shifting by the cached offset and formatting as UTC is the same as converting to Pacific time, minus the
+        # timezone database lookup
+        return datetime.fromtimestamp(x + self.offsets.offset(x), timezone.utc)
+
+    def __call__(self, x, pos=None):
+        if not np.isfinite(x):
+            return ""
+        span = 0
+        if self.axis is not None:
+            vmin, vmax = self.axis.get_view_interval()
+            span = abs(vmax - vmin)
+        if span > 2*86400:
+            fmt = "%m-%d %H:%M"
+        elif span > 30*60:
+            fmt = "%H:%M"
+        else:
+            fmt = "%H:%M:%S"
+        try:
+            return self._to_datetime(x).strftime(fmt)
+        except (OverflowError, OSError, ValueError):
+            return ""
+
+    def format_data_short(self, value):
+        """What the NavigationToolbar shows for the cursor position"""
+        try:
+            return self._to_datetime(value).strftime("%Y-%m-%d %H:%M:%S")
+        except (OverflowError, OSError, ValueError):
+            return ""
+
+def set_time_axis(ax):
+    """Sets up an axis whose x-data is epoch seconds to show Pacific time"""
+    ax.xaxis.set_major_locator(PacificTimeLocator())
+    ax.xaxis.set_major_formatter(PacificTimeFormatter())
@@ -1,59 +1,88 @@
 # Communicates with Arduino
+#
+# All the serial traffic goes through a SerialTransport (see serial_transport.py), which reads the port on its own thread.
+# Commands don't wait on the Arduino's reply - send_command() hands back a Future for it - so toggling a bunch of valves
+# doesn't block for a round-trip on each one. Sensor readings come back as binary frames (see binary_protocol.py).
+#
+# In streaming mode the Arduino sends samples continuously on its own schedule, each stamped with its microsecond 
+# counter. ClockSync (see clock_sync.py) maps those onto epoch time, so the timestamps are when the sample was taken 
+# rather than whenever our threads got around to reading it.
 
+import time
+from functools import partial
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import numpy as np
 import serial
 import yaml
 from serial import SerialException
 
+try:
+    from sensor_interfaces.serial_transport import SerialTransport
+    from sensor_interfaces.clock_sync import ClockSync
+except ImportError:
+    from serial_transport import SerialTransport
+    from clock_sync import ClockSync
+
 import logging
 from logdecorator import log_on_start , log_on_end , log_on_error
-# Set up a logger for this module
-logger = logging.getLogger(__name__)
-# Set the lowest-severity log message the logger will handle (debug = lowest, critical = highest)
-logger.setLevel(logging.DEBUG)
-# Create a handler that saves logs to the log folder named as the current date
-# fh = logging.FileHandler(f"logs\\{time.strftime('%Y-%m-%d', time.localtime())}.log")
-fh = logging.StreamHandler()
-fh.setLevel(logging.DEBUG)
-logger.addHandler(fh)
-# Create a formatter to specify our log format
-formatter = logging.Formatter("%(levelname)s: %(asctime)s - %(name)s:  %(message)s", datefmt="%H:%M:%S")
-fh.setFormatter(formatter)
+from app_logging import get_logger
+logger = get_logger(__name__)
 
 class ArduinoInterface():
 
-    def __init__(self, serial_port, baud_rate, custom_logger=None):
+    def __init__(self, serial_port, baud_rate, custom_logger=None, num_channels=1):
         
         if custom_logger is not None:
             self.logger = custom_logger
         else:
             self.logger = logger
         
-        self.initialize_pyserial(serial_port, baud_rate)
-
         # Different serial command characters
         self.start_character = "<"
         self.end_character = ">"
         # self.one_thing = "1"
         # self.another_thing = "2"
+        # Batch pin commands carry one bit per pin (0-71) as this many hex digits
+        self.mask_digits = 18
+        # How many analog channels we ask for in each reading
+        self.num_channels = num_channels
+        # Streaming mode
+        self.streaming = False
+        self.clock_sync = ClockSync()
+
+        self.ser = None
+        self.transport = None
+        self.initialize_pyserial(serial_port, baud_rate)
 
     def initialize_pyserial(self, port, baud):
         """
         Method to open the serial port at the specified baud. Also specifies a timeout to prevent infinite blocking.
         These values (except for timeout) MUST match the instrument. Typing "mode" in the Windows Command Prompt 
         gives information about serial ports, but sometimes the baud is wrong, so beware. Check sensor documentation.
+        The timeout is short because it only sets how often the transport's reader thread checks in - replies are
+        waited on with their own timeout.
         Inputs - port (str, serial port), baud (int, baud rate)
         """
         try:
-            self.ser = serial.Serial(port, baud, timeout=1)
+            self.ser = serial.Serial(port, baud, timeout=0.05)
             logger.info(f"Connected to serial port {port} with baud {baud}")
             self.ser.flush()
             self.ser.reset_input_buffer()
-            self.ser.readline()
-            self.ser.readline()
+            self.transport = SerialTransport(self.ser, self.start_character, self.end_character, custom_logger=self.logger)
+            self.transport.start()
         except SerialException:
             logger.warning(f"Could not connect to serial port {port}")
 
+    def close_pyserial(self):
+        """Method to stop the transport and close the serial port, e.g so another program can use it"""
+        if self.streaming:
+            self.stop_streaming()
+        if self.transport is not None:
+            self.transport.stop()
+            self.transport = None
+        if self.ser is not None:
+            self.ser.close()
+
     @log_on_start(logging.INFO, "Initializing Arduino", logger=logger)
     def initialize_arduino(self, timeout=10):
         """
@@ -69,7 +98,7 @@ class ArduinoInterface():
                 timestamp, data_out = self.query()
             
                 # Validity check
-                if data_out:
+                if data_out is not None:
                     logger.info("Arduino initialized")
                     return 1
 
@@ -82,32 +111,98 @@ class ArduinoInterface():
     @log_on_end(logging.INFO, "Arduino shut down", logger=logger)
     def shutdown_arduino(self):
         # Do whatever we need to do to turn off the sensors properly
-        self.ser.close()
+        self.close_pyserial()
         return 0
     
-    @log_on_start(logging.INFO, "Querying arduino", logger=logger)
-    def query(self):
-        get_data = self.ser.readline()
-        data_string = get_data.decode('utf-8')
-        # data_string = get_data
+    @log_on_start(logging.DEBUG, "Querying arduino", logger=logger)
+    def query(self, timeout=1):
+        """
+        Asks the Arduino for a reading of its analog channels and waits up to timeout seconds for it. The reading comes back 
+        as a binary frame, so it's already numbers by the time we get it - and a garbled frame fails its CRC check and gets 
+        thrown out rather than turning into a wrong number.
+
+        Returns - (timestamp, data), data is a np.ndarray with one value per channel, or None if no reading came in
+        """
+        timestamp = time.time()
+        data = None
+        if self.transport is not None:
+            # The transport matches the reading to this request by its tag, so a late reading from an earlier query
+            # that timed out never gets handed back as this one
+            future = self.transport.request_reading(self.num_channels, timeout=timeout)
+            try:
+                timestamp, seq, values = future.result(timeout + 0.5)
+                data = np.array(values, dtype=float)
+            except (TimeoutError, FutureTimeoutError, ConnectionError) as e:
+                self.logger.warning(f"No reading from the Arduino: {e}")
+
+        self.logger.info(f"Result from querying arduino: {data}")
+
+        return timestamp, data
+
+    @log_on_start(logging.INFO, "Starting Arduino streaming at {rate_hz} Hz", logger=logger)
+    def start_streaming(self, rate_hz):
+        """
+        Tells the Arduino to start sending samples of its analog channels rate_hz times a second, each stamped with its
+        own microsecond counter. Pick them up with read_samples().
+        Inputs - rate_hz (int, samples per second, 1-1000)
+        """
+        if self.transport is None:
+            logger.warning("Arduino serial port isn't open, couldn't start streaming")
+            return
+        # The Arduino's counter starts over whenever it restarts, so start the clock fit over too
+        self.clock_sync.reset()
+        self.transport.samples.clear()
+        self.transport.send(f"04;{int(rate_hz)};{self.num_channels:02d}")
+        self.streaming = True
 
-        self.logger.info(f"Result from querying arduino: {data_string}")
+    @log_on_start(logging.INFO, "Stopping Arduino streaming", logger=logger)
+    def stop_streaming(self):
+        if self.transport is not None:
+            self.transport.send("04;0")
+        self.streaming = False
 
-        return data_string
+    def read_samples(self):
+        """
+        Grabs every streamed sample that's come in since we last asked, with timestamps from the Arduino's own clock
+        (mapped onto epoch time by self.clock_sync). Doesn't wait.
+        Returns - (timestamps, data): np.ndarray of epoch times, and np.ndarray with one row per sample and one column
+        per channel. Both are empty if nothing came in
+        """
+        samples = self.transport.read_samples() if self.transport is not None else []
+        timestamps = np.empty(len(samples))
+        data = np.empty((len(samples), self.num_channels))
+        for i, (arrival_time, tick, values) in enumerate(samples):
+            timestamps[i] = self.clock_sync.update(tick, arrival_time)
+            data[i] = values
+        return timestamps, data
     
     def validate_command(self, command):
         return True
 
-    def send_command(self, command):
+    def send_command(self, command, timeout=1):
+        """
+        Sends a command to the Arduino without waiting for its reply. The reply gets logged whenever it comes in.
+        Inputs - command (str, without the start/end characters), timeout (float, how long to wait for the reply in seconds)
+        Returns - Future that resolves to the Arduino's reply (str), or None if the command wasn't sent
+        """
         command_valid = self.validate_command(command)
-        if command_valid:
-            msg_str = self.start_character+command+self.end_character
-            logger.debug(f"Sending command to Arduino: {msg_str}")
-            self.ser.write(str(msg_str).encode())
-            self.query()
-            
-        else:
+        if not command_valid:
             logger.debug(f"Invalid Arduino command: {command}")
+            return None
+        if self.transport is None:
+            logger.warning(f"Arduino serial port isn't open, couldn't send command {command}")
+            return None
+
+        logger.debug(f"Sending command to Arduino: {self.start_character+command+self.end_character}")
+        future = self.transport.request(command, timeout=timeout)
+        future.add_done_callback(partial(self._log_reply, command))
+        return future
+
+    def _log_reply(self, command, future):
+        try:
+            self.logger.debug(f"Arduino reply to {command}: {future.result()}")
+        except Exception as e:
+            self.logger.warning(f"No reply from Arduino to {command}: {e}")
 
     def validate_and_format_pin(self, pin):
         try:
@@ -133,15 +228,48 @@ class ArduinoInterface():
         if pin:
             # logger.info(f"Setting pin {pin} high")
             msg_str = "01;"+pin
-            self.send_command(msg_str)
+            return self.send_command(msg_str)
 
     def set_pin_low(self, pin):
         pin = self.validate_and_format_pin(pin)
         if pin:
             # logger.info(f"Setting pin {pin} low")
             msg_str = "00;"+pin
-            self.send_command(msg_str)
+            return self.send_command(msg_str)
+
+    def format_batch_command(self, pin_states):
+        """
+        Builds a batch pin command: "02;MASK;STATES", where MASK has a 1 bit for every pin we're setting and STATES has a 1 
+        bit for every one of those pins that should go high (bit n = pin n), each as a fixed-width hex number.
+        Inputs - pin_states (dict, {pin: state}, state is anything truthy for high)
+        Returns - command (str), or False if any of the pins are invalid
+        """
+        mask = 0
+        states = 0
+        for pin, state in pin_states.items():
+            if not self.validate_and_format_pin(pin):
+                return False
+            mask |= 1 << int(pin)
+            if state:
+                states |= 1 << int(pin)
+        return f"02;{mask:0{self.mask_digits}X};{states:0{self.mask_digits}X}"
+
+    def set_pins(self, pin_states):
+        """
+        Sets a bunch of pins in one command, so they all switch together in a single round trip instead of one command each.
+        The Arduino replies with the command followed by the pins' actual states, e.g "02;MASK;STATES;READBACK".
+        Inputs - pin_states (dict, {pin: state}, state is anything truthy for high)
+        Returns - Future for the reply (see send_command), or None if any pin was invalid
+        """
+        msg_str = self.format_batch_command(pin_states)
+        if msg_str:
+            return self.send_command(msg_str)
+        return None
 
 
 if __name__ == "__main__":
-    myarduino = ArduinoInterface("COM4", 19200)
\ No newline at end of file
+    # Same port and baud rate the rest of the app uses (run from the top of the repo, so the config path works)
+    with open("config/sensor_comms.yaml", "r") as stream:
+        arduino_config = yaml.safe_load(stream)["Arduino"]
+    myarduino = ArduinoInterface(arduino_config["serial port"], arduino_config["baud rate"],
+                                 num_channels=arduino_config.get("analog channels", 1))
\ No newline at end of file
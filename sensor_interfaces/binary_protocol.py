@@ -0,0 +1,100 @@
+# -------------
+# Binary sensor frames
+#
+# Sensor readings come back from the Arduino as compact binary frames instead of text, so there's no float-to-text
+# overhead and a garbled or partial frame gets caught instead of silently turning into a wrong number:
+#
+#   SYNC (0xA5) | LEN (u8) | TYPE (u8) | SEQ (u16) | PAYLOAD (LEN bytes) | CRC (u16)
+#
+# Everything is little-endian. For readings, PAYLOAD is the tag of the request it answers (u16, sent in the "03;NN;TAG"
+# command) followed by one float32 per channel, so a late reply to an old request can't be mistaken for the answer to a
+# new one. For streamed samples, it's the device's microsecond counter (u32) followed by one float32 per channel, so we
+# know when the sample was actually taken. SEQ
+# counts up by one every frame (wrapping at 65535) so we can tell if any went missing. CRC is CRC16-CCITT (poly 0x1021,
+# starting at 0xFFFF) over everything from LEN to the end of the payload. The sync byte is never a valid text character, so binary frames can
+# share the port with the "<...>" text replies.
+# -------------
+
+import struct
+import binascii
+
+SYNC = 0xA5
+# Frame types
+TYPE_READING = 0x01
+TYPE_STREAM = 0x02
+# Payload layout of each frame type, as the struct code of everything before the float32 channels
+PAYLOAD_PREFIX = {TYPE_READING: "H", TYPE_STREAM: "I"}
+# Most channels a frame can carry (maxAnalogChannels in the firmware), so the longest payload each frame type can have
+MAX_CHANNELS = 16
+MAX_PAYLOAD = {frame_type: struct.calcsize(f"<{prefix}") + 4*MAX_CHANNELS for frame_type, prefix in PAYLOAD_PREFIX.items()}
+
+# SYNC, LEN, TYPE, SEQ
+HEADER = struct.Struct("<BBBH")
+CRC = struct.Struct("<H")
+# Smallest possible frame (no payload)
+MIN_FRAME_LENGTH = HEADER.size + CRC.size
+
+def crc16(data):
+    """CRC16-CCITT (poly 0x1021, initial value 0xFFFF) of some bytes. binascii does the work in C, and takes
+    memoryviews without copying them"""
+    return binascii.crc_hqx(data, 0xFFFF)
+
+def pack_frame(frame_type:int, seq:int, values, prefix:tuple=()):
+    """Builds a frame of float32 values
+
+    Args:
+        frame_type (int): Frame type, e.g TYPE_READING
+        seq (int): Sequence number, wrapped to 16 bits
+        values (list): Numbers to send, one float32 each
+        prefix (tuple, optional): Values that go before the floats for this frame type, e.g (tag,) for TYPE_READING or
+            (tick,) for TYPE_STREAM. Defaults to ().
+
+    Returns:
+        frame (bytes): The whole frame, sync byte to CRC
+    """
+    payload = struct.pack(f"<{PAYLOAD_PREFIX.get(frame_type, '')}{len(values)}f", *prefix, *values)
+    body = HEADER.pack(SYNC, len(payload), frame_type, seq & 0xFFFF)[1:] + payload
+    return bytes([SYNC]) + body + CRC.pack(crc16(body))
+
+def unpack_frame(buffer, offset:int=0):
+    """Tries to read one frame out of a buffer, starting at a sync byte. Reads straight out of the buffer with struct,
+    so nothing gets copied except the values themselves
+
+    Args:
+        buffer (bytes-like): Bytes from the serial port (bytes, bytearray, or memoryview)
+        offset (int, optional): Where the sync byte is. Defaults to 0.
+
+    Returns:
+        consumed (int): How many bytes the frame took up. 0 if the frame isn't all here yet, -1 if the frame is bad
+            (unknown type, too long, wrong CRC, or a payload that isn't whole float32s), in which case skip the sync byte
+            and look for the next one
+
+        **frame** (tuple): (type, seq, values tuple), or None if we didn't get a good frame. For frame types with a
+            prefix (see PAYLOAD_PREFIX), the prefix values come first in the values tuple
+    """
+    available = len(buffer) - offset
+    # Check LEN and TYPE as soon as they're here, so a stray sync byte (like reset noise) gets thrown out straight away
+    # instead of holding up whatever comes after it while we wait for a frame that's never coming
+    if available >= 2 and buffer[offset + 1] > max(MAX_PAYLOAD.values()):
+        return -1, None
+    if available >= 3:
+        frame_type = buffer[offset + 2]
+        if frame_type not in PAYLOAD_PREFIX or buffer[offset + 1] > MAX_PAYLOAD[frame_type]:
+            return -1, None
+    if available < MIN_FRAME_LENGTH:
+        return 0, None
+    _, length, frame_type, seq = HEADER.unpack_from(buffer, offset)
+    total = HEADER.size + length + CRC.size
+    if available < total:
+        return 0, None
+    with memoryview(buffer) as view:
+        body = view[offset + 1:offset + HEADER.size + length]
+        (crc,) = CRC.unpack_from(view, offset + HEADER.size + length)
+        prefix = PAYLOAD_PREFIX[frame_type]
+        num_floats, leftover = divmod(length - struct.calcsize(f"<{prefix}"), 4)
+        if crc != crc16(body) or leftover or num_floats < 0:
+            body.release()
+            return -1, None
+        values = struct.unpack_from(f"<{prefix}{num_floats}f", view, offset + HEADER.size)
+        body.release()
+    return total, (frame_type, seq, values)
@@ -0,0 +1,104 @@
+# -------------
+# Clock sync
+#
+# In streaming mode the Arduino stamps every sample with its own microsecond counter (micros()), which ticks along at
+# a steady rate no matter what the PC is doing. To turn those ticks into epoch time we need to know how the Arduino's
+# clock lines up with ours, and how fast it runs compared to ours (its crystal is only good to a few hundred ppm).
+#
+# Every sample gives us a pair: the device tick, and the host time the sample arrived. Arrival time is always the
+# true sample time plus some latency (USB, serial, thread scheduling), and that latency jitters a lot but can never be
+# negative. So:
+#   - the drift (device seconds -> host seconds) is the slope of a straight-line fit of host time vs device time over
+#     a sliding window - the jitter averages out over a long enough window
+#   - the offset is set by the sample that arrived with the least latency in the window, i.e the smallest
+#     (host time - slope * device time)
+# The counter is 32 bits, so it wraps every ~71 minutes - we unwrap it into a continuous count first.
+# -------------
+
+import numpy as np
+from collections import deque
+
+class ClockSync():
+    """Class that maps a device's tick counter onto epoch time"""
+    def __init__(self, tick_hz:float=1e6, window:int=600, refit_every:int=10, max_drift:float=1e-3) -> None:
+        """
+        Args:
+            tick_hz (float, optional): How fast the device counter ticks. Defaults to 1e6 (micros()).
+            window (int, optional): How many of the most recent (tick, host time) pairs to fit over. Defaults to 600.
+            refit_every (int, optional): Refit the drift every this many samples. Defaults to 10.
+            max_drift (float, optional): Largest clock rate error we believe, as a fraction (1e-3 = 1000 ppm). Defaults to 1e-3.
+        """
+        self.tick_hz = tick_hz
+        self.refit_every = refit_every
+        self.max_drift = max_drift
+
+        self._wraps = 0             # How many times the 32-bit counter has wrapped
+        self._last_tick = None      # Last raw tick we saw, to spot wraps
+        self._device_times = deque(maxlen=window)   # Unwrapped device time (s) of each sample in the window
+        self._host_times = deque(maxlen=window)     # Host arrival time (epoch) of each sample in the window
+        self._since_fit = 0
+
+        self.slope = 1.0    # Host seconds per device second
+        self.offset = None  # Host time when the device time was 0
+        self._origin = None # First device time we saw - we fit relative to this to keep the numbers small
+
+    def unwrap(self, tick:int):
+        """Converts a raw 32-bit tick to seconds on a counter that never wraps. Call with ticks in order
+
+        Returns:
+            device_time (float): Seconds since the counter started (or since it was last reset)
+        """
+        if self._last_tick is not None and tick < self._last_tick:
+            self._wraps += 1
+        self._last_tick = tick
+        return (self._wraps*2**32 + tick) / self.tick_hz
+
+    def update(self, tick:int, host_time:float):
+        """Adds one sample's device tick and host arrival time, and returns its corrected epoch timestamp
+
+        Args:
+            tick (int): Raw device counter value
+            host_time (float): Epoch time the sample arrived on our side
+
+        Returns:
+            timestamp (float): Best estimate of the epoch time the sample was taken
+        """
+        device_time = self.unwrap(tick)
+        if self._origin is None:
+            self._origin = device_time
+        self._device_times.append(device_time - self._origin)
+        self._host_times.append(host_time)
+
+        self._since_fit += 1
+        if self.offset is None or self._since_fit >= self.refit_every:
+            self._fit()
+        else:
+            # Between fits, keep the offset pinned to the lowest-latency sample we've seen
+            self.offset = min(self.offset, host_time - self.slope*(device_time - self._origin))
+        return self.offset + self.slope*(device_time - self._origin)
+
+    def to_epoch(self, device_times):
+        """Converts unwrapped device times (s) to epoch times with the current fit
+
+        Args:
+            device_times (array_like): Unwrapped device times, from unwrap()
+
+        Returns:
+            timestamps (np.ndarray): Epoch times
+        """
+        return self.offset + self.slope*(np.asarray(device_times, dtype=float) - self._origin)
+
+    def reset(self):
+        """Forgets everything, e.g after the device restarts and its counter goes back to 0"""
+        self.__init__(self.tick_hz, self._device_times.maxlen, self.refit_every, self.max_drift)
+
+    def _fit(self):
+        """Refits the drift and offset over the current window"""
+        self._since_fit = 0
+        device_times = np.fromiter(self._device_times, dtype=float, count=len(self._device_times))
+        host_times = np.fromiter(self._host_times, dtype=float, count=len(self._host_times))
+        # Need a decent stretch of time before the slope means anything
+        if len(device_times) >= 10 and device_times[-1] - device_times[0] > 1.0:
+            slope = np.polyfit(device_times, host_times - host_times[0], 1)[0]
+            self.slope = float(np.clip(slope, 1 - self.max_drift, 1 + self.max_drift))
+        self.offset = float(np.min(host_times - self.slope*device_times))
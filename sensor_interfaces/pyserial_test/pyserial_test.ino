@@ -1,5 +1,5 @@
 // Serial read parameters
-const byte numChars = 32; // expected maximum input length: 32 bits
+const byte numChars = 48; // expected maximum input length: 48 characters (a batch pin command is 40)
 char receivedChars[numChars];   // an array to store the received data
 boolean newData = false;  // flag to keep track of if we have new data to process or not
 
@@ -7,14 +7,37 @@ boolean newData = false;  // flag to keep track of if we have new data to proces
 // very human-readable
 #define pinLow 00
 #define pinHigh 01
+#define setPins 02
+#define readSensors 03
+#define streamSensors 04
 const char delimiter = ';';
+// Batch pin commands ("02;MASK;STATES") carry one bit per pin as a hex number this many digits long (72 pins)
+const byte maskDigits = 18;
+const byte maxPin = 69;
+
+// Sensor readings go out as binary frames: SYNC | LEN | TYPE | SEQ (2 bytes) | PAYLOAD (LEN bytes) | CRC16 (2 bytes),
+// all little-endian, with one float per channel in the payload (after the request tag for readings, or the micros()
+// timestamp for streamed samples). The CRC (CRC16-CCITT, starting at 0xFFFF) covers
+// everything from LEN to the end of the payload. See sensor_interfaces/binary_protocol.py for the Python side
+const byte frameSync = 0xA5;
+const byte frameTypeReading = 0x01;
+const byte frameTypeStream = 0x02;
+const byte maxAnalogChannels = 16;
+uint16_t frameSeq = 0;
+
+// Streaming mode: send a sample every streamInterval microseconds, stamped with micros() so the PC knows exactly when
+// it was taken
+boolean streaming = false;
+unsigned long streamInterval = 0;
+unsigned long nextSampleTime = 0;
+int streamChannels = 1;
 // Create arrays to sort out the pin and command values from the serial input
 char cmd[3];
 char mypin[3];
 
 // Make sure the serial is set up
 void setup() {
-  Serial.begin(19200);
+  Serial.begin(115200);
   while (!Serial); // Wait out until serial starts up
   delay(100);
   clearInputBuffer();
@@ -25,6 +48,11 @@ void setup() {
 void loop() {
   recvWithStartEndMarker();
   parseCommands();
+  // Subtracting (rather than comparing directly) keeps this working when micros() wraps around
+  if (streaming && (long)(micros() - nextSampleTime) >= 0){
+    nextSampleTime += streamInterval;
+    sendStreamSample();
+  }
 }
 
 // Function to accept and retain serial input
@@ -46,7 +74,7 @@ void recvWithStartEndMarker() {
         // Add the char to our data array and increase the index.
         receivedChars[ndx] = rc;
         ndx++;
-        // If we've received more than the expected 32 bits, no we haven't.
+        // If we've received more than the expected number of characters, no we haven't.
         if (ndx >= numChars) {
           ndx = numChars - 1;
         }
@@ -75,6 +103,21 @@ void parseCommands() {
   if (newData == true) {
     // Reset the new data flag
     newData = false;
+    // Batch pin and streaming commands have a different layout, so they get handled separately
+    if (atoi(receivedChars) == setPins && receivedChars[2] == delimiter){
+      setPinsBatch(receivedChars + 3);
+      return;
+    }
+    if (atoi(receivedChars) == streamSensors && receivedChars[2] == delimiter){
+      setStreaming(receivedChars + 3);
+      return;
+    }
+    // Readings are "03;CHANNELS;TAG" - the tag goes back in the reading so Python can tell which request it answers
+    if (atoi(receivedChars) == readSensors && receivedChars[2] == delimiter){
+      char* tag = strchr(receivedChars + 3, delimiter);
+      sendReading(atoi(receivedChars + 3), tag ? (uint16_t)atol(tag + 1) : 0);
+      return;
+    }
     // Create indices for our command and pin arrays
     int cIdx = 0;
     int pIdx = 0;
@@ -114,7 +157,8 @@ void parseCommands() {
     // Serial.print("pin ");
     // Serial.println(mypin);
     
-    // Manage the serial input accordingly
+    // Manage the serial input accordingly. Every command gets exactly one framed reply that starts with the command
+    // itself, so Python can match replies to commands even with several commands in flight
     if (pinResult <= 69){
       if (cmdResult == pinLow){
         setPinLow(pinResult);
@@ -122,12 +166,16 @@ void parseCommands() {
       else if (cmdResult == pinHigh){
         setPinHigh(pinResult);
       }
+      else if (cmdResult == readSensors){
+        // For this command the "pin" is how many analog channels to read
+        sendReading(pinResult, 0);
+      }
       else{
-        Serial.println("Unknown command received");
+        sendReply("ERR unknown command");
       }
     }
     else{
-      Serial.println("Invalid pin received");
+      sendReply("ERR invalid pin");
     }
   }
 
@@ -136,19 +184,136 @@ void parseCommands() {
 void setPinLow(int pin){
   pinMode(pin, OUTPUT);
   digitalWrite(pin, LOW);
-  Serial.print("Pin ");
-  Serial.print(pin);
-  Serial.print(" set ");
-  Serial.println(digitalRead(pin));
+  sendReply(digitalRead(pin) ? "1" : "0");
 }
 
 void setPinHigh(int pin){
   pinMode(pin, OUTPUT);
   digitalWrite(pin, HIGH);
-  Serial.print("Pin ");
-  Serial.print(pin);
-  Serial.print(" set ");
-  Serial.println(digitalRead(pin));
+  sendReply(digitalRead(pin) ? "1" : "0");
+}
+
+// Set a batch of pins at once. args is "MASK;STATES": two hex numbers, maskDigits long, where bit n is pin n. Every pin
+// with its MASK bit set goes to its STATES bit. Replies with the actual states of those pins, in the same format
+void setPinsBatch(char* args){
+  if (strlen(args) != 2*maskDigits + 1 || args[maskDigits] != delimiter){
+    sendReply("ERR bad batch command");
+    return;
+  }
+  char readback[maskDigits + 1];
+  // Each hex digit covers 4 pins. The first digit is the most significant, so it covers the highest pins
+  for (byte i = 0; i < maskDigits; i++){
+    byte maskNibble = hexValue(args[i]);
+    byte stateNibble = hexValue(args[maskDigits + 1 + i]);
+    byte readNibble = 0;
+    for (byte b = 0; b < 4; b++){
+      int pin = (maskDigits - 1 - i)*4 + b;
+      // Pins 0 and 1 are the serial port itself, so never touch those
+      if (pin < 2 || pin > maxPin || !(maskNibble & (1 << b))){
+        continue;
+      }
+      pinMode(pin, OUTPUT);
+      digitalWrite(pin, (stateNibble & (1 << b)) ? HIGH : LOW);
+      if (digitalRead(pin)){
+        readNibble |= (1 << b);
+      }
+    }
+    readback[i] = "0123456789ABCDEF"[readNibble];
+  }
+  readback[maskDigits] = '\0';
+  sendReply(readback);
+}
+
+// Read the first numChannels analog inputs and send them (in volts) as one binary frame, starting with the tag of the
+// request they answer. No text reply for this one
+void sendReading(int numChannels, uint16_t tag){
+  if (numChannels < 1) numChannels = 1;
+  if (numChannels > maxAnalogChannels) numChannels = maxAnalogChannels;
+  byte frame[5 + 2 + 4*maxAnalogChannels + 2];
+  byte length = 2 + 4*numChannels;
+  frame[0] = frameSync;
+  frame[1] = length;
+  frame[2] = frameTypeReading;
+  frame[3] = frameSeq & 0xFF;
+  frame[4] = frameSeq >> 8;
+  frame[5] = tag & 0xFF;
+  frame[6] = tag >> 8;
+  for (int i = 0; i < numChannels; i++){
+    float volts = analogRead(A0 + i) * (5.0 / 1023.0);
+    // AVR floats are already little-endian IEEE 754, so just copy the bytes in
+    memcpy(&frame[7 + 4*i], &volts, 4);
+  }
+  uint16_t crc = crc16(&frame[1], 4 + length);
+  frame[5 + length] = crc & 0xFF;
+  frame[6 + length] = crc >> 8;
+  Serial.write(frame, 7 + length);
+  frameSeq++;
+}
+
+// Start or stop streaming. args is "RATE;CHANNELS" (samples per second, number of analog channels), or "0" to stop
+void setStreaming(char* args){
+  int rate = atoi(args);
+  char* channels = strchr(args, delimiter);
+  if (rate <= 0 || rate > 1000){
+    streaming = false;
+    return;
+  }
+  streamChannels = channels ? atoi(channels + 1) : 1;
+  if (streamChannels < 1) streamChannels = 1;
+  if (streamChannels > maxAnalogChannels) streamChannels = maxAnalogChannels;
+  streamInterval = 1000000UL / rate;
+  nextSampleTime = micros();
+  streaming = true;
+}
+
+// Read the analog channels and send them as a stream frame: the micros() timestamp, then one float per channel
+void sendStreamSample(){
+  byte frame[5 + 4 + 4*maxAnalogChannels + 2];
+  byte length = 4 + 4*streamChannels;
+  unsigned long tick = micros();
+  frame[0] = frameSync;
+  frame[1] = length;
+  frame[2] = frameTypeStream;
+  frame[3] = frameSeq & 0xFF;
+  frame[4] = frameSeq >> 8;
+  memcpy(&frame[5], &tick, 4);
+  for (int i = 0; i < streamChannels; i++){
+    float volts = analogRead(A0 + i) * (5.0 / 1023.0);
+    memcpy(&frame[9 + 4*i], &volts, 4);
+  }
+  uint16_t crc = crc16(&frame[1], 4 + length);
+  frame[5 + length] = crc & 0xFF;
+  frame[6 + length] = crc >> 8;
+  Serial.write(frame, 7 + length);
+  frameSeq++;
+}
+
+// CRC16-CCITT (poly 0x1021, starting at 0xFFFF), same as binascii.crc_hqx(data, 0xFFFF) in Python
+uint16_t crc16(const byte* data, int length){
+  uint16_t crc = 0xFFFF;
+  for (int i = 0; i < length; i++){
+    crc ^= (uint16_t)data[i] << 8;
+    for (byte b = 0; b < 8; b++){
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+byte hexValue(char c){
+  if (c >= '0' && c <= '9') return c - '0';
+  if (c >= 'A' && c <= 'F') return c - 'A' + 10;
+  if (c >= 'a' && c <= 'f') return c - 'a' + 10;
+  return 0;
+}
+
+// Reply to the command we just handled as "<command;result>", e.g "<01;05;1>" after setting pin 5 high
+void sendReply(const char* result){
+  Serial.print('<');
+  Serial.print(receivedChars);
+  Serial.print(';');
+  Serial.print(result);
+  Serial.println('>');
 }
 
 void clearInputBuffer() {
@@ -0,0 +1,357 @@
+# -------------
+# Serial transport
+#
+# Owns a serial port and reads from it on a dedicated thread, so nobody else ever has to block on readline(). Incoming
+# bytes get split up incrementally into framed messages ("<...>"), binary sensor frames (see binary_protocol.py), and
+# plain text lines (anything outside a frame, like the Arduino's start-up message).
+#
+# Every command we send gets a Future. The device echoes the command at the start of its reply (e.g we send "<01;05>",
+# it replies "<01;05;1>"), so when a frame comes in we hand it to the oldest in-flight command it matches. Several
+# commands can be in flight at once ("pipelining") - we don't wait for one reply before sending the next command, we
+# just cap how many we let pile up so we don't overrun the device's input buffer. Commands that never get a reply time
+# out instead of wedging everything behind them. Binary readings work the same way, except the device can't echo the
+# command in a binary frame, so each reading request carries a tag that comes back in the reading instead.
+# -------------
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+try:
+    from sensor_interfaces import binary_protocol
+except ImportError:
+    import binary_protocol
+
+import logging
+from logdecorator import log_on_start , log_on_end , log_on_error
+from app_logging import get_logger
+logger = get_logger(__name__)
+
+class FrameParser():
+    """Splits a stream of bytes into "<...>" frames, binary frames, and plain text lines, however the bytes happen to be
+    chunked up"""
+    def __init__(self, start:bytes=b"<", end:bytes=b">", max_length:int=256) -> None:
+        """
+        Args:
+            start (bytes, optional): Start of frame marker. Defaults to b"<".
+            end (bytes, optional): End of frame marker. Defaults to b">".
+            max_length (int, optional): Longest frame or line we'll hold onto - anything longer is junk and gets thrown out. Defaults to 256.
+        """
+        self.start = start[0]
+        self.end = end[0]
+        self.max_length = max_length
+        self._buffer = bytearray()  # Bytes we haven't finished with yet
+        self._frame = None          # Bytes of the text frame we're partway through, None if we're not in a frame
+        self._line = bytearray()    # Bytes of the text line we're partway through
+        self.crc_errors = 0         # Binary frames we threw out because they were garbled
+
+    def feed(self, data:bytes):
+        """Adds some bytes and returns whatever complete messages they finish off
+
+        Args:
+            data (bytes): Bytes read from the serial port
+
+        Returns:
+            messages (list): List of ("frame", str), ("line", str), or ("binary", (type, seq, values)) tuples, in the
+                order they arrived
+        """
+        messages = []
+        buffer = self._buffer
+        buffer += data
+        i = 0
+        while i < len(buffer):
+            byte = buffer[i]
+            if self._frame is None and byte == binary_protocol.SYNC:
+                consumed, frame = binary_protocol.unpack_frame(buffer, i)
+                if consumed == 0:
+                    # The rest of the frame hasn't arrived yet - hang onto it for next time
+                    break
+                if consumed < 0:
+                    # Garbled frame (or a stray sync byte) - skip it and look for the next sync byte
+                    self.crc_errors += 1
+                    i += 1
+                    continue
+                messages.append(("binary", frame))
+                i += consumed
+                continue
+            i += 1
+            if self._frame is not None:
+                if byte == self.end:
+                    messages.append(("frame", self._frame.decode("utf-8", errors="replace")))
+                    self._frame = None
+                elif byte == self.start:
+                    # A new frame started before the last one finished, so the last one got mangled - start over
+                    self._frame = bytearray()
+                elif len(self._frame) < self.max_length:
+                    self._frame.append(byte)
+                else:
+                    self._frame = None
+            elif byte == self.start:
+                self._frame = bytearray()
+            elif byte == ord("\n"):
+                line = self._line.decode("utf-8", errors="replace").strip()
+                if line:
+                    messages.append(("line", line))
+                self._line = bytearray()
+            elif len(self._line) < self.max_length:
+                self._line.append(byte)
+        del buffer[:i]
+        return messages
+
+
+class SerialTransport():
+    """Class that reads a serial port on its own thread and matches the replies up with the commands we've sent"""
+    def __init__(self, ser, start_character:str="<", end_character:str=">", max_in_flight:int=8, timeout:float=1.0,
+                 custom_logger:logging.Logger=None) -> None:
+        """
+        Args:
+            ser (serial.Serial): An open serial port. Its read timeout sets how often the reader thread checks in, so keep it short
+            start_character (str, optional): Start of frame marker. Defaults to "<".
+            end_character (str, optional): End of frame marker. Defaults to ">".
+            max_in_flight (int, optional): Most commands we'll have waiting on a reply at once. Defaults to 8.
+            timeout (float, optional): How long to wait for a reply before giving up on a command, in seconds. Defaults to 1.0.
+            custom_logger (logging.Logger, optional): Logger to use instead of the module logger. Defaults to None.
+        """
+        if custom_logger is not None:
+            self.logger = custom_logger
+        else:
+            self.logger = logger
+
+        self.ser = ser
+        self.start_character = start_character
+        self.end_character = end_character
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.parser = FrameParser(start_character.encode(), end_character.encode())
+
+        # Commands waiting on a reply, oldest first: (command, future, deadline)
+        self._in_flight = deque()
+        self._lock = threading.Condition()
+        # Anything the device sent that wasn't a reply to a command
+        self.messages = deque(maxlen=100)
+        self._messages_ready = threading.Condition()
+        # Binary reading requests waiting on their reading, by tag: (future, deadline). Guarded by self._lock
+        self._reading_requests = {}
+        self._next_tag = 1
+        self.stale_readings = 0 # Readings that came in after their request gave up on them
+        # Streamed samples: (arrival time, device tick, values). Deque appends/pops are thread-safe, so no lock needed
+        self.samples = deque(maxlen=10000)
+        self._last_seq = None
+        self.missed_frames = 0  # Readings that never showed up, going by the gaps in the sequence numbers
+
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the reader thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._read_loop, name="serial reader", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout:float=2.0):
+        """Stops the reader thread and fails any commands still waiting on a reply"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._lock:
+            while self._in_flight:
+                command, future, _ = self._in_flight.popleft()
+                future.set_exception(ConnectionError(f"Serial transport stopped before {command} got a reply"))
+            for future, _ in self._reading_requests.values():
+                future.set_exception(ConnectionError("Serial transport stopped before the reading came in"))
+            self._reading_requests.clear()
+            self._lock.notify_all()
+
+    def request(self, command:str, timeout:float=None):
+        """Sends a command without waiting for the reply. If too many commands are already waiting on replies, waits
+        for one of them to finish (or time out) first
+
+        Args:
+            command (str): The command, without the start/end characters
+            timeout (float, optional): How long to wait for the reply, in seconds. Defaults to None (self.timeout).
+
+        Returns:
+            future (Future): Resolves to the reply frame (str), or raises TimeoutError if the device never answers
+        """
+        future = Future()
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            while len(self._in_flight) >= self.max_in_flight and not self._stop_event.is_set():
+                self._lock.wait(0.05)
+                self._expire()
+            if self._stop_event.is_set():
+                future.set_exception(ConnectionError("Serial transport isn't running"))
+                return future
+            self._in_flight.append((command, future, time.monotonic() + timeout))
+        with self._write_lock:
+            try:
+                self.ser.write((self.start_character + command + self.end_character).encode())
+            except Exception as e:
+                with self._lock:
+                    self._remove(future)
+                future.set_exception(e)
+        return future
+
+    def send(self, command:str):
+        """Sends a command that doesn't get a text reply (like starting streaming), without a Future
+
+        Args:
+            command (str): The command, without the start/end characters
+        """
+        with self._write_lock:
+            self.ser.write((self.start_character + command + self.end_character).encode())
+
+    def request_reading(self, num_channels:int, timeout:float=None):
+        """Asks the device for one binary reading of its analog channels, without waiting for it. Each request carries
+        a tag that the device sends back in the reading, so the reading always goes to the request that asked for it -
+        one that turns up after its request timed out gets thrown out instead of answering a later request
+
+        Args:
+            num_channels (int): How many analog channels to read
+            timeout (float, optional): How long to wait for the reading, in seconds. Defaults to None (self.timeout).
+
+        Returns:
+            future (Future): Resolves to (arrival time (epoch), seq, values tuple), or raises TimeoutError if the reading
+                never shows up
+        """
+        future = Future()
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            if self._stop_event.is_set():
+                future.set_exception(ConnectionError("Serial transport isn't running"))
+                return future
+            # Tags are 16 bits, and 0 is what the firmware sends back for a request without one
+            tag = self._next_tag
+            self._next_tag = self._next_tag % 0xFFFF + 1
+            self._reading_requests[tag] = (future, time.monotonic() + timeout)
+        try:
+            self.send(f"03;{num_channels:02d};{tag}")
+        except Exception as e:
+            with self._lock:
+                self._reading_requests.pop(tag, None)
+            future.set_exception(e)
+        return future
+
+    def read_samples(self):
+        """Grabs every streamed sample that's come in since we last asked, without waiting
+
+        Returns:
+            samples (list): List of (arrival time (epoch), device tick, values tuple), oldest first
+        """
+        samples = []
+        while True:
+            try:
+                samples.append(self.samples.popleft())
+            except IndexError:
+                return samples
+
+    @property
+    def crc_errors(self):
+        return self.parser.crc_errors
+
+    def read_message(self, timeout:float=None):
+        """Returns the oldest message the device sent on its own (not a reply to a command), waiting up to timeout
+        seconds for one to show up
+
+        Returns:
+            message (str): The message, or None if nothing came in
+        """
+        with self._messages_ready:
+            if not self.messages:
+                self._messages_ready.wait(timeout)
+            try:
+                return self.messages.popleft()
+            except IndexError:
+                return None
+
+    def in_flight(self):
+        """Returns how many commands are waiting on a reply"""
+        with self._lock:
+            return len(self._in_flight)
+
+    def _read_loop(self):
+        """Reader thread - reads whatever's arrived, splits it into messages, and sends each one where it belongs"""
+        while not self._stop_event.is_set():
+            try:
+                # Block for one byte (up to the port's read timeout), then grab everything else that's waiting
+                data = self.ser.read(1)
+                if data:
+                    data += self.ser.read(self.ser.in_waiting)
+            except Exception as e:
+                self.logger.error(f"Error reading serial port, stopping the reader: {e}")
+                break
+            arrival_time = time.time()
+            for kind, message in self.parser.feed(data):
+                if kind == "binary":
+                    self._add_reading(arrival_time, message)
+                    continue
+                if kind == "frame" and self._resolve(message):
+                    continue
+                with self._messages_ready:
+                    self.messages.append(message)
+                    self._messages_ready.notify_all()
+            with self._lock:
+                self._expire()
+
+    def _add_reading(self, arrival_time:float, frame:tuple):
+        """Queues up a binary reading or streamed sample, keeping track of any sequence numbers we skipped"""
+        frame_type, seq, values = frame
+        if self._last_seq is not None:
+            self.missed_frames += (seq - self._last_seq - 1) % 0x10000
+        self._last_seq = seq
+        if frame_type == binary_protocol.TYPE_STREAM:
+            self.samples.append((arrival_time, values[0], values[1:]))
+            return
+        if frame_type != binary_protocol.TYPE_READING:
+            self.logger.warning(f"Unknown binary frame type {frame_type}")
+            return
+        tag, values = values[0], values[1:]
+        with self._lock:
+            request = self._reading_requests.pop(tag, None)
+        if request is None:
+            self.stale_readings += 1
+            self.logger.debug(f"Reading {seq} (tag {tag}) came in after its request gave up, throwing it out")
+            return
+        request[0].set_result((arrival_time, seq, values))
+
+    def _resolve(self, reply:str):
+        """Hands a reply to the oldest in-flight command it belongs to
+
+        Returns:
+            matched (bool): Whether it was a reply to one of our commands
+        """
+        with self._lock:
+            for entry in self._in_flight:
+                command, future, _ = entry
+                if reply == command or reply.startswith(command + ";"):
+                    self._in_flight.remove(entry)
+                    self._lock.notify_all()
+                    break
+            else:
+                return False
+        future.set_result(reply)
+        return True
+
+    def _remove(self, future:Future):
+        for entry in self._in_flight:
+            if entry[1] is future:
+                self._in_flight.remove(entry)
+                self._lock.notify_all()
+                return
+
+    def _expire(self):
+        """Times out any commands (and reading requests) that have waited too long for a reply. Call with self._lock held"""
+        now = time.monotonic()
+        expired = [entry for entry in self._in_flight if entry[2] < now]
+        for entry in expired:
+            self._in_flight.remove(entry)
+            entry[1].set_exception(TimeoutError(f"No reply to {entry[0]}"))
+        if expired:
+            self._lock.notify_all()
+        for tag in [tag for tag, (_, deadline) in self._reading_requests.items() if deadline < now]:
+            future, _ = self._reading_requests.pop(tag)
+            future.set_exception(TimeoutError(f"No reading for request {tag}"))
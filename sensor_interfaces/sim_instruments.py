@@ -2,32 +2,79 @@
 
 import numpy as np
 import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+try:
+    from sensor_interfaces import binary_protocol
+    from sensor_interfaces.serial_transport import FrameParser
+    from sensor_interfaces.clock_sync import ClockSync
+except ImportError:
+    import binary_protocol
+    from serial_transport import FrameParser
+    from clock_sync import ClockSync
 
 import logging
 from logdecorator import log_on_start , log_on_end , log_on_error
-# Set up a logger for this module
-logger = logging.getLogger(__name__)
-# Set the lowest-severity log message the logger will handle (debug = lowest, critical = highest)
-logger.setLevel(logging.DEBUG)
-# Create a handler that saves logs to the log folder named as the current date
-# fh = logging.FileHandler(f"logs\\{time.strftime('%Y-%m-%d', time.localtime())}.log")
-fh = logging.StreamHandler()
-fh.setLevel(logging.DEBUG)
-logger.addHandler(fh)
-# Create a formatter to specify our log format
-formatter = logging.Formatter("%(levelname)s: %(asctime)s - %(name)s:  %(message)s", datefmt="%H:%M:%S")
-fh.setFormatter(formatter)
+from app_logging import get_logger
+logger = get_logger(__name__)
+
+class SimulatedArduinoDevice():
+    """Stands in for the Arduino end of the serial port - builds binary reading frames the same way the sketch does"""
+    def __init__(self, drift=50e-6):
+        """
+        Args:
+            drift (float, optional): How fast the simulated device clock runs compared to ours (50e-6 = 50 ppm fast), 
+                so the clock sync has something to correct. Defaults to 50e-6.
+        """
+        self.seq = 0
+        self.drift = drift
+        self._clock_start = time.monotonic()
+
+    def read_analog(self, num_channels, tag=0):
+        """Returns the bytes the Arduino would send for a reading of num_channels analog channels (volts, with some
+        noise), answering the request with this tag"""
+        values = 2.5 + 0.01*np.random.randn(num_channels)
+        frame = binary_protocol.pack_frame(binary_protocol.TYPE_READING, self.seq, values, prefix=(tag,))
+        self.seq = (self.seq + 1) & 0xFFFF
+        return frame
+
+    def micros(self):
+        """The device's 32-bit microsecond counter, like micros() on the Arduino"""
+        return int((time.monotonic() - self._clock_start)*1e6*(1 + self.drift)) & 0xFFFFFFFF
+
+    def stream_sample(self, num_channels):
+        """Returns the bytes the Arduino would send for one streamed sample, stamped with its counter"""
+        values = 2.5 + 0.01*np.random.randn(num_channels)
+        frame = binary_protocol.pack_frame(binary_protocol.TYPE_STREAM, self.seq, values, prefix=(self.micros(),))
+        self.seq = (self.seq + 1) & 0xFFFF
+        return frame
 
 class ArduinoInterface():
 
-    def __init__(self, serial_port, baud_rate, custom_logger=None):
+    def __init__(self, serial_port, baud_rate, custom_logger=None, num_channels=1):
         self.initialize_pyserial(serial_port, baud_rate)
+        # Simulated device on the other end of the "serial port", and the same parser the real transport uses
+        self.device = SimulatedArduinoDevice()
+        self.parser = FrameParser()
+        self.num_channels = num_channels
+        # Streaming mode - a thread plays the part of the Arduino, dropping (arrival time, frame bytes) in here
+        self.streaming = False
+        self.clock_sync = ClockSync()
+        self._stream = deque(maxlen=10000)
+        self._stream_stop = threading.Event()
+        self._stream_thread = None
 
         # Different serial command characters
         self.start_character = "<"
         self.end_character = ">"
         self.one_thing = "1"
         self.another_thing = "2"
+        # Batch pin commands carry one bit per pin (0-71) as this many hex digits
+        self.mask_digits = 18
+        # Simulated pin states, one bit per pin, so batch commands can read them back
+        self.pin_states = 0
 
         if custom_logger is not None:
             self.logger = custom_logger
@@ -39,6 +86,9 @@ class ArduinoInterface():
     def initialize_pyserial(self, port, baud):
         pass
 
+    def close_pyserial(self):
+        self.stop_streaming()
+
     @log_on_start(logging.INFO, "Initializing Arduino", logger=logger)
     def initialize_arduino(self, timeout=10):
         """
@@ -54,23 +104,91 @@ class ArduinoInterface():
     def shutdown_arduino(self):
         return 0
     
-    @log_on_start(logging.INFO, "Querying arduino", logger=logger)
-    def query(self):
-        output = np.nan
+    @log_on_start(logging.DEBUG, "Querying arduino", logger=logger)
+    def query(self, timeout=1):
+        output = None
         timestamp = time.time()
+        for kind, message in self.parser.feed(self.device.read_analog(self.num_channels)):
+            if kind == "binary":
+                frame_type, seq, values = message
+                # Skip the request tag
+                output = np.array(values[1:], dtype=float)
 
         return timestamp, output
+
+    @log_on_start(logging.INFO, "Starting simulated Arduino streaming at {rate_hz} Hz", logger=logger)
+    def start_streaming(self, rate_hz):
+        self.stop_streaming()
+        self.clock_sync.reset()
+        self._stream.clear()
+        self._stream_stop.clear()
+        self._stream_thread = threading.Thread(target=self._stream_loop, args=(rate_hz,), name="simulated Arduino stream", daemon=True)
+        self._stream_thread.start()
+        self.streaming = True
+
+    def stop_streaming(self):
+        self._stream_stop.set()
+        if self._stream_thread is not None:
+            self._stream_thread.join()
+            self._stream_thread = None
+        self.streaming = False
+
+    def _stream_loop(self, rate_hz):
+        """Sends samples at rate_hz, with a random serial/USB delay on each one like the real thing"""
+        period = 1/rate_hz
+        next_sample = time.monotonic()
+        while not self._stream_stop.is_set():
+            frame = self.device.stream_sample(self.num_channels)
+            self._stream.append((time.time() + np.random.exponential(0.003), frame))
+            next_sample += period
+            self._stream_stop.wait(max(next_sample - time.monotonic(), 0))
+
+    def read_samples(self):
+        samples = []
+        while True:
+            try:
+                samples.append(self._stream.popleft())
+            except IndexError:
+                break
+        timestamps = []
+        data = []
+        for arrival_time, frame in samples:
+            for kind, message in self.parser.feed(frame):
+                if kind == "binary" and message[0] == binary_protocol.TYPE_STREAM:
+                    values = message[2]
+                    timestamps.append(self.clock_sync.update(values[0], arrival_time))
+                    data.append(values[1:])
+        return np.array(timestamps, dtype=float), np.array(data, dtype=float).reshape(-1, self.num_channels)
     
     def validate_command(self, command):
         return True
 
     # @log_on_end(logging.INFO, "Sent command to arduino", logger=logger)
-    def send_command(self, command):
+    def send_command(self, command, timeout=1):
         command_valid = self.validate_command(command)
         if command_valid:
             logger.debug(f"Sent command to simulated Arduino: {command}")
+            # Reply the way the real Arduino does - echo the command, then the pin state(s)
+            future = Future()
+            if command.startswith("02"):
+                _, mask, states = command.split(";")
+                mask = int(mask, 16)
+                self.pin_states = (self.pin_states & ~mask) | (int(states, 16) & mask)
+                future.set_result(command + ";" + f"{self.pin_states & mask:0{self.mask_digits}X}")
+            elif command.startswith(("00", "01")):
+                # Single pin commands change the pin too, so a later batch command reads back the right state
+                pin = 1 << int(command.split(";")[1])
+                if command.startswith("01"):
+                    self.pin_states |= pin
+                else:
+                    self.pin_states &= ~pin
+                future.set_result(command + ";" + ("1" if command.startswith("01") else "0"))
+            else:
+                future.set_result(command + ";0")
+            return future
         else:
             logger.debug(f"Invalid Arduino command: {command}")
+            return None
 
     def validate_and_format_pin(self, pin):
         try:
@@ -97,12 +215,30 @@ class ArduinoInterface():
         if pin:
             self.logger.info(f"Setting pin {pin} high")
             msg_str = "01;"+pin
-            self.send_command(msg_str)
+            return self.send_command(msg_str)
 
     def set_pin_low(self, pin):
         pin = self.validate_and_format_pin(pin)
         if pin:
             self.logger.info(f"Setting pin {pin} low")
             msg_str = "00;"+pin
-            self.send_command(msg_str)
+            return self.send_command(msg_str)
+
+    def format_batch_command(self, pin_states):
+        mask = 0
+        states = 0
+        for pin, state in pin_states.items():
+            if not self.validate_and_format_pin(pin):
+                return False
+            mask |= 1 << int(pin)
+            if state:
+                states |= 1 << int(pin)
+        return f"02;{mask:0{self.mask_digits}X};{states:0{self.mask_digits}X}"
+
+    def set_pins(self, pin_states):
+        msg_str = self.format_batch_command(pin_states)
+        if msg_str:
+            self.logger.info(f"Setting pins {pin_states}")
+            return self.send_command(msg_str)
+        return None
 
@@ -0,0 +1,112 @@
+# -------------
+# Start-up benchmark
+#
+# Times how long the GUI takes to get going, so we notice when start-up gets slower. Each run starts the GUI in a fresh
+# Python process (so nothing's already imported) and records:
+#   - import:       how long "import gui" takes
+#   - first paint:  time from process start until the window first gets drawn - what the user actually waits on
+#   - ready:        time until start-up has finished completely (hardware probed, plots up, controls unlocked)
+#
+# Usage: python startup_benchmark.py [--runs 5] [--offscreen] [--json results.json]
+# Run it from the repo root, like the GUI. --offscreen runs without showing a window (e.g on a machine with no display).
+# -------------
+
+import time
+# Take the start time before anything else gets imported
+PROCESS_START = time.perf_counter()
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+def run_once(timeout:float):
+    """Starts the GUI in this process, times it, and prints the results as a line of JSON. Called in a child process"""
+    from PyQt5 import QtWidgets, QtCore
+
+    results = {}
+    qapp = QtWidgets.QApplication(sys.argv)
+
+    t = time.perf_counter()
+    import gui
+    results["import"] = time.perf_counter() - t
+
+    class PaintWatcher(QtCore.QObject):
+        """Notes the first time the window gets painted"""
+        def eventFilter(self, obj, event):
+            if event.type() == QtCore.QEvent.Paint and "first paint" not in results:
+                results["first paint"] = time.perf_counter() - PROCESS_START
+            return False
+
+    watcher = PaintWatcher()
+    # The filter has to be on the application, since the window starts painting from inside its constructor (show())
+    qapp.installEventFilter(watcher)
+    window = gui.ApplicationWindow()
+    results["constructor"] = time.perf_counter() - PROCESS_START
+
+    def on_ready():
+        results["ready"] = time.perf_counter() - PROCESS_START
+        QtCore.QTimer.singleShot(0, qapp.quit)
+    window.startup_finished.connect(on_ready)
+    # Give up if start-up never finishes
+    QtCore.QTimer.singleShot(int(timeout*1000), qapp.quit)
+    qapp.exec_()
+    qapp.removeEventFilter(watcher)
+    window.close()
+
+    print("STARTUP_BENCHMARK " + json.dumps(results), flush=True)
+
+def summarize(runs:list):
+    """Prints the median, min, and max of each measurement over all the runs"""
+    keys = ["import", "constructor", "first paint", "ready"]
+    print(f"{'':>12} {'median':>8} {'min':>8} {'max':>8}   (s, {len(runs)} runs)")
+    for key in keys:
+        values = [run[key] for run in runs if key in run]
+        if not values:
+            print(f"{key:>12} {'--':>8} {'--':>8} {'--':>8}")
+            continue
+        print(f"{key:>12} {statistics.median(values):8.3f} {min(values):8.3f} {max(values):8.3f}")
+    missing = sum("ready" not in run for run in runs)
+    if missing:
+        print(f"{missing} run(s) never finished starting up")
+
+def main():
+    parser = argparse.ArgumentParser(description="Times how long the GUI takes to start up")
+    parser.add_argument("--runs", type=int, default=5, help="How many times to start the GUI (default 5)")
+    parser.add_argument("--offscreen", action="store_true", help="Don't actually show the window")
+    parser.add_argument("--timeout", type=float, default=60, help="Longest to wait for one start-up, in seconds (default 60)")
+    parser.add_argument("--json", help="Also save every run's results to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_once(args.timeout)
+        return
+
+    env = dict(os.environ)
+    if args.offscreen:
+        env["QT_QPA_PLATFORM"] = "offscreen"
+    runs = []
+    for i in range(args.runs):
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", "--timeout", str(args.timeout)],
+                                 env=env, capture_output=True, text=True, timeout=args.timeout + 30)
+        result = None
+        for line in process.stdout.splitlines():
+            if line.startswith("STARTUP_BENCHMARK "):
+                result = json.loads(line[len("STARTUP_BENCHMARK "):])
+        if result is None:
+            print(f"Run {i+1} failed:\n{process.stderr[-2000:]}")
+            continue
+        runs.append(result)
+        print(f"Run {i+1}: " + ", ".join(f"{key} {value:.3f} s" for key, value in result.items()))
+
+    if runs:
+        summarize(runs)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(runs, f, indent=2)
+
+if __name__ == "__main__":
+    main()